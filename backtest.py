@@ -0,0 +1,365 @@
+import argparse
+import bisect
+import math
+import time
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+from policies import PumpCycleState, pump_cycle_decision
+
+POLICIES = ('start_system', 'control', 'main')
+# Config values the policies depend on
+PARAMETERS = ('temp_delta_threshold', 'light_threshold', 'analysis_interval', 'water_replace_time',
+              'average_samples', 'log_interval')
+# Parameters each policy actually uses
+POLICY_PARAMETERS = {
+    'start_system': ('temp_delta_threshold', 'light_threshold', 'water_replace_time'),
+    'control': ('temp_delta_threshold', 'water_replace_time'),
+    'main': PARAMETERS,
+}
+# start_system.py and control.py check the conditions every 10 s, main.py every log_interval
+CONTROL_PERIOD = 10
+
+
+class Trace:
+    """Recorded sensor values as NumPy columns sorted by time, NaN where a value is missing."""
+
+    KEYS = ('temp_E', 'temp_S', 'temp_A', 'light')
+
+    def __init__(self, ts: Any, temp_E: Any, temp_S: Any, temp_A: Any, light: Any):
+        ts = np.asarray(ts, dtype=float)
+        order = np.argsort(ts, kind='stable')
+        self.ts = ts[order]
+        self.temp_E = np.asarray(temp_E, dtype=float)[order]
+        self.temp_S = np.asarray(temp_S, dtype=float)[order]
+        self.temp_A = np.asarray(temp_A, dtype=float)[order]
+        self.light = np.asarray(light, dtype=float)[order]
+        self._checks: Dict[Any, Any] = {}
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, Any]) -> 'Trace':
+        """From TimeSeriesStore.query(..., 'raw') or LogColumns.columns(), None becomes NaN."""
+        return cls(columns['ts'], *(columns[key] for key in cls.KEYS))
+
+    @classmethod
+    def from_history(cls, file_path: str, start: float = 0, end: float = math.inf) -> 'Trace':
+        from timeseries import TimeSeriesStore
+        store = TimeSeriesStore(file_path)
+        try:
+            return cls.from_columns(store.query(start, end, 'raw'))
+        finally:
+            store.close()
+
+    @classmethod
+    def from_logs(cls, file_paths: Iterable[str], workers: Optional[int] = None, zone: Optional[str] = None) -> 'Trace':
+        """The statuses of one zone, the first one by default."""
+        from log_ingest import parse_logs
+        parsed = parse_logs(file_paths, workers)
+        columns = parsed.columns()
+        keep = np.asarray(columns['zone']) == parsed.zone_code(zone)
+        return cls(np.asarray(columns['ts'])[keep], *(np.asarray(columns[key])[keep] for key in cls.KEYS))
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def ticks(self, period: float) -> np.ndarray:
+        """Times of the control checks, every `period` seconds from the first sample."""
+        if not len(self.ts):
+            return np.empty(0)
+        return np.arange(self.ts[0], self.ts[-1], period)
+
+    def sample(self, ticks: np.ndarray, max_age: Optional[float] = None) -> Dict[str, np.ndarray]:
+        """Latest values at each tick, like a SensorHub subscription.
+
+        'fresh' is False where no sample is recent enough, the values are
+        NaN there.
+        """
+        index = np.searchsorted(self.ts, ticks, side='right') - 1
+        fresh = index >= 0
+        if max_age is not None:
+            fresh &= ticks - self.ts[np.maximum(index, 0)] <= max_age
+        index[~fresh] = 0
+        values = {'fresh': fresh}
+        for key in self.KEYS:
+            values[key] = getattr(self, key)[index]
+            values[key][~fresh] = np.nan
+        return values
+
+    def checks(self, period: float, max_age: Optional[float] = None):
+        """Ticks and sampled values of a control period, kept for the next policy or parameter set."""
+        key = (period, max_age)
+        if key not in self._checks:
+            ticks = self.ticks(period)
+            self._checks[key] = ticks, self.sample(ticks, max_age)
+        return self._checks[key]
+
+
+class BacktestResult(NamedTuple):
+    policy: str
+    ticks: np.ndarray
+    # Relay state after each check
+    relay: np.ndarray
+    # Times the relay switched and the state it switched to, OFF before the first
+    change_times: np.ndarray
+    change_states: np.ndarray
+    cycles: int
+    runtime: float
+    # Seconds with the delta above temp_delta_threshold (or params['missed_delta']) and the pump off
+    missed: float
+    duration: float
+
+
+def parameters(config: Dict[str, Any]) -> Dict[str, Any]:
+    """Policy parameters from a config.json dict or PoolConfig."""
+    params = {name: config[name] for name in PARAMETERS}
+    params['max_age'] = config['sensors'].get('max_age', {}).get('control')
+    return params
+
+
+def _result(policy: str, trace: Trace, ticks: np.ndarray, delta_ok: np.ndarray,
+            change_times: np.ndarray, change_states: np.ndarray) -> BacktestResult:
+    end = trace.ts[-1] if len(trace) else 0.0
+    change_times = np.asarray(change_times, dtype=float)
+    change_states = np.asarray(change_states, dtype=bool)
+    if not len(change_states):
+        # The pump never turned on (a night, a threshold out of reach)
+        relay = np.zeros(len(ticks), dtype=bool)
+        runtime = 0.0
+        cycles = 0
+    else:
+        index = np.searchsorted(change_times, ticks, side='right') - 1
+        relay = np.where(index >= 0, change_states[np.maximum(index, 0)], False)
+        durations = np.diff(np.append(change_times, end))
+        runtime = float(durations[change_states].sum())
+        cycles = int(np.count_nonzero(change_states))
+    periods = np.diff(np.append(ticks, end))
+    missed = float(periods[delta_ok & ~relay].sum())
+    duration = float(end - trace.ts[0]) if len(trace) else 0.0
+    return BacktestResult(policy, ticks, relay, change_times, change_states, cycles, runtime, missed, duration)
+
+
+def _hold(desired: np.ndarray, decided: np.ndarray) -> np.ndarray:
+    """Relay state per tick: the last decision taken, OFF before the first."""
+    index = np.where(decided, np.arange(len(decided)), -1)
+    np.maximum.accumulate(index, out=index)
+    return np.where(index >= 0, desired[np.maximum(index, 0)], False)
+
+
+def _changes(ticks: np.ndarray, relay: np.ndarray):
+    changes = np.flatnonzero(np.diff(relay.astype(np.int8), prepend=0))
+    return ticks[changes], relay[changes]
+
+
+def _compress(times: List[float], states: List[bool]):
+    """Relay changes from the states set in order, the last one set at an instant wins."""
+    times = np.array(times, dtype=float)
+    states = np.array(states, dtype=bool)
+    last = np.append(times[1:] != times[:-1], True)
+    times, states = times[last], states[last]
+    changed = np.diff(states.astype(np.int8), prepend=0) != 0
+    return times[changed], states[changed]
+
+
+def _delta_ok(values: Dict[str, np.ndarray], threshold: float) -> np.ndarray:
+    with np.errstate(invalid='ignore'):
+        return values['temp_S'] - values['temp_E'] >= threshold
+
+
+def _missed_delta_ok(values: Dict[str, np.ndarray], params: Dict[str, Any]) -> np.ndarray:
+    # 'missed_delta' compares parameter sets against one delta, temp_delta_threshold by default
+    return _delta_ok(values, params.get('missed_delta', params['temp_delta_threshold']))
+
+
+def evaluate_start_system(trace: Trace, params: Dict[str, Any]) -> BacktestResult:
+    """start_system.py: light_and_delta_decision every 10 s, after the start-up water replacement."""
+    ticks, values = trace.checks(CONTROL_PERIOD, params.get('max_age'))
+    with np.errstate(invalid='ignore'):
+        desired = (values['light'] >= params['light_threshold']) & _delta_ok(values, params['temp_delta_threshold'])
+    decided = ~(np.isnan(values['temp_E']) | np.isnan(values['temp_S']) | np.isnan(values['light']))
+    if len(ticks):
+        decided &= ticks >= ticks[0] + params['water_replace_time']
+    relay = _hold(desired, decided)
+    return _result('start_system', trace, ticks, _missed_delta_ok(values, params), *_changes(ticks, relay))
+
+
+def evaluate_control(trace: Trace, params: Dict[str, Any]) -> BacktestResult:
+    """control.py: delta_decision every 10 s, after waiting water_replace_time - 5 s."""
+    ticks, values = trace.checks(CONTROL_PERIOD, params.get('max_age'))
+    decided = ~(np.isnan(values['temp_E']) | np.isnan(values['temp_S']))
+    if len(ticks):
+        decided &= ticks - ticks[0] >= params['water_replace_time'] - 5
+    relay = _hold(_delta_ok(values, params['temp_delta_threshold']), decided)
+    return _result('control', trace, ticks, _missed_delta_ok(values, params), *_changes(ticks, relay))
+
+
+def _light_sufficient(values: Dict[str, np.ndarray], params: Dict[str, Any]) -> np.ndarray:
+    """LightSensor.is_average_light_sufficient at each tick, vectorized.
+
+    The history takes the light of every fresh snapshot but the first one
+    and averages the last average_samples - 1 of them.
+    """
+    light = values['light']
+    pushed = np.flatnonzero(values['fresh'] & ~np.isnan(light))[1:]
+    sufficient = np.zeros(len(light), dtype=bool)
+    if not len(pushed):
+        return sufficient
+    window = max(params['average_samples'] - 1, 1)
+    sums = np.concatenate(([0.0], np.cumsum(light[pushed])))
+    count = np.arange(1, len(pushed) + 1)
+    low = np.maximum(count - window, 0)
+    means = (sums[count] - sums[low]) / (count - low)
+    # Index of the last value pushed at or before each tick
+    latest = np.zeros(len(light), dtype=np.int64)
+    latest[pushed] = 1
+    latest = np.cumsum(latest) - 1
+    return np.where(latest >= 0, means[np.maximum(latest, 0)] > params['light_threshold'], False)
+
+
+def evaluate_main(trace: Trace, params: Dict[str, Any]) -> BacktestResult:
+    """main.py: pump_cycle_decision every log_interval, starting with a pump run.
+
+    The inputs of every check are computed with NumPy. The state machine
+    then only visits the checks where something can happen: when its
+    inputs change, when a deadline (end of the analysis period, of the
+    water replacement or of a pump run) is reached, or right after a
+    change. A stop and a restart by the same check do not count as a cycle,
+    the relay does not have time to release.
+    """
+    analysis_interval = params['analysis_interval']
+    water_replace_time = params['water_replace_time']
+    ticks, values = trace.checks(params['log_interval'], params.get('max_age'))
+    n = len(ticks)
+    if not n:
+        return _result('main', trace, ticks, np.zeros(0, dtype=bool), np.empty(0), np.zeros(0, dtype=bool))
+    valid = values['fresh'] & ~(np.isnan(values['temp_E']) | np.isnan(values['temp_S']) | np.isnan(values['temp_A']))
+    with np.errstate(invalid='ignore'):
+        ambient = values['temp_A'] > values['temp_E']
+    light_ok = _light_sufficient(values, params)
+
+    # Inputs of each check as bits, VALID | AMBIENT | LIGHT
+    inputs = valid * np.int8(4) + ambient * np.int8(2) + light_ok
+    # Checks where the inputs change
+    changes = np.flatnonzero(np.diff(inputs, prepend=-1)).tolist()
+    changes.append(n)
+    inputs = inputs.tolist()
+    tick_list = ticks.tolist()
+    # Relay state set by each check, in order
+    times: List[float] = []
+    states: List[bool] = []
+
+    # main.run() starts with a pump run
+    start = tick_list[0]
+    state = PumpCycleState(True, 0, 0, start)
+    pump_run_until = start + water_replace_time
+    times.append(start)
+    states.append(True)
+    segment = 0
+    k = 0
+    while k < n:
+        now = tick_list[k]
+        if pump_run_until is not None:
+            if pump_run_until > now:
+                k = max(k + 1, bisect.bisect_left(tick_list, pump_run_until))
+                continue
+            times.append(pump_run_until)
+            states.append(False)
+            state = PumpCycleState(False, *state[1:])
+            pump_run_until = None
+        while changes[segment + 1] <= k:
+            segment += 1
+        next_change = changes[segment + 1]
+        code = inputs[k]
+        if not code & 4:
+            k = next_change
+            continue
+        ambient_above, light_sufficient = code & 2, code & 1
+        state, _, start_pump_run = pump_cycle_decision(state, ambient_above, light_sufficient, now,
+                                                       analysis_interval, water_replace_time)
+        pump_running, analysis_start_time, water_replace_start_time, last_pump_start_time = state
+        if start_pump_run:
+            state = PumpCycleState(True, analysis_start_time, water_replace_start_time, now)
+            pump_run_until = now + water_replace_time
+            pump_running = True
+        if pump_running != states[-1]:
+            times.append(now)
+            states.append(pump_running)
+
+        k += 1
+        if pump_run_until is not None:
+            continue
+        # Skip the checks that cannot change anything before the inputs change or a deadline
+        if ambient_above:
+            if analysis_start_time == 0:
+                continue
+            deadline = (analysis_start_time + analysis_interval if water_replace_start_time == 0
+                        else water_replace_start_time + water_replace_time)
+            if not pump_running:
+                deadline = min(deadline, last_pump_start_time + analysis_interval)
+        elif pump_running and light_sufficient:
+            # Each check stops and restarts the pump, only the pump start time moves
+            if next_change > k:
+                k = next_change
+                state = PumpCycleState(True, analysis_start_time, water_replace_start_time, tick_list[k - 1])
+            continue
+        elif not pump_running and not light_sufficient:
+            deadline = last_pump_start_time + analysis_interval
+        else:
+            continue
+        # One check early, the policy compares differences
+        k = min(max(k, bisect.bisect_left(tick_list, deadline) - 1), next_change)
+    if pump_run_until is not None and pump_run_until <= trace.ts[-1]:
+        times.append(pump_run_until)
+        states.append(False)
+
+    return _result('main', trace, ticks, _missed_delta_ok(values, params), *_compress(times, states))
+
+
+EVALUATORS = {
+    'start_system': evaluate_start_system,
+    'control': evaluate_control,
+    'main': evaluate_main,
+}
+
+
+def backtest(trace: Trace, policy: str, params: Dict[str, Any]) -> BacktestResult:
+    if policy not in EVALUATORS:
+        raise ValueError(f"Unknown policy '{policy}', expected one of {POLICIES}")
+    return EVALUATORS[policy](trace, params)
+
+
+def parse_timestamp(value: str) -> float:
+    return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded sensor data through the pump control policies")
+    parser.add_argument('source', nargs='+', help="history database, or pool_control.log files")
+    parser.add_argument('--policy', choices=POLICIES + ('all',), default='all')
+    parser.add_argument('--config', default='config.json', help="parameters of the policies")
+    parser.add_argument('--start', type=parse_timestamp, default=0, help='"YYYY-MM-DD HH:MM" (history database only)')
+    parser.add_argument('--end', type=parse_timestamp, default=math.inf, help='"YYYY-MM-DD HH:MM" (history database only)')
+    parser.add_argument('--zone', help="zone of the zones section (log files only, default: the first one)")
+    args = parser.parse_args()
+
+    from pool_config import load_config
+    params = parameters(load_config(args.config))
+    begin = time.perf_counter()
+    if args.source[0].endswith('.log'):
+        trace = Trace.from_logs(args.source, zone=args.zone)
+    else:
+        trace = Trace.from_history(args.source[0], args.start, args.end)
+    print(f"Loaded {len(trace)} samples in {time.perf_counter() - begin:.2f} s")
+    if not len(trace):
+        return
+
+    print(f"{'policy':<14}{'cycles':>8}{'runtime':>10}{'missed':>10}{'replay':>10}")
+    for policy in POLICIES if args.policy == 'all' else (args.policy,):
+        begin = time.perf_counter()
+        result = backtest(trace, policy, params)
+        elapsed = time.perf_counter() - begin
+        print(f"{policy:<14}{result.cycles:>8}{result.runtime / 3600:>9.1f}h{result.missed / 3600:>9.1f}h{elapsed:>9.3f}s")
+
+
+if __name__ == "__main__":
+    main()
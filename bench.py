@@ -0,0 +1,260 @@
+import argparse
+import contextlib
+import copy
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, TextIO
+
+from simulator import InstantClock, Simulation
+
+RESULTS_FILE = 'bench_results.jsonl'
+# Noon in summer, the light is above the threshold and the collector warms up
+DEFAULT_START = "2024-07-20 12:00"
+# Calls traced to measure the memory allocated per call
+TRACED_CALLS = 50
+
+
+class BenchEnvironment:
+    """start_system.PoolControlSystem on fake drivers, in a temporary directory.
+
+    The hardware delays are skipped by an InstantClock, so only the Python
+    code around the drivers is measured. Nothing runs in the background: the
+    scheduler and the writer threads are not started. The status lines printed
+    while the system starts go to `output`.
+    """
+
+    def __init__(self, config_file: str, work_dir: str, start: float, output: TextIO):
+        with open(config_file, 'r') as f:
+            config = json.load(f)
+        config = copy.deepcopy(config)
+        config['error_logging']['log_directory'] = os.path.join(work_dir, 'logs')
+        config.setdefault('thingsboard', {}).update(enabled=True, host='localhost', port=1883, access_token='bench')
+        config.setdefault('metrics', {})['enabled'] = False
+        config.setdefault('diagnostics', {})['enabled'] = False
+        # Every call reads the sensors, as they would without adaptive sampling
+        config['sensors'].setdefault('sampling', {})['enabled'] = False
+        self.config_file = os.path.join(work_dir, 'config.json')
+        with open(self.config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+
+        self.clock = InstantClock(start)
+        self.simulation = Simulation(config, clock=self.clock).install()
+        import start_system
+        with contextlib.redirect_stdout(output):
+            self.system = start_system.PoolControlSystem(self.config_file)
+            # Fills the snapshot read by the consumers
+            self.system.sensor_hub.acquire()
+
+    def close(self) -> None:
+        """Stop the logging, its console handler writes to `output`."""
+        self.system.log_pipeline.stop()
+
+
+def bench_temperatures(env: BenchEnvironment) -> Callable[[], Any]:
+    return env.system.sensor_manager.get_temperature_data
+
+
+def bench_light(env: BenchEnvironment) -> Callable[[], Any]:
+    sensor_manager = env.system.sensor_manager
+    measurement_time = sensor_manager.light_sensor.measurement_time()
+
+    def step():
+        # One new measurement per read, as with the polling job
+        env.clock.io_delay(measurement_time)
+        sensor_manager.poll_light()
+        return sensor_manager.get_light_level()
+    return step
+
+
+def bench_update_displays(env: BenchEnvironment) -> Callable[[], Any]:
+    lcd_manager = env.system.lcd_manager
+    snapshot = env.system.sensor_hub.latest
+    # Slowly drifting readings: some frames change, most do not
+    frames = [
+        {name: value + (i % 20) * 0.02 for name, value in snapshot.temperatures.items()}
+        for i in range(100)
+    ]
+    position = [0]
+
+    def step():
+        position[0] = (position[0] + 1) % len(frames)
+        lcd_manager.update_displays(frames[position[0]])
+    return step
+
+
+def bench_log_status(env: BenchEnvironment) -> Callable[[], Any]:
+    return env.system.log_status
+
+
+def bench_state_write(env: BenchEnvironment) -> Callable[[], Any]:
+    state = env.system.state
+    counter = [0]
+
+    def step():
+        counter[0] += 1
+        state.set('next_scheduled_run', counter[0])
+        return state.flush()
+    return step
+
+
+def bench_load_config(env: BenchEnvironment) -> Callable[[], Any]:
+    from pool_config import load_config
+    return lambda: load_config(env.config_file)
+
+
+def bench_control_iteration(env: BenchEnvironment) -> Callable[[], Any]:
+    system = env.system
+    update_interval = system.config.update_interval
+
+    def step():
+        env.clock.io_delay(update_interval)
+        system.sensor_hub.acquire()
+        system.control_step()
+    return step
+
+
+# The hot paths of start_system.py, name -> setup returning the call to measure
+BENCHMARKS: Dict[str, Callable[[BenchEnvironment], Callable[[], Any]]] = {
+    'temperatures': bench_temperatures,
+    'light': bench_light,
+    'update_displays': bench_update_displays,
+    'log_status': bench_log_status,
+    'state_write': bench_state_write,
+    'load_config': bench_load_config,
+    'control_iteration': bench_control_iteration,
+}
+
+
+def _percentile(ordered: List[int], fraction: float) -> int:
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def measure(step: Callable[[], Any], seconds: float, min_calls: int = 20) -> Dict[str, float]:
+    """Time `step` for about `seconds`, then trace the memory of a few more calls."""
+    for _ in range(5):
+        step()
+    latencies = []
+    perf_counter_ns = time.perf_counter_ns
+    end = perf_counter_ns() + int(seconds * 1e9)
+    while perf_counter_ns() < end or len(latencies) < min_calls:
+        begin = perf_counter_ns()
+        step()
+        latencies.append(perf_counter_ns() - begin)
+    latencies.sort()
+
+    # Separate pass, tracemalloc slows every allocation down
+    gc.collect()
+    tracemalloc.start()
+    peak_total = 0
+    blocks = sys.getallocatedblocks()
+    for _ in range(TRACED_CALLS):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        step()
+        peak_total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    retained = sys.getallocatedblocks() - blocks
+
+    return {
+        'calls': len(latencies),
+        'ops_per_sec': len(latencies) / (sum(latencies) / 1e9),
+        'p50_us': _percentile(latencies, 0.50) / 1000,
+        'p99_us': _percentile(latencies, 0.99) / 1000,
+        'peak_kib': peak_total / TRACED_CALLS / 1024,
+        'retained_blocks': retained / TRACED_CALLS,
+    }
+
+
+def revision() -> Dict[str, Any]:
+    """Git revision of the working tree, marked dirty when tracked files changed."""
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return {'revision': 'unknown', 'dirty': False}
+    return {'revision': head, 'dirty': bool(status.strip())}
+
+
+def load_results(file_path: str) -> List[Dict[str, Any]]:
+    try:
+        with open(file_path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def find_baseline(records: List[Dict[str, Any]], rev: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Latest record of revision `rev`, or the latest record at all."""
+    for record in reversed(records):
+        if rev is None or record['revision'].startswith(rev):
+            return record
+    return None
+
+
+def print_results(results: Dict[str, Dict[str, float]], baseline: Optional[Dict[str, Any]]) -> None:
+    header = f"{'benchmark':<18}{'ops/s':>12}{'p50 us':>10}{'p99 us':>10}{'KiB/call':>10}{'kept/call':>10}"
+    if baseline is not None:
+        header += f"{'ops/s vs ' + baseline['revision']:>20}{'p99':>8}"
+    print(header)
+    for name, result in results.items():
+        line = (f"{name:<18}{result['ops_per_sec']:>12.1f}{result['p50_us']:>10.1f}{result['p99_us']:>10.1f}"
+                f"{result['peak_kib']:>10.2f}{result['retained_blocks']:>10.2f}")
+        previous = baseline['results'].get(name) if baseline is not None else None
+        if previous:
+            line += (f"{(result['ops_per_sec'] / previous['ops_per_sec'] - 1) * 100:>19.1f}%"
+                     f"{(result['p99_us'] / previous['p99_us'] - 1) * 100:>7.1f}%")
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the controller hot paths on simulated hardware")
+    parser.add_argument('benchmarks', nargs='*', metavar='NAME', help=f"benchmarks to run, among {', '.join(BENCHMARKS)} (default: all)")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--seconds', type=float, default=1.0, help="measuring time per benchmark")
+    parser.add_argument('--start', default=DEFAULT_START, help="simulated time, YYYY-mm-dd HH:MM")
+    parser.add_argument('--results', default=RESULTS_FILE, help="file the results are appended to")
+    parser.add_argument('--no-save', action='store_true', help="do not append the results")
+    parser.add_argument('--compare', nargs='?', const='', metavar='REV',
+                        help="show the change against the latest results of REV (default: the latest results)")
+    args = parser.parse_args()
+
+    names = args.benchmarks or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark '{name}', expected one of {tuple(BENCHMARKS)}")
+    baseline = None
+    if args.compare is not None:
+        baseline = find_baseline(load_results(args.results), args.compare or None)
+        if baseline is None:
+            print(f"No results of '{args.compare}' in {args.results}, nothing to compare with")
+
+    start = time.mktime(time.strptime(args.start, "%Y-%m-%d %H:%M"))
+    results = {}
+    with tempfile.TemporaryDirectory() as work_dir, open(os.devnull, 'w') as devnull:
+        env = BenchEnvironment(args.config, work_dir, start, devnull)
+        with contextlib.redirect_stdout(devnull):
+            for name in names:
+                results[name] = measure(BENCHMARKS[name](env), args.seconds)
+        env.close()
+
+    record = dict(revision(), time=time.strftime('%Y-%m-%d %H:%M:%S'), python=platform.python_version(),
+                  machine=platform.machine(), results=results)
+    print(f"Revision {record['revision']}{' (modified)' if record['dirty'] else ''}, "
+          f"Python {record['python']} on {record['machine']}")
+    print_results(results, baseline)
+    if not args.no_save:
+        with open(args.results, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        print(f"Results appended to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import logging
+from typing import Optional
+from hardware import clock
+
+logger = logging.getLogger(__name__)
+
+POWER_ON = 0x01
+RESET = 0x07
+CONTINUOUS_HIGH_RES_MODE_1 = 0x10
+CONTINUOUS_HIGH_RES_MODE_2 = 0x11
+CONTINUOUS_LOW_RES_MODE = 0x13
+# One-time modes power down after each measurement, mapped to their continuous counterpart
+ONE_TIME_TO_CONTINUOUS = {0x20: 0x10, 0x21: 0x11, 0x23: 0x13}
+
+MTREG_DEFAULT = 69
+MTREG_MIN = 31
+MTREG_MAX = 254
+# Maximum measurement time at the default MTreg, from the datasheet
+MEASUREMENT_TIME = {CONTINUOUS_HIGH_RES_MODE_1: 0.18, CONTINUOUS_HIGH_RES_MODE_2: 0.18, CONTINUOUS_LOW_RES_MODE: 0.024}
+RAW_MAX = 0xFFFF
+
+
+class BH1750:
+    """BH1750 ambient light sensor in continuous measurement mode.
+
+    The chip measures on its own and poll() only reads its data register,
+    so a reading never waits for a conversion. With `auto_range`, the
+    measurement time register (MTreg) is lowered when the count nears
+    saturation in bright sun and raised in dim light, keeping the count
+    around a quarter of full scale. read() returns the mean of the samples
+    polled since the previous read(), decimating a fast poll to the rate
+    of its consumer.
+    """
+
+    def __init__(self, bus, address: int = 0x23, mode: int = CONTINUOUS_HIGH_RES_MODE_1,
+                 mtreg: int = MTREG_DEFAULT, auto_range: bool = True):
+        if mode in ONE_TIME_TO_CONTINUOUS:
+            logger.info(f"BH1750 one-time mode {mode:#x} replaced by continuous mode {ONE_TIME_TO_CONTINUOUS[mode]:#x}")
+            mode = ONE_TIME_TO_CONTINUOUS[mode]
+        if mode not in MEASUREMENT_TIME:
+            raise ValueError(f"Unsupported BH1750 mode {mode:#x}")
+        self.bus = bus
+        self.address = address
+        self.mode = mode
+        self.mtreg = mtreg
+        self.auto_range = auto_range
+        self.ready_at = float('inf')
+        self.last_lux: Optional[float] = None
+        self.saturated = False
+        self._sum = 0.0
+        self._count = 0
+        self.samples = 0
+        self.range_changes = 0
+
+    def measurement_time(self) -> float:
+        return MEASUREMENT_TIME[self.mode] * self.mtreg / MTREG_DEFAULT
+
+    def start(self) -> None:
+        """Power the sensor on and start continuous measurements."""
+        self.bus.write_byte(self.address, POWER_ON)
+        self._set_mtreg(self.mtreg)
+
+    def _set_mtreg(self, mtreg: int) -> None:
+        self.mtreg = max(MTREG_MIN, min(MTREG_MAX, mtreg))
+        self.bus.write_byte(self.address, 0x40 | (self.mtreg >> 5))
+        self.bus.write_byte(self.address, 0x60 | (self.mtreg & 0x1F))
+        self.bus.write_byte(self.address, self.mode)
+        # The current measurement restarts with the new settings
+        self.ready_at = clock.monotonic() + self.measurement_time()
+
+    def to_lux(self, raw: int) -> float:
+        lux = raw / 1.2 * MTREG_DEFAULT / self.mtreg
+        return lux / 2 if self.mode == CONTINUOUS_HIGH_RES_MODE_2 else lux
+
+    def poll(self) -> Optional[float]:
+        """Read the latest measurement, None when none completed since the last poll."""
+        if self.ready_at == float('inf'):
+            self.start()
+        now = clock.monotonic()
+        if now < self.ready_at:
+            return None
+        data = self.bus.read_i2c_block_data(self.address, self.mode, 2)
+        raw = (data[0] << 8) | data[1]
+        lux = self.to_lux(raw)
+        self.saturated = raw == RAW_MAX and self.mtreg == MTREG_MIN
+        self.last_lux = lux
+        self._sum += lux
+        self._count += 1
+        self.samples += 1
+        self.ready_at = now + self.measurement_time()
+        if self.auto_range:
+            self._auto_range(raw)
+        return lux
+
+    def _auto_range(self, raw: int) -> None:
+        if raw > RAW_MAX * 0.8 and self.mtreg > MTREG_MIN:
+            target = self.mtreg * RAW_MAX / 4 / raw
+        elif raw < RAW_MAX / 32 and self.mtreg < MTREG_MAX:
+            target = self.mtreg * RAW_MAX / 4 / max(raw, 1)
+        else:
+            return
+        mtreg = max(MTREG_MIN, min(MTREG_MAX, int(target)))
+        if mtreg != self.mtreg:
+            self.range_changes += 1
+            self._set_mtreg(mtreg)
+
+    def read(self) -> Optional[float]:
+        """Mean of the samples since the previous read, polling once if there are none."""
+        if self.last_lux is None and self._count == 0:
+            # Only the very first read waits, for the first measurement
+            if self.ready_at == float('inf'):
+                self.start()
+            clock.sleep(self.ready_at - clock.monotonic())
+        if self._count == 0:
+            self.poll()
+        if self._count == 0:
+            return self.last_lux
+        lux = self._sum / self._count
+        self._sum = 0.0
+        self._count = 0
+        return lux
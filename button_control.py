@@ -1,28 +1,25 @@
 import time
 import threading
-from gpiozero import Button, OutputDevice
-from control import PUMP_RELAY_PIN
+from pool_config import load_config
 
-# Pin definitions for buttons
-BUTTON_B1_PIN = 5
-BUTTON_B2_PIN = 6
+# The third button is not in config.json
 BUTTON_B3_PIN = 13
 
-# Initialize buttons
-button_B1 = Button(BUTTON_B1_PIN)
-button_B2 = Button(BUTTON_B2_PIN)
-button_B3 = Button(BUTTON_B3_PIN)
-
-# Initialize pump relay
-pump_relay = OutputDevice(PUMP_RELAY_PIN)
-
 # State tracking
 button_B1_state = False
 button_B1_disabled = False
 button_B2_pressed_time = None
 
-def button_control_loop(control_state):
+def setup_devices(config):
+    """Claim the buttons and the pump relay, nothing is touched before this is called."""
+    from gpiozero import Button, OutputDevice
+    gpio = config['gpio']
+    buttons = (Button(gpio['button_b1_pin']), Button(gpio['button_b2_pin']), Button(gpio.get('button_b3_pin', BUTTON_B3_PIN)))
+    return buttons, OutputDevice(gpio['pump_relay_pin'])
+
+def button_control_loop(control_state, config_file='config.json'):
     global button_B1_state, button_B1_disabled, button_B2_pressed_time
+    (button_B1, button_B2, button_B3), pump_relay = setup_devices(load_config(config_file))
 
     while True:
         if button_B1.is_pressed:
@@ -48,7 +45,8 @@ def button_control_loop(control_state):
                     pump_relay.on()
                     time.sleep(300)  # Run pump for 5 minutes
                     pump_relay.off()
-                    control_state['running'] = should_pump_run(temperatures, time.time())
+                    # Automatic control decides again after the forced run
+                    control_state['running'] = True
                     button_B2_pressed_time = None
 
         if button_B3.is_pressed:
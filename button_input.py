@@ -0,0 +1,162 @@
+import logging
+import queue
+import threading
+import time
+from typing import Callable, Dict, Optional
+from hardware import GPIO, clock
+
+logger = logging.getLogger(__name__)
+
+RELEASED = 'released'
+PRESSED = 'pressed'
+
+
+class Button:
+    """Debounce state machine of one pull-up button (pressed = LOW).
+
+    A change within `debounce` of the last accepted one is a bounce, but it
+    may also be the release of a tap shorter than `debounce`: the level is
+    read again at `settle_at`, once the window has ended, and the level it
+    settled on is accepted.
+    """
+
+    def __init__(self, name: str, pin: int, action: Callable[[], None], debounce: float):
+        self.name = name
+        self.pin = pin
+        self.action = action
+        self.debounce = debounce
+        self.state = RELEASED
+        self.last_change = float('-inf')
+        # When to read the level again after a bounce, None when it is settled
+        self.settle_at: Optional[float] = None
+        self.bounces = 0
+
+    def on_edge(self, level: int, now: float) -> bool:
+        """Feed the level seen after an edge, True when it is a new press."""
+        new_state = PRESSED if level == GPIO.LOW else RELEASED
+        if new_state == self.state:
+            return False
+        if now - self.last_change < self.debounce:
+            self.bounces += 1
+            self.settle_at = self.last_change + self.debounce
+            return False
+        return self._change(new_state, now)
+
+    def settle(self, level: int, now: float) -> bool:
+        """Feed the level read at settle_at, True when it is a new press."""
+        self.settle_at = None
+        new_state = PRESSED if level == GPIO.LOW else RELEASED
+        if new_state == self.state:
+            return False
+        return self._change(new_state, now)
+
+    def _change(self, new_state: str, now: float) -> bool:
+        self.state = new_state
+        self.last_change = now
+        self.settle_at = None
+        return new_state == PRESSED
+
+
+class ButtonInput:
+    """Edge-triggered button input.
+
+    GPIO edge callbacks run the debounce state machines and queue accepted
+    presses; a single dispatcher thread waits for them and runs the button
+    actions, so nothing polls while the buttons are idle. The dispatcher
+    also reads a pin again when its debounce window ends after a bounce.
+    Actions should return quickly since presses are handled one at a time.
+
+    The time between the first edge of a press and the end of its action is
+    recorded per button in `latency` and passed to `latency_hook`.
+    """
+
+    def __init__(self, debounce_ms: float = 50, latency_hook: Optional[Callable[[str, float], None]] = None):
+        self.debounce = debounce_ms / 1000.0
+        self.latency_hook = latency_hook
+        self.buttons: Dict[int, Button] = {}
+        self.latency: Dict[str, Dict[str, float]] = {}
+        self.events: 'queue.Queue' = queue.Queue()
+        self._wakeup = threading.Event()
+        # The state machines are fed by the GPIO callbacks and the dispatcher
+        self._lock = threading.Lock()
+        self.thread = None
+
+    def add_button(self, name: str, pin: int, action: Callable[[], None]) -> None:
+        self.buttons[pin] = Button(name, pin, action, self.debounce)
+        self.latency[name] = {'count': 0, 'last': 0.0, 'max': 0.0, 'total': 0.0}
+
+    def start(self) -> None:
+        for pin in self.buttons:
+            GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._on_edge)
+        self.thread = threading.Thread(target=self._dispatch, name='button_input', daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        for pin in self.buttons:
+            try:
+                GPIO.remove_event_detect(pin)
+            except RuntimeError as e:
+                logger.error(f"Error removing edge detection on pin {pin}: {e}")
+        self.events.put(None)
+        self._wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _on_edge(self, pin: int) -> None:
+        edge_time = time.perf_counter()
+        button = self.buttons.get(pin)
+        if button is None:
+            return
+        with self._lock:
+            pressed = button.on_edge(GPIO.input(pin), clock.monotonic())
+            settling = button.settle_at is not None
+        if pressed:
+            self.events.put((button, edge_time))
+        if pressed or settling:
+            self._wakeup.set()
+
+    def _settle(self) -> Optional[float]:
+        """Read the pins whose debounce window ended, returns when the next one ends."""
+        now = clock.monotonic()
+        next_due = None
+        for pin, button in self.buttons.items():
+            with self._lock:
+                due = button.settle_at
+                if due is not None and now >= due:
+                    if button.settle(GPIO.input(pin), now):
+                        self.events.put((button, time.perf_counter()))
+                    due = None
+            if due is not None and (next_due is None or due < next_due):
+                next_due = due
+        return next_due
+
+    def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            next_due = self._settle()
+            while True:
+                try:
+                    event = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                if event is None:
+                    return
+                self._run(*event)
+            clock.wait(self._wakeup, 3600 if next_due is None else next_due - clock.monotonic())
+
+    def _run(self, button: Button, edge_time: float) -> None:
+        try:
+            button.action()
+        except Exception as e:
+            logger.error(f"Error handling button {button.name}: {e}")
+            return
+        self._record_latency(button.name, time.perf_counter() - edge_time)
+
+    def _record_latency(self, name: str, latency: float) -> None:
+        stats = self.latency[name]
+        stats['count'] += 1
+        stats['last'] = latency
+        stats['max'] = max(stats['max'], latency)
+        stats['total'] += latency
+        if self.latency_hook is not None:
+            self.latency_hook(name, latency)
@@ -1,51 +1,99 @@
-import os
-import json
 import time
 import logging
-import RPi.GPIO as GPIO
-from typing import Dict, Any
-from sensor import SensorManager, load_config
-
-class ConfigError(Exception):
-    pass
-
-def write_config(config: Dict[str, Any], file_path: str) -> None:
-    with open(file_path, 'w') as file:
-        json.dump(config, file, indent=2)
-
-def setup_logging(config: Dict[str, Any]):
-    if config['error_logging']['enabled']:
-        log_dir = config['error_logging']['log_directory']
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = os.path.join(log_dir, 'control_errors.log')
-        logging.basicConfig(
-            filename=log_file,
-            level=logging.ERROR,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
+import threading
+from typing import Dict
+from hardware import GPIO, clock
+from sensor import SensorManager
+from pool_config import ConfigWatcher
+from button_input import ButtonInput
+from state_store import RuntimeStateStore
+from policies import delta_decision
+from sensor_guard import SensorReading
+from log_pipeline import STATUS_LOGGER, setup_logging
+
+# Named after the module, __name__ is __main__ when it runs as a script
+logger = logging.getLogger('control')
+status_log = logging.getLogger(STATUS_LOGGER)
+
+def report_button_latency(name: str, latency: float):
+    logger.info(f"Button {name} handled {latency * 1000:.1f} ms after the press")
 
 def control_loop(temperatures: Dict[str, float]):
+    state = None
     try:
-        config = load_config('config.json')
-        setup_logging(config)
+        config_watcher = ConfigWatcher('config.json')
+        config = config_watcher.get()
+        setup_logging(config, 'control.log')
 
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
-        GPIO.setup(config['gpio']['button_b1_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(config['gpio']['button_b2_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(config['gpio']['pump_relay_pin'], GPIO.OUT, initial=GPIO.LOW)
+        GPIO.setup(config.button_b1_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(config.button_b2_pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        GPIO.setup(config.pump_relay_pin, GPIO.OUT, initial=GPIO.LOW)
 
         sensor_manager = SensorManager(config)
-
-        start_time = time.time()
-        water_replace_time = config['water_replace_time']
+        state = RuntimeStateStore.from_config(config, 'config.json')
+        state.start()
+
+        start_time = clock.time()
+        water_replace_time = config.water_replace_time
+        relay_pin = config.pump_relay_pin
+        temp_E = temperatures['temp_E']
+        temp_S = temperatures['temp_S']
+        delta_temp = temp_S - temp_E
+
+        # End of the water replacement started by B1, None when not running
+        water_replacement = {'until': None}
+        wakeup = threading.Event()
+
+        def button_b1_action():
+            GPIO.output(relay_pin, GPIO.HIGH)
+            logger.info("Button B1 pressed.")
+            state.update(
+                last_button_pressed="B1",
+                relay_state="ON",
+                stopped_by_b2=False,
+                last_pump_start_time=clock.time(),
+                button_b1_last_pressed=time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime()),
+            )
+            water_replacement['until'] = clock.time() + water_replace_time
+            wakeup.set()
+
+        def button_b2_action():
+            GPIO.output(relay_pin, GPIO.LOW)
+            logger.info("Button B2 pressed.")
+            state.update(
+                last_button_pressed="B2",
+                relay_state="OFF",
+                stopped_by_b2=True,
+                button_b2_last_pressed=time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime()),
+            )
+            water_replacement['until'] = None
+            wakeup.set()
+
+        buttons = ButtonInput(config.debounce_ms, report_button_latency)
+        buttons.add_button('B1', config.button_b1_pin, button_b1_action)
+        buttons.add_button('B2', config.button_b2_pin, button_b2_action)
+        buttons.start()
 
         while True:
-            config = load_config('config.json')
-            current_time = time.time()
-
-            if current_time - start_time < water_replace_time - 5:
-                pump_state = config['relay_state']
+            wakeup.clear()
+            config = config_watcher.get()
+            current_time = clock.time()
+            until = water_replacement['until']
+
+            if until is not None and current_time < until:
+                pump_state = "ON"
+                reason = "Water replacement started by B1"
+            elif until is not None:
+                water_replacement['until'] = None
+                GPIO.output(relay_pin, GPIO.LOW)
+                state.set('relay_state', "OFF")
+                pump_state = "OFF"
+                reason = "Water replacement by B1 completed"
+                logger.info("Pump stopped after water replacement by B1")
+            elif current_time - start_time < water_replace_time - 5:
+                pump_state = state.get('relay_state')
                 reason = f"Waiting for {water_replace_time} seconds after start"
             else:
                 temp_data = sensor_manager.get_temperature_data()
@@ -55,58 +103,38 @@ def control_loop(temperatures: Dict[str, float]):
 
                 temp_E = temperatures['temp_E']
                 temp_S = temperatures['temp_S']
-                delta_temp = temp_S - temp_E
+                logger.info("Sensor Data: %s", temperatures)
+
+                # A probe past its max_stale reads None, the relay stays as it is
+                if temp_E is None or temp_S is None:
+                    delta_temp = None
+                    pump_state = state.get('relay_state')
+                    reason = "Temperature missing, keeping relay state"
+                    logger.warning(reason)
+                else:
+                    delta_temp = temp_S - temp_E
+                    logger.info("Temp. Entrée: %.2f | Temp. Sortie: %.2f | Delta Temp: %.2f", temp_E, temp_S, delta_temp)
 
-                logging.info(f"Sensor Data: {temperatures}")
-                logging.info(f"Temp. Entrée: {temp_E:.2f} | Temp. Sortie: {temp_S:.2f} | Delta Temp: {delta_temp:.2f}")
+                    pump_state, reason = delta_decision(temp_E, temp_S, config.temp_delta_threshold)
+                    GPIO.output(relay_pin, GPIO.HIGH if pump_state == "ON" else GPIO.LOW)
+                    state.set('relay_state', pump_state)
 
-                if delta_temp < config['temp_delta_threshold']:
-                    pump_state = "OFF"
-                    reason = f"delta temperature ({delta_temp:.2f}) lower than threshold"
-                    GPIO.output(config['gpio']['pump_relay_pin'], GPIO.LOW)
-                else:
-                    pump_state = "ON"
-                    reason = f"delta temperature ({delta_temp:.2f}) above threshold"
-                    GPIO.output(config['gpio']['pump_relay_pin'], GPIO.HIGH)
-
-            if GPIO.input(config['gpio']['button_b1_pin']) == GPIO.LOW:
-                logging.info("Button B1 pressed.")
-                config['last_button_pressed'] = "B1"
-                config['relay_state'] = "ON"
-                config['last_pump_start_time'] = time.time()
-                config['button_b1_last_pressed'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                write_config(config, 'config.json')
-                GPIO.output(config['gpio']['pump_relay_pin'], GPIO.HIGH)
-                time.sleep(config['water_replace_time'])
-                config = load_config('config.json')
-
-                if not config.get('stopped_by_b2', False):
-                    config['relay_state'] = "OFF"
-                    write_config(config, 'config.json')
-                    GPIO.output(config['gpio']['pump_relay_pin'], GPIO.LOW)
-                logging.info("Pump stopped after water replacement by B1")
-                time.sleep(0.5)
-
-            elif GPIO.input(config['gpio']['button_b2_pin']) == GPIO.LOW:
-                logging.info("Button B2 pressed.")
-                config['last_button_pressed'] = "B2"
-                config['relay_state'] = "OFF"
-                config['stopped_by_b2'] = True
-                config['button_b2_last_pressed'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                write_config(config, 'config.json')
-                GPIO.output(config['gpio']['pump_relay_pin'], GPIO.LOW)
-                time.sleep(0.5)
-
-            current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-            log_message = f"{current_time_str} | RELAY: {pump_state} - [Reason: {reason}] | Temp. Entrée: {temp_E:.2f} | Temp. Sortie: {temp_S:.2f} | Delta Temp: {delta_temp:.2f} | Luminosité: {temperatures['light']:.2f} | Last Button Pressed: {config.get('last_button_pressed', 'None')}"
-            print(log_message)
-            logging.info(log_message)
-
-            time.sleep(10)
+            current_time_str = time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime())
+            status_log.info("%s | RELAY: %s - [Reason: %s] | Temp. Entrée: %s | Temp. Sortie: %s | Delta Temp: %s "
+                            "| Luminosité: %s | Last Button Pressed: %s", current_time_str, pump_state, reason,
+                            SensorReading(temp_E), SensorReading(temp_S), SensorReading(delta_temp),
+                            SensorReading(temperatures['light']), state.get('last_button_pressed', 'None'))
+
+            # Sleep until the next iteration, a button press or the end of the water replacement
+            until = water_replacement['until']
+            clock.wait(wakeup, 10 if until is None else min(10, until - clock.time()))
 
     except Exception as e:
-        logging.error(f"Error in control loop: {e}")
+        logger.error(f"Error in control loop: {e}")
         raise
+    finally:
+        if state is not None:
+            state.close()
 
 def main():
     try:
@@ -116,7 +144,7 @@ def main():
         print("\nExiting control loop.")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        logging.exception("An unexpected error occurred")
+        logger.exception("An unexpected error occurred")
     finally:
         GPIO.cleanup()
 
@@ -0,0 +1,189 @@
+import collections
+import faulthandler
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Dict, List, Optional, Tuple
+from hardware import clock
+
+logger = logging.getLogger(__name__)
+
+# Longest profile the HTTP endpoint accepts, in seconds
+MAX_PROFILE_SECONDS = 600
+
+
+def _thread_names() -> Dict[int, str]:
+    return {thread.ident: thread.name for thread in threading.enumerate()}
+
+
+def dump_stacks() -> str:
+    """Current stack of every thread, with the thread names, most recent call last."""
+    names = _thread_names()
+    parts = []
+    for ident, frame in sys._current_frames().items():
+        parts.append(f"Thread {names.get(ident, '?')} ({ident:#x}):\n" + ''.join(traceback.format_stack(frame)))
+    return '\n'.join(parts)
+
+
+def _frame_label(code, lineno: int) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{lineno})"
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread at a fixed interval.
+
+    This is a wall clock profile: a thread blocked on a 1-wire read or waiting
+    for its next deadline is sampled like a busy one, which is what shows
+    where a stall happens. Stacks are kept as tuples of code objects and
+    formatted once at the end, a sample costs a few microseconds per thread.
+    Real time is used even in the simulator, the process itself is profiled.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: Dict[Tuple[str, Tuple], int] = collections.Counter()
+        self.sample_count = 0
+
+    def run(self, duration: float) -> None:
+        own = threading.get_ident()
+        names = _thread_names()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names = _thread_names()
+                stack = []
+                while frame is not None:
+                    stack.append((frame.f_code, frame.f_lineno))
+                    frame = frame.f_back
+                self.samples[(names.get(ident, '?'), tuple(stack))] += 1
+            self.sample_count += 1
+            time.sleep(self.interval)
+
+    def collapsed(self) -> List[str]:
+        """Stacks in the collapsed format of flamegraph.pl and speedscope: 'thread;outer;...;inner count'."""
+        lines = collections.Counter()
+        for (name, stack), count in self.samples.items():
+            frames = ';'.join(_frame_label(code, lineno) for code, lineno in reversed(stack))
+            lines[f"{name};{frames}"] += count
+        return [f"{stack} {count}" for stack, count in sorted(lines.items())]
+
+
+class Diagnostics:
+    """Thread stacks and sampling profiles of the running process, on demand.
+
+    SIGUSR1 appends the stack of every thread to stacks.txt: faulthandler
+    writes it at once from the signal handler, even when the main thread is
+    stuck, then a dump with the thread names is written by a background
+    thread woken by the Python handler. SIGUSR2 starts a profile of `profile_seconds` in a
+    background thread, written to profile-<time>.folded. Both only read the
+    stacks, pump control carries on. The same is available on the local
+    HTTP server at /debug/stacks and /debug/profile?seconds=N.
+    """
+
+    def __init__(self, directory: str, profile_seconds: float = 30, sample_interval: float = 0.01):
+        self.directory = directory
+        self.profile_seconds = profile_seconds
+        self.sample_interval = sample_interval
+        self._stack_file = None
+        self._profiling = threading.Lock()
+        self._stacks_requested = threading.Event()
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['Diagnostics']:
+        """The diagnostics configured in config.json, None when disabled."""
+        settings = config.get('diagnostics', {})
+        if not settings.get('enabled', False):
+            return None
+        directory = settings.get('directory', config['error_logging']['log_directory'])
+        return cls(directory, settings.get('profile_seconds', 30), settings.get('sample_interval', 0.01))
+
+    def _path(self, name: str) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        return os.path.join(self.directory, name)
+
+    def install_signals(self) -> None:
+        """Handle SIGUSR1 and SIGUSR2, from the main thread only."""
+        if not hasattr(signal, 'SIGUSR1') or threading.current_thread() is not threading.main_thread():
+            logger.warning("Diagnostic signals not installed, use the HTTP endpoints")
+            return
+        signal.signal(signal.SIGUSR1, self._on_stacks_signal)
+        signal.signal(signal.SIGUSR2, self._on_profile_signal)
+        self._stack_file = open(self._path('stacks.txt'), 'a')
+        # Chained, the Python handler above runs after the immediate dump
+        faulthandler.register(signal.SIGUSR1, file=self._stack_file, all_threads=True, chain=True)
+        threading.Thread(target=self._stack_writer, name='stack_dump', daemon=True).start()
+        logger.info(f"Diagnostics: kill -USR1 {os.getpid()} dumps the thread stacks, -USR2 runs a profile")
+
+    def _on_stacks_signal(self, signum, frame) -> None:
+        # Runs on the main thread, the scheduler, wherever it was interrupted: it may hold
+        # the lock of the log queue or of the file, so the dump is written by another thread
+        self._stacks_requested.set()
+
+    def _stack_writer(self) -> None:
+        while True:
+            self._stacks_requested.wait()
+            self._stacks_requested.clear()
+            try:
+                self.write_stacks()
+            except Exception as e:
+                logger.error("Error writing the thread stacks: %s", e)
+
+    def _on_profile_signal(self, signum, frame) -> None:
+        self.start_profile()
+
+    def write_stacks(self) -> str:
+        """Append the named stacks to stacks.txt, returns them."""
+        stacks = dump_stacks()
+        stamp = time.strftime('%Y-%m-%d %H:%M:%S', clock.localtime())
+        if self._stack_file is None:
+            self._stack_file = open(self._path('stacks.txt'), 'a')
+        self._stack_file.write(f"=== {stamp} pid {os.getpid()} ===\n{stacks}\n")
+        self._stack_file.flush()
+        logger.info(f"Thread stacks written to {self._stack_file.name}")
+        return stacks
+
+    def profile(self, seconds: Optional[float] = None) -> Optional[Tuple[str, List[str]]]:
+        """Profile for `seconds` and write the collapsed stacks, returns the file and its lines.
+
+        None when a profile is already running.
+        """
+        if not self._profiling.acquire(blocking=False):
+            return None
+        try:
+            seconds = self.profile_seconds if seconds is None else seconds
+            profiler = SamplingProfiler(self.sample_interval)
+            logger.info(f"Profiling for {seconds} s")
+            profiler.run(seconds)
+            lines = profiler.collapsed()
+            path = self._path(time.strftime('profile-%Y%m%d-%H%M%S.folded', clock.localtime()))
+            with open(path, 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+            logger.info(f"Profile of {profiler.sample_count} samples written to {path}")
+            return path, lines
+        finally:
+            self._profiling.release()
+
+    def start_profile(self, seconds: Optional[float] = None) -> None:
+        threading.Thread(target=self.profile, args=(seconds,), name='profiler', daemon=True).start()
+
+    def add_routes(self, server) -> None:
+        """Serve /debug/stacks and /debug/profile?seconds=N on a metrics.MetricsServer."""
+        server.add_route('/debug/stacks', lambda query: dump_stacks())
+        server.add_route('/debug/profile', self._profile_route)
+
+    def _profile_route(self, query: Dict[str, List[str]]) -> str:
+        try:
+            seconds = float(query.get('seconds', [self.profile_seconds])[0])
+        except ValueError:
+            return "seconds must be a number\n"
+        result = self.profile(min(max(seconds, 0), MAX_PROFILE_SECONDS))
+        if result is None:
+            return "A profile is already running\n"
+        return '\n'.join(result[1]) + '\n'
@@ -1,5 +1,8 @@
-import time
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 def log_error(error):
-    with open("error_log.txt", "a") as log_file:
-        log_file.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - {str(error)}\n")
+    """Log an error through the logging pipeline (errors.log), with its traceback when it is an exception."""
+    logger.error("%s", error, exc_info=error if isinstance(error, BaseException) else None)
@@ -0,0 +1,93 @@
+import importlib
+import os
+import threading
+import time
+from typing import Dict, Any
+
+# Modules used on the Raspberry Pi, imported only when first needed
+PI_DRIVERS = {
+    'GPIO': 'RPi.GPIO',
+    'w1thermsensor': 'w1thermsensor',
+    'w1bus': 'w1bus',
+    'smbus': 'smbus',
+    'tm1637': 'tm1637',
+    'tb_device_mqtt': 'tb_device_mqtt',
+}
+
+_lock = threading.Lock()
+_drivers: Dict[str, Any] = {}
+
+
+class RealClock:
+    """Wall clock used on the Pi."""
+
+    def time(self) -> float:
+        return time.time()
+
+    def monotonic(self) -> float:
+        return time.monotonic()
+
+    def localtime(self) -> 'time.struct_time':
+        return time.localtime()
+
+    def sleep(self, seconds: float) -> None:
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        """Sleep up to `timeout` seconds, returning early when `event` is set."""
+        return event.wait(max(timeout, 0))
+
+
+def install(drivers: Dict[str, Any]) -> None:
+    """Replace the active drivers (e.g. with the fakes from simulator.py)."""
+    with _lock:
+        _drivers.clear()
+        _drivers.update(drivers)
+
+
+def _load_default(name: str) -> Any:
+    backend = os.environ.get('PIPOOL_BACKEND', 'pi')
+    if backend == 'sim':
+        import simulator
+        simulator.Simulation.from_config_file('config.json', clock=simulator.WallClock()).install()
+        return _drivers[name]
+    if backend != 'pi':
+        raise RuntimeError(f"Unknown PIPOOL_BACKEND '{backend}', expected 'pi' or 'sim'")
+    if name == 'clock':
+        return RealClock()
+    return importlib.import_module(PI_DRIVERS[name])
+
+
+def get(name: str) -> Any:
+    driver = _drivers.get(name)
+    if driver is None:
+        with _lock:
+            driver = _drivers.get(name)
+        if driver is None:
+            driver = _load_default(name)
+            with _lock:
+                driver = _drivers.setdefault(name, driver)
+    return driver
+
+
+class _DriverProxy:
+    """Module stand-in that resolves the active backend on attribute access."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str) -> Any:
+        return getattr(get(self._name), attr)
+
+    def __repr__(self) -> str:
+        return f"<driver proxy '{self._name}'>"
+
+
+GPIO = _DriverProxy('GPIO')
+w1thermsensor = _DriverProxy('w1thermsensor')
+w1bus = _DriverProxy('w1bus')
+smbus = _DriverProxy('smbus')
+tm1637 = _DriverProxy('tm1637')
+tb_device_mqtt = _DriverProxy('tb_device_mqtt')
+clock = _DriverProxy('clock')
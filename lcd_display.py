@@ -1,43 +1,59 @@
 import time
-import tm1637
-import json
 import logging
-import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+from hardware import tm1637, clock
+from pool_config import ConfigError, PoolConfig, load_config
+from metrics import STAGE_TIME, histogram
+from log_pipeline import setup_logging
+
+logger = logging.getLogger(__name__)
+
+DISPLAY_WRITE_TIME = histogram('pipool_display_write_seconds', "Time to write the segments of each display", ('display',))
+
+# Segment bytes of the characters we display, same encoding as tm1637.TM1637.encode_string
+GLYPHS = {str(digit): segments for digit, segments in enumerate(b'\x3F\x06\x5B\x4F\x66\x6D\x7D\x07\x7F\x6F')}
+GLYPHS.update({' ': 0x00, '-': 0x40})
+COLON = 0x80
+# Shown in place of a temperature the sensor could not provide
+NO_READING = bytes((GLYPHS['-'],) * 4)
+# "HH" / "MM" for 0..99, the time is two lookups
+TWO_DIGITS = [bytes((GLYPHS[f"{n:02d}"[0]], GLYPHS[f"{n:02d}"[1]])) for n in range(100)]
+# Temperatures rendered in advance, in tenths of a degree
+TEMPERATURE_RANGE = range(-999, 2000)
+
+
+def encode(text: str) -> bytes:
+    """Segment bytes for a 4 character display, unknown characters are blank."""
+    return bytes(GLYPHS.get(char, 0) for char in text[:4].ljust(4))
 
-def load_config(file_path: str) -> Dict[str, Any]:
-    try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        raise ConfigError(f"Error loading configuration: {e}")
 
-class ConfigError(Exception):
-    pass
+def format_temperature(temp: float, temperature_format: str = "{:.1f}") -> str:
+    """'25.3' is shown as '25 3', the digit point not being wired on these displays."""
+    int_part, frac_part = temperature_format.format(temp).split(".")
+    return f"{int_part[:2]} {frac_part[0]}"
+
 
 class LCDManager:
-    def __init__(self, config: Dict[str, Any]):
+    def __init__(self, config: PoolConfig):
         self.config = config
-        self.setup_logging()
         self.displays = self._initialize_displays()
         self.display_settings = {
             "update_interval": self.config['sensors']['temperature'].get('update_interval', 1),
             "temperature_format": "{:.1f}",
-            "time_format": "%H%M"
+            "time_format": "%H%M",
+            # Resend unchanged segments after this many seconds, in case a display was reset
+            "refresh_interval": 300
+        }
+        self.temperature_glyphs = {
+            tenths: encode(format_temperature(tenths / 10, self.display_settings['temperature_format']))
+            for tenths in TEMPERATURE_RANGE
         }
+        # Last segments sent to each display, a display is only written when they change
+        self.segments: Dict[str, bytes] = {}
+        self.last_write: Dict[str, float] = {}
+        self.stats = {key: {'writes': 0, 'skipped': 0, 'time': 0.0} for key in self.displays}
 
-    def setup_logging(self):
-        if self.config['error_logging']['enabled']:
-            log_dir = self.config['error_logging']['log_directory']
-            os.makedirs(log_dir, exist_ok=True)
-            log_file = os.path.join(log_dir, 'lcd_errors.log')
-            logging.basicConfig(
-                filename=log_file,
-                level=logging.ERROR,
-                format='%(asctime)s - %(levelname)s - %(message)s'
-            )
-
-    def _initialize_displays(self) -> Dict[str, tm1637.TM1637]:
+    def _initialize_displays(self) -> Dict[str, Any]:
         displays = {}
         temp_displays = self.config['sensors']['temperature']['displays']
         for key, display_info in temp_displays.items():
@@ -49,36 +65,63 @@ class LCDManager:
                 )
 ##                displays[key].brightness(2)  # Set brightness to maximum
             except Exception as e:
-                logging.error(f"Error initializing display {key}: {e}")
+                logger.error(f"Error initializing display {key}: {e}")
         return displays
 
-    def display_temperature(self, display_key: str, temp: float) -> None:
+    def render(self, display_key: str, segments: bytes) -> bool:
+        """Send the segments unless the display already shows them, True when written."""
+        stats = self.stats[display_key]
+        now = clock.monotonic()
+        if (self.segments.get(display_key) == segments
+                and now - self.last_write[display_key] < self.display_settings['refresh_interval']):
+            stats['skipped'] += 1
+            return False
+        self.displays[display_key].write(segments)
+        self.last_write[display_key] = clock.monotonic()
+        stats['time'] += self.last_write[display_key] - now
+        DISPLAY_WRITE_TIME.labels(display_key).observe(self.last_write[display_key] - now)
+        stats['writes'] += 1
+        self.segments[display_key] = segments
+        return True
+
+    def display_temperature(self, display_key: str, temp: Optional[float]) -> None:
+        if temp is None:
+            self.render(display_key, NO_READING)
+            return
         try:
-            temp_str = self.display_settings['temperature_format'].format(temp)
-            int_part, frac_part = temp_str.split(".")
-            display_str = f"{int_part[:2]} {frac_part[0]}"
-            self.displays[display_key].show(display_str)
-        except (ValueError, TypeError, KeyError) as e:
-            logging.error(f"Error displaying temperature on {display_key}: {e}")
+            segments = self.temperature_glyphs.get(int(round(round(temp, 1) * 10)))
+            if segments is None:
+                segments = encode(format_temperature(temp, self.display_settings['temperature_format']))
+            self.render(display_key, segments)
+        except (ValueError, TypeError, KeyError, OverflowError) as e:
+            logger.error(f"Error displaying temperature on {display_key}: {e}")
 
     def display_time(self) -> None:
-        current_time = time.strftime(self.display_settings['time_format'])
-        self.displays['H'].show(current_time, colon=True)
+        now = clock.localtime()
+        if self.display_settings['time_format'] == "%H%M":
+            hours = TWO_DIGITS[now.tm_hour]
+            segments = bytes((hours[0], hours[1] | COLON)) + TWO_DIGITS[now.tm_min]
+        else:
+            segments = bytearray(encode(time.strftime(self.display_settings['time_format'], now)))
+            segments[1] |= COLON
+            segments = bytes(segments)
+        for key in self.config.time_displays:
+            self.render(key, segments)
 
     def update_displays(self, temperatures: Dict[str, float]) -> None:
-        temp_displays = self.config['sensors']['temperature']['displays']
-        for key, display_info in temp_displays.items():
-            if key != 'H':  # 'H' is reserved for time display
-                sensor_name = display_info['name']
+        with STAGE_TIME.labels('update_displays').time():
+            for key, sensor_name in self.config.display_sensors:
                 if sensor_name in temperatures:
                     self.display_temperature(key, temperatures[sensor_name])
                 else:
-                    logging.error(f"Temperature for '{sensor_name}' not found in provided temperatures.")
-        self.display_time()
+                    logger.error(f"Temperature for '{sensor_name}' not found in provided temperatures.")
+            if self.config.has_time_display:
+                self.display_time()
 
 def main():
     try:
         config = load_config('config.json')
+        setup_logging(config, 'lcd.log')
         lcd_manager = LCDManager(config)
         while True:
             # Simulate temperature readings (replace with actual data source)
@@ -88,13 +131,13 @@ def main():
                 'ambient': 23.3
             }
             lcd_manager.update_displays(temperatures)
-            time.sleep(lcd_manager.display_settings['update_interval'])
+            clock.sleep(lcd_manager.display_settings['update_interval'])
     except ConfigError as e:
-        logging.error(f"Configuration error: {e}")
+        logger.error(f"Configuration error: {e}")
     except KeyboardInterrupt:
         print("Program terminated by user")
     except Exception as e:
-        logging.exception("An unexpected error occurred")
+        logger.exception("An unexpected error occurred")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,44 +1,52 @@
-import smbus
 import json
+from hardware import smbus
+from rolling import RollingWindow
+from bh1750 import BH1750
+from metrics import SENSOR_READ_ERRORS, SENSOR_READ_TIME
 
 class LightSensor:
     def __init__(self, config):
-        self.device = config['sensors']['light']['device_address']
-        self.mode = config['sensors']['light']['mode']
-        self.bus = smbus.SMBus(config['sensors']['light']['bus_number'])
+        light_config = config['sensors']['light']
+        self.sensor = BH1750(
+            smbus.SMBus(light_config['bus_number']),
+            int(light_config['device_address'], 16),
+            int(light_config['mode'], 16),
+            auto_range=light_config.get('auto_range', True)
+        )
         self.average_samples = config['average_samples']
         self.light_threshold = config['light_threshold']
-        self.light_history = []
+        # The first sample after start-up is ignored, the mean covers the next average_samples - 1
+        self.light_history = RollingWindow(max(self.average_samples - 1, 1))
+        self.first_sample_seen = False
+
+    def poll(self):
+        """Collect the latest measurement, the sensor measures continuously, raises IOError."""
+        with SENSOR_READ_TIME.labels('light_poll').time():
+            self.sensor.poll()
+
+    def read(self):
+        """Light level averaged over the measurements polled since the last call, raises IOError."""
+        with SENSOR_READ_TIME.labels('light').time():
+            return self.sensor.read()
 
     def get_light_level(self):
-        """Read the light level from the sensor."""
+        """Same as read(), None on error."""
         try:
-            data = self.bus.read_i2c_block_data(int(self.device, 16), int(self.mode, 16))
-            light_level = self.convert_to_number(data)
-            return light_level
+            return self.read()
         except IOError:
-            return None
-
-    def convert_to_number(self, data):
-        """Convert the raw light sensor data to a number."""
-        try:
-            return (data[1] + (256 * data[0])) / 1.2
-        except IndexError:
+            SENSOR_READ_ERRORS.labels('light').inc()
             return None
 
     def update_light_history(self, light_level):
         """Update the history of light levels with a new sample, ignoring the first one."""
-        if len(self.light_history) < self.average_samples:
-            self.light_history.append(light_level)
-        else:
-            self.light_history.pop(0)
-            self.light_history.append(light_level)
+        if not self.first_sample_seen:
+            self.first_sample_seen = True
+            return
+        self.light_history.push(light_level)
 
     def get_moving_mean(self):
         """Calculate the moving mean of the light levels."""
-        if len(self.light_history) <= 1:
-            return None
-        return sum(self.light_history[1:]) / (len(self.light_history) - 1)
+        return self.light_history.mean
 
     def is_average_light_sufficient(self):
         """Check if the moving mean of light is above the threshold."""
@@ -47,22 +55,26 @@ class LightSensor:
             return mean_light > self.light_threshold
         return False
 
-# Charger la configuration depuis le fichier config.json
-with open('config.json', 'r') as config_file:
-    config = json.load(config_file)
+def main():
+    # Charger la configuration depuis le fichier config.json
+    with open('config.json', 'r') as config_file:
+        config = json.load(config_file)
+
+    # Créer une instance de LightSensor avec la configuration chargée
+    sensor = LightSensor(config)
 
-# Créer une instance de LightSensor avec la configuration chargée
-sensor = LightSensor(config)
+    # Mettre à jour l'historique des niveaux de lumière et obtenir le résultat
+    light_level = sensor.get_light_level()
+    if light_level is not None:
+        sensor.update_light_history(light_level)
 
-# Mettre à jour l'historique des niveaux de lumière et obtenir le résultat
-light_level = sensor.get_light_level()
-if light_level is not None:
-    sensor.update_light_history(light_level)
+    # Obtenir la moyenne mobile et vérifier si elle dépasse le seuil
+    average_light = sensor.get_moving_mean()
+    result = sensor.is_average_light_sufficient()
 
-# Obtenir la moyenne mobile et vérifier si elle dépasse le seuil
-average_light = sensor.get_moving_mean()
-result = sensor.is_average_light_sufficient()
+    # Afficher les résultats
+    print(f"Valeur moyenne de la lumière: {average_light}")
+    print(f"Luminosité moyenne dépasse la limite: {result}")
 
-# Afficher les résultats
-print(f"Valeur moyenne de la lumière: {average_light}")
-print(f"Luminosité moyenne dépasse la limite: {result}")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
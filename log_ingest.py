@@ -0,0 +1,303 @@
+import argparse
+import concurrent.futures
+import gzip
+import math
+import mmap
+import os
+import re
+import time
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+NUMBER = rb'([^\s|\xc2]+)'
+
+# start_system.log_status and control.control_loop, one line per status. Older
+# versions of start_system wrote the air temperature before the delta, the
+# zones other than the first one write their name before RELAY.
+STATUS_LINE = (
+    rb'\| (?:Zone ([^|\n]+?) )?RELAY: (\w+) - \[Reason: ([^\]\n]*)\] '
+    rb'\| Temp\. Entr\xc3\xa9e: ' + NUMBER + rb'(?: - Moyenne: ' + NUMBER + rb')? '
+    rb'\| Temp\. Sortie: ' + NUMBER + rb'(?: - Moyenne: ' + NUMBER + rb')? '
+    rb'(?:\| Temp\. Air: ' + NUMBER + rb' )?'
+    rb'\| Delta Temp: ' + NUMBER + rb' '
+    rb'(?:\| Temp\. Air: ' + NUMBER + rb' )?'
+    rb'\| Luminosit\xc3\xa9: ' + NUMBER + rb'(?: - Moyenne: ' + NUMBER + rb')? '
+    rb'\| Last Button Pressed: ([^\n]*)'
+)
+
+# main.log_status, a multi-line block
+STATUS_BLOCK = (
+    rb'Status Update:\s+Time: (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\s+'
+    rb'Pump Running: (\w+)\s+'
+    rb'Last Action: ([^\n]*)\s+'
+    rb'Temperatures:\s+'
+    rb'E \(Pool Water\): ' + NUMBER + rb'\xc2\xb0C\s+'
+    rb'S \(Solar Collector\): ' + NUMBER + rb'\xc2\xb0C\s+'
+    rb'A \(Ambient\): ' + NUMBER + rb'\xc2\xb0C'
+)
+
+PATTERN = re.compile(rb'(?:' + STATUS_LINE + rb')|(?:' + STATUS_BLOCK + rb')')
+# A new logging record: newline then the asctime of the logging formatter
+RECORD_START = re.compile(rb'\n\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} - ')
+CHUNK_SIZE = 32 * 1024 * 1024
+
+SOURCE_LINE = 0
+SOURCE_BLOCK = 1
+FLOAT_COLUMNS = ('ts', 'temp_E', 'avg_E', 'temp_S', 'avg_S', 'delta', 'temp_A', 'light', 'avg_light')
+CODE_COLUMNS = ('relay', 'reason', 'button', 'source', 'zone')
+NAN = float('nan')
+
+
+def _number(value: Optional[bytes]) -> float:
+    if value is None:
+        return NAN
+    try:
+        # A trailing '*' marks the last known value of a failing sensor, 'n/a' an unknown one
+        return float(value.rstrip(b'*'))
+    except ValueError:
+        return NAN
+
+
+class LogColumns:
+    """Status records parsed from pool_control.log, one array per field.
+
+    Numeric fields are array('d') with NaN where a format has no such value.
+    `relay` is array('b') (1 ON, 0 OFF, -1 unknown), `reason` and `button`
+    are indexes into the `reasons` and `buttons` lists, and `source` tells
+    single-line statuses (SOURCE_LINE) from main.py blocks (SOURCE_BLOCK).
+    `zone` is an index into the `zones` list, -1 for the first zone (the
+    only one of a single pool setup).
+    """
+
+    def __init__(self):
+        for name in FLOAT_COLUMNS:
+            setattr(self, name, array('d'))
+        self.relay = array('b')
+        self.reason = array('l')
+        self.button = array('l')
+        self.source = array('b')
+        self.zone = array('l')
+        self.reasons: List[str] = []
+        self.buttons: List[str] = []
+        self.zones: List[str] = []
+        self._reason_codes: Dict[bytes, int] = {}
+        self._button_codes: Dict[bytes, int] = {}
+        self._zone_codes: Dict[bytes, int] = {}
+        self._hours: Dict[bytes, float] = {}
+        self.bytes_read = 0
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def _code(self, value: bytes, codes: Dict[bytes, int], labels: List[str]) -> int:
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(labels)
+            labels.append(value.decode('utf-8', 'replace'))
+        return code
+
+    def parse(self, data, pos: int = 0, endpos: Optional[int] = None) -> None:
+        """Append the status records found in data[pos:endpos], data being bytes or an mmap."""
+        reason_codes, button_codes, zone_codes, hours = self._reason_codes, self._button_codes, self._zone_codes, self._hours
+        endpos = len(data) if endpos is None else endpos
+        # Records are appended row by row to two flat arrays and split into columns at the end
+        floats = array('d')
+        codes = array('l')
+
+        for match in PATTERN.finditer(data, pos, endpos):
+            g = match.groups()
+            if g[1] is not None:
+                # The status timestamp directly precedes " | RELAY" or " | Zone"
+                start = match.start()
+                stamp = data[start - 20:start - 1]
+            else:
+                stamp = g[13]
+            hour = hours.get(stamp[:13])
+            try:
+                if hour is None:
+                    hour = hours[stamp[:13]] = time.mktime(time.strptime(stamp[:13].decode(), '%Y-%m-%d %H'))
+                timestamp = hour + int(stamp[14:16]) * 60 + int(stamp[17:19])
+            except ValueError:
+                continue
+
+            if g[1] is not None:
+                fields = (g[3], g[4], g[5], g[6], g[8], g[9] if g[7] is None else g[7], g[10], g[11])
+                try:
+                    values = [float(value) if value is not None else NAN for value in fields]
+                except ValueError:
+                    # "n/a", a stale "21.50*" or another unreadable value
+                    values = [_number(value) for value in fields]
+                reason = g[2]
+                button = g[12].rstrip(b'\r')
+                zone = g[0]
+                codes.extend((
+                    1 if g[1] == b'ON' else 0 if g[1] == b'OFF' else -1,
+                    reason_codes[reason] if reason in reason_codes else self._code(reason, reason_codes, self.reasons),
+                    button_codes[button] if button in button_codes else self._code(button, button_codes, self.buttons),
+                    SOURCE_LINE,
+                    -1 if zone is None else zone_codes[zone] if zone in zone_codes else self._code(zone, zone_codes, self.zones),
+                ))
+            else:
+                e, s = _number(g[16]), _number(g[17])
+                values = (e, NAN, s, NAN, s - e, _number(g[18]), NAN, NAN)
+                reason = g[15].rstrip(b'\r')
+                codes.extend((
+                    1 if g[14] == b'True' else 0 if g[14] == b'False' else -1,
+                    reason_codes[reason] if reason in reason_codes else self._code(reason, reason_codes, self.reasons),
+                    -1,
+                    SOURCE_BLOCK,
+                    -1,
+                ))
+            floats.append(timestamp)
+            floats.extend(values)
+
+        width = len(FLOAT_COLUMNS)
+        for i, name in enumerate(FLOAT_COLUMNS):
+            getattr(self, name).extend(floats[i::width])
+        for i, name in enumerate(CODE_COLUMNS):
+            column = getattr(self, name)
+            column.extend(array(column.typecode, codes[i::len(CODE_COLUMNS)]))
+        self.bytes_read += endpos - pos
+
+    def parse_file(self, file_path: str, workers: Optional[int] = None) -> None:
+        """Stream a log file through mmap, the file is never read into memory.
+
+        Gzipped segments (pool_control.log.*.gz) are decompressed in memory.
+
+        Files larger than CHUNK_SIZE are split at log record boundaries and
+        the chunks parsed by `workers` processes (default: one per CPU).
+        """
+        if file_path.endswith('.gz'):
+            # A rotated segment, at most logging.max_bytes once decompressed
+            with gzip.open(file_path, 'rb') as f:
+                data = f.read()
+            self.parse(data)
+            return
+        size = os.path.getsize(file_path)
+        if size == 0:
+            return
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or size <= CHUNK_SIZE:
+            self.merge(_parse_chunk(file_path, 0, size))
+            return
+        with _open_mmap(file_path) as data:
+            bounds = _chunk_bounds(data, max(CHUNK_SIZE, size // (workers * 4)))
+        with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+            for columns in executor.map(_parse_chunk, [file_path] * len(bounds), *zip(*bounds)):
+                self.merge(columns)
+
+    def merge(self, other: 'LogColumns') -> None:
+        """Append the records of another LogColumns, in order."""
+        for name in FLOAT_COLUMNS:
+            getattr(self, name).extend(getattr(other, name))
+        reasons = array('l', (self._code(label.encode('utf-8'), self._reason_codes, self.reasons) for label in other.reasons))
+        buttons = array('l', (self._code(label.encode('utf-8'), self._button_codes, self.buttons) for label in other.buttons))
+        self.reason.extend(reasons[code] for code in other.reason)
+        zones = array('l', (self._code(label.encode('utf-8'), self._zone_codes, self.zones) for label in other.zones))
+        self.button.extend(buttons[code] if code >= 0 else -1 for code in other.button)
+        self.zone.extend(zones[code] if code >= 0 else -1 for code in other.zone)
+        self.relay.extend(other.relay)
+        self.source.extend(other.source)
+        self.bytes_read += other.bytes_read
+
+    def zone_code(self, name: Optional[str]) -> Optional[int]:
+        """Code of a zone in the `zone` column, -1 for the first zone (None), None when absent."""
+        if name is None:
+            return -1
+        return self._zone_codes.get(name.encode('utf-8'))
+
+    def columns(self) -> Dict[str, array]:
+        columns = {name: getattr(self, name) for name in FLOAT_COLUMNS}
+        columns.update((name, getattr(self, name)) for name in CODE_COLUMNS)
+        return columns
+
+
+def _open_mmap(file_path: str) -> mmap.mmap:
+    with open(file_path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(data, 'madvise'):
+        data.madvise(mmap.MADV_SEQUENTIAL)
+    return data
+
+
+def _chunk_bounds(data: mmap.mmap, chunk_size: int) -> List[Tuple[int, int]]:
+    """Split data in ranges of about chunk_size bytes, each starting on a new log record."""
+    bounds = []
+    start = 0
+    while start < len(data):
+        record = RECORD_START.search(data, min(start + chunk_size, len(data)))
+        end = record.start() + 1 if record else len(data)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def _parse_chunk(file_path: str, start: int, end: int) -> LogColumns:
+    columns = LogColumns()
+    with _open_mmap(file_path) as data:
+        columns.parse(data, start, end)
+    return columns
+
+
+def parse_logs(file_paths: Iterable[str], workers: Optional[int] = None) -> LogColumns:
+    columns = LogColumns()
+    for file_path in file_paths:
+        columns.parse_file(file_path, workers)
+    return columns
+
+
+def import_history(columns: LogColumns, store) -> None:
+    """Copy parsed statuses into a timeseries.TimeSeriesStore.
+
+    The temperatures of the first zone only are imported, the log lines do
+    not tell which probes the other zones use. Their relay events are, with
+    the zone name before the reason like start_system records them.
+    """
+    last: Dict[int, Tuple[int, int]] = {}
+    for i in range(len(columns)):
+        zone = columns.zone[i]
+        if zone == -1:
+            values = {key: None if math.isnan(getattr(columns, key)[i]) else getattr(columns, key)[i]
+                      for key in ('temp_E', 'temp_S', 'temp_A', 'light')}
+            store.add_sample(columns.ts[i], values)
+        event = (columns.relay[i], columns.reason[i])
+        if event != last.get(zone):
+            relay = {1: "ON", 0: "OFF"}.get(columns.relay[i])
+            reason = columns.reasons[columns.reason[i]]
+            store.add_event(columns.ts[i], relay, reason if zone == -1 else f"[{columns.zones[zone]}] {reason}")
+            last[zone] = event
+        if i % 10000 == 9999:
+            store.flush()
+    store.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parse pool_control.log files into columns")
+    parser.add_argument('logs', nargs='+', help="log files to parse")
+    parser.add_argument('--workers', type=int, help="parsing processes (default: one per CPU)")
+    parser.add_argument('--history', help="also import the statuses into this history database")
+    args = parser.parse_args()
+
+    begin = time.perf_counter()
+    columns = parse_logs(args.logs, args.workers)
+    elapsed = time.perf_counter() - begin
+    megabytes = columns.bytes_read / 1e6
+    print(f"Parsed {len(columns)} statuses from {megabytes:.1f} MB in {elapsed:.2f} s ({megabytes / max(elapsed, 1e-9):.0f} MB/s)")
+    if len(columns):
+        first, last = min(columns.ts), max(columns.ts)
+        print(f"From {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first))} to {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last))}")
+        print(f"Single-line statuses: {columns.source.count(SOURCE_LINE)}, status blocks: {columns.source.count(SOURCE_BLOCK)}")
+        for code, name in enumerate(columns.zones):
+            print(f"Zone {name}: {columns.zone.count(code)} statuses")
+        print(f"Distinct reasons: {len(columns.reasons)}, relay ON in {columns.relay.count(1) * 100 / len(columns):.1f}% of statuses")
+
+    if args.history:
+        from timeseries import TimeSeriesStore
+        store = TimeSeriesStore(args.history)
+        import_history(columns, store)
+        store.close()
+        print(f"Imported into {args.history}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+import atexit
+import glob
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from typing import Any, Iterable, List, Optional
+from metrics import counter
+from pool_config import LogSettings
+
+LOG_DROPPED = counter('pipool_log_records_dropped_total', "Log records dropped because the writer fell behind")
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+# Status lines, written to the log file and echoed on stdout
+STATUS_LOGGER = 'status'
+# Echoed on stdout only, in place of print() in the loops
+CONSOLE_LOGGER = 'console'
+# Arguments formatted by the writer thread, other ones are formatted by the caller
+_IMMUTABLE = (str, bytes, int, float, bool, type(None))
+
+
+def _immutable(value: Any) -> bool:
+    if isinstance(value, _IMMUTABLE):
+        return True
+    return isinstance(value, (tuple, frozenset)) and all(_immutable(item) for item in value)
+
+
+class _NameFilter(logging.Filter):
+    """Lets through the records of the given loggers only, or all but them."""
+
+    def __init__(self, names: Iterable[str], include: bool):
+        super().__init__()
+        self.names = frozenset(names)
+        self.include = include
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return (record.name in self.names) == self.include
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue unformatted, the writer thread formats them.
+
+    A record whose arguments could change before the writer gets to it
+    (anything but numbers, strings and tuples of them) is formatted here.
+    When the queue is full the record is dropped, the caller never waits.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args and not _immutable(record.args):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # Tracebacks hold frames that keep changing, they are rendered now
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class SegmentedFileHandler(logging.Handler):
+    """Log file written through a large buffer, rotated by size and age.
+
+    Records are written to disk when `buffer_bytes` have piled up, when
+    one is older than `flush_interval` seconds, and at once from ERROR on,
+    so the SD card sees few large sequential writes. Past `max_bytes`, or
+    `rotate_interval` seconds after its first record, the file is renamed
+    to a segment stamped with the time (pool_control.log.20240720-101500)
+    which is gzipped on a background thread; the newest `backup_count`
+    segments are kept. Runs on the writer thread of the pipeline only.
+    """
+
+    def __init__(self, path: str, settings: LogSettings, level: int = logging.NOTSET):
+        super().__init__(level)
+        self.path = path
+        self.settings = settings
+        self.stream = None
+        self.size = 0
+        self.opened_at: Optional[float] = None
+        self.last_flush = 0.0
+        self.compressions: List[threading.Thread] = []
+        self._open()
+        # Segments left uncompressed by a previous run stopped during their compression
+        for segment in self._segments():
+            if not segment.endswith('.gz'):
+                self._compress_later(segment)
+
+    def _open(self) -> None:
+        self.stream = open(self.path, 'ab', buffering=self.settings.buffer_bytes)
+        self.size = self.stream.tell()
+        self.opened_at = None
+
+    def _segments(self) -> List[str]:
+        # The stamps sort in time order
+        return sorted(path for path in glob.glob(glob.escape(self.path) + '.*') if not path.endswith('.tmp'))
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            data = (self.format(record) + '\n').encode('utf-8')
+            if self.opened_at is None:
+                self.opened_at = record.created
+            elif self.size + len(data) > self.settings.max_bytes or record.created - self.opened_at >= self.settings.rotate_interval:
+                self.rotate(record.created)
+                self.opened_at = record.created
+            self.stream.write(data)
+            self.size += len(data)
+            if record.levelno >= logging.ERROR or record.created - self.last_flush >= self.settings.flush_interval:
+                self.flush()
+                self.last_flush = record.created
+        except Exception:
+            self.handleError(record)
+
+    def flush(self) -> None:
+        if self.stream is not None:
+            self.stream.flush()
+
+    def rotate(self, now: float) -> None:
+        self.stream.close()
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.localtime(now))
+        segment = f"{self.path}.{stamp}"
+        n = 1
+        while os.path.exists(segment) or os.path.exists(segment + '.gz'):
+            n += 1
+            segment = f"{self.path}.{stamp}-{n}"
+        os.rename(self.path, segment)
+        self._open()
+        if self.settings.compress:
+            self._compress_later(segment)
+        self._prune()
+
+    def _compress_later(self, segment: str) -> None:
+        self.compressions = [thread for thread in self.compressions if thread.is_alive()]
+        thread = threading.Thread(target=self._compress, args=(segment,), name='log_compress', daemon=True)
+        thread.start()
+        self.compressions.append(thread)
+
+    @staticmethod
+    def _compress(segment: str) -> None:
+        # Written aside then renamed, an interrupted compression leaves the segment as it was
+        try:
+            with open(segment, 'rb') as source, gzip.open(segment + '.gz.tmp', 'wb') as target:
+                shutil.copyfileobj(source, target, 1024 * 1024)
+            os.replace(segment + '.gz.tmp', segment + '.gz')
+            os.remove(segment)
+        except OSError as e:
+            print(f"Error compressing {segment}: {e}", file=sys.stderr)
+
+    def _prune(self) -> None:
+        segments = self._segments()
+        for segment in segments[:max(len(segments) - self.settings.backup_count, 0)]:
+            try:
+                os.remove(segment)
+            except OSError:
+                pass
+
+    def close(self) -> None:
+        self.acquire()
+        try:
+            if self.stream is not None:
+                self.stream.close()
+                self.stream = None
+        finally:
+            self.release()
+        super().close()
+
+
+class LogPipeline:
+    """One logging subsystem per process: callers enqueue, a background thread writes.
+
+    The root logger gets a single handler putting records on a bounded
+    queue; the writer thread formats them and feeds the handlers: the log
+    file (or stderr with output 'terminal'), errors.log for ERROR and
+    above, and stdout for the status lines and console messages. It also
+    writes out the buffers when no record came for `flush_interval`. The
+    levels come from the "logging" section, per logger (module) name.
+    """
+
+    def __init__(self, settings: LogSettings, directory: Optional[str], file_name: str, output: str = 'file'):
+        self.settings = settings
+        formatter = logging.Formatter(FORMAT)
+        handlers = []
+        if output == 'file' and directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            handlers.append(SegmentedFileHandler(os.path.join(directory, file_name), settings))
+            handlers.append(SegmentedFileHandler(os.path.join(directory, 'errors.log'), settings, logging.ERROR))
+        else:
+            handlers.append(logging.StreamHandler(sys.stderr))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+            handler.addFilter(_NameFilter([CONSOLE_LOGGER], include=False))
+        echo = logging.StreamHandler(sys.stdout)
+        echo.setFormatter(logging.Formatter('%(message)s'))
+        echo.addFilter(_NameFilter([STATUS_LOGGER, CONSOLE_LOGGER], include=True))
+        handlers.append(echo)
+        self.handlers = handlers
+        self.queue: 'queue.Queue' = queue.Queue(settings.queue_size)
+        self.queue_handler = DeferredQueueHandler(self.queue)
+        self.records = 0
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: Any, file_name: str, output: str = 'file') -> 'LogPipeline':
+        enabled = config['error_logging']['enabled']
+        return cls(config.logging, config['error_logging']['log_directory'] if enabled else None, file_name, output)
+
+    def start(self) -> None:
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        self.apply_levels(self.settings)
+        self._thread = threading.Thread(target=self._write, name='log_writer', daemon=True)
+        self._thread.start()
+
+    def apply_levels(self, settings: LogSettings) -> None:
+        """Set the root and per-module levels, also used when the config is reloaded."""
+        for name in self.settings.levels:
+            if name not in settings.levels:
+                logging.getLogger(name).setLevel(logging.NOTSET)
+        logging.getLogger().setLevel(settings.level.upper())
+        for name, level in settings.levels.items():
+            logging.getLogger(name).setLevel(level.upper())
+        self.settings = self.settings._replace(level=settings.level, levels=settings.levels)
+
+    def _write(self) -> None:
+        while True:
+            try:
+                record = self.queue.get(timeout=self.settings.flush_interval)
+            except queue.Empty:
+                self.flush()
+                continue
+            if record is None:
+                break
+            self.records += 1
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+        self.flush()
+
+    def flush(self) -> None:
+        for handler in self.handlers:
+            handler.flush()
+
+    def stop(self) -> None:
+        """Write the records still queued and close the files."""
+        if self._thread is None:
+            return
+        logging.getLogger().removeHandler(self.queue_handler)
+        # Waits for room, unlike the records
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+        for handler in self.handlers:
+            if isinstance(handler, SegmentedFileHandler):
+                handler.close()
+
+
+_pipeline: Optional[LogPipeline] = None
+_lock = threading.Lock()
+
+
+def setup_logging(config: Any, file_name: str, output: str = 'file') -> LogPipeline:
+    """Start the logging of the process, the first caller sets it up and later ones share it until it is stopped."""
+    global _pipeline
+    with _lock:
+        if _pipeline is None or _pipeline._thread is None:
+            _pipeline = LogPipeline.from_config(config, file_name, output)
+            _pipeline.start()
+            atexit.register(_pipeline.stop)
+        return _pipeline
@@ -1,45 +1,91 @@
 import time
-import threading
 import logging
-import RPi.GPIO as GPIO
 from lcd_display import LCDManager
 from light import LightSensor
 from temperature import TempSensor
-from typing import Dict, Any
+from sensor_hub import SensorHub, SensorSnapshot
+from sensor_guard import SensorGuard, SensorReading, read_all
+from button_input import ButtonInput
+from state_store import RuntimeStateStore
+from pool_config import LIGHT_SENSOR, load_config
+from scheduler import Scheduler
+from metrics import REGISTRY, MetricsServer, scheduler_collector, time_log_handlers
+from diagnostics import Diagnostics
+from log_pipeline import STATUS_LOGGER, setup_logging
+from status_api import StatusServer
+from policies import PumpCycleState, pump_cycle_decision
+from hardware import GPIO, clock
 
-def load_config(file_path: str) -> Dict[str, Any]:
-    import json
-    with open(file_path, 'r') as f:
-        return json.load(f)
+# Named after the module, __name__ is __main__ when it runs as a script
+logger = logging.getLogger('main')
+status_log = logging.getLogger(STATUS_LOGGER)
 
-def write_config(config: Dict[str, Any], file_path: str) -> None:
-    import json
-    with open(file_path, 'w') as file:
-        json.dump(config, file, indent=2)
+STATUS_BLOCK = """
+        Status Update:
+        Time: %s
+        Pump Running: %s
+        Last Action: %s
+        Temperatures:
+            E (Pool Water): %s°C
+            S (Solar Collector): %s°C
+            A (Ambient): %s°C
+        Average Light Sufficient: %s
+        Temperature Conditions:
+            E Below S - Threshold: %s
+            A Above E: %s
+        Time since last pump start: %.2f seconds
+        Analysis period: %s
+        Water replacement: %s
+        """
 
 class PoolControlSystem:
     def __init__(self, config_file: str):
         self.config_file = config_file
         self.config = load_config(config_file)
+        # First, so the other components log through it from their construction on
+        self.setup_logging()
+        time_log_handlers()
+        self.state = RuntimeStateStore.from_config(self.config, config_file)
+        self.windows = RuntimeStateStore.windows_from_config(self.config, config_file)
         self.lcd_manager = LCDManager(self.config)
         self.light_sensor = LightSensor(self.config)
         self.temp_sensor_E = TempSensor(self.config['sensors']['temperature']['displays']['E']['id'], self.config['temp_delta_threshold'])
         self.temp_sensor_S = TempSensor(self.config['sensors']['temperature']['displays']['S']['id'], self.config['temp_delta_threshold'])
         self.temp_sensor_A = TempSensor(self.config['sensors']['temperature']['displays']['A']['id'], self.config['temp_delta_threshold'])
+        self.sensor_names = {key: info['name'] for key, info in self.config['sensors']['temperature']['displays'].items()}
+        self.probes = {self.sensor_names[key]: sensor.sensor
+                       for key, sensor in (('E', self.temp_sensor_E), ('S', self.temp_sensor_S), ('A', self.temp_sensor_A))}
+        self.guards = {name: SensorGuard(name, self.config.read_guard) for name in [*self.probes, LIGHT_SENSOR, 'light_poll']}
+        # Sensors served their last known value by the latest read
+        self.stale = frozenset()
+        self.sensor_hub = SensorHub(self.read_sensors, stale=lambda: self.stale)
+        max_age = self.config['sensors'].get('max_age', {})
+        self.sensor_hub.subscribe('display', max_age.get('display'), callback=self.update_lcd)
+        self.control_sensors = self.sensor_hub.subscribe('control', max_age.get('control'))
+        self.status_api = StatusServer.from_config(self.config)
+        if self.status_api is not None:
+            self.sensor_hub.subscribe('status_api', callback=self.push_sensor_status)
         self.running = True
         self.pump_running = False
         self.last_action_reason = "System initialized"
         self.analysis_start_time = 0
         self.water_replace_start_time = 0
-        self.setup_logging()
+        self.scheduler = Scheduler()
+        self.pump_run_timer = None
+        self.scheduled_run_timer = None
+        self.metrics_server = MetricsServer.from_config(self.config)
+        self.diagnostics = Diagnostics.from_config(self.config)
+        if self.diagnostics is not None:
+            self.diagnostics.install_signals()
+            if self.metrics_server is not None:
+                self.diagnostics.add_routes(self.metrics_server)
         self.setup_gpio()
+        self.button_input = ButtonInput(self.config['gpio'].get('debounce_ms', 50), self.report_button_latency)
+        self.button_input.add_button('B1', self.config['gpio']['button_b1_pin'], self.button_b1_action)
+        self.button_input.add_button('B2', self.config['gpio']['button_b2_pin'], self.button_b2_action)
 
     def setup_logging(self):
-        logging.basicConfig(
-            filename='pool_control.log',
-            level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s'
-        )
+        self.log_pipeline = setup_logging(self.config, 'pool_control.log')
 
     def setup_gpio(self):
         GPIO.setmode(GPIO.BCM)
@@ -49,149 +95,241 @@ class PoolControlSystem:
         GPIO.setup(self.config['gpio']['pump_relay_pin'], GPIO.OUT)
 
     def initial_pump_run(self):
-        logging.info("Starting initial pump run.")
-        self.start_pump("Initial pump run")
-        time.sleep(self.config['water_replace_time'])
+        """Run the pump for water_replace_time, the stop is a timer so this returns at once."""
+        logger.info("Starting initial pump run.")
+        if not self.pump_running:
+            self.start_pump("Initial pump run")
+        if self.pump_run_timer is not None:
+            self.pump_run_timer.cancel()
+        self.pump_run_timer = self.scheduler.call_later('initial_pump_run', self.config['water_replace_time'], self.end_initial_pump_run)
+        self.state.set('pump_run_until', clock.time() + self.config['water_replace_time'])
+
+    def end_initial_pump_run(self):
+        self.pump_run_timer = None
+        self.state.set('pump_run_until', None)
         self.stop_pump("Initial pump run completed")
 
+    def cancel_initial_pump_run(self):
+        if self.pump_run_timer is not None:
+            self.pump_run_timer.cancel()
+            self.pump_run_timer = None
+            self.state.set('pump_run_until', None)
+            logger.info("Initial pump run interrupted")
+
+    def restore_state(self) -> bool:
+        """Resume the relay, pump run, cycle and light history persisted before a restart.
+
+        Returns False on a cold start, when there is nothing to resume.
+        """
+        state = self.state
+        if not state.restored:
+            return False
+        self.analysis_start_time = state.get('analysis_start_time', 0)
+        self.water_replace_start_time = state.get('water_replace_start_time', 0)
+        light_history = self.windows.get('light_history')
+        if light_history:
+            self.light_sensor.light_history.extend(light_history)
+            self.light_sensor.first_sample_seen = True
+        self.pump_running = state.get('relay_state') == "ON"
+        GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.HIGH if self.pump_running else GPIO.LOW)
+        self.last_action_reason = "State restored after restart"
+        self.push_pump_status()
+        logger.info(f"Restored after restart: pump {'running' if self.pump_running else 'stopped'}")
+
+        pump_run_until = state.get('pump_run_until')
+        if pump_run_until is not None:
+            remaining = pump_run_until - clock.time()
+            if remaining > 0:
+                self.pump_run_timer = self.scheduler.call_later('initial_pump_run', remaining, self.end_initial_pump_run)
+            else:
+                # Ended while the controller was down
+                self.end_initial_pump_run()
+        return True
+
     def start_pump(self, reason: str):
         self.pump_running = True
         GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.HIGH)
         self.last_action_reason = reason
-        self.config['last_pump_start_time'] = time.time()
-        logging.info(f"Pump started: {reason}")
+        self.state.update(relay_state="ON", last_pump_start_time=clock.time())
+        self.push_pump_status()
+        logger.info(f"Pump started: {reason}")
 
     def stop_pump(self, reason: str):
         self.pump_running = False
         GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
+        self.state.set('relay_state', "OFF")
         self.last_action_reason = reason
-        logging.info(f"Pump stopped: {reason}")
+        self.push_pump_status()
+        logger.info(f"Pump stopped: {reason}")
 
-    def button_handler(self):
-        while self.running:
-            if GPIO.input(self.config['gpio']['button_b1_pin']) == GPIO.LOW:
-                self.button_b1_action()
-                time.sleep(0.3)  # Debounce delay
-            elif GPIO.input(self.config['gpio']['button_b2_pin']) == GPIO.LOW:
-                self.button_b2_action()
-                time.sleep(0.3)  # Debounce delay
+    def report_button_latency(self, name: str, latency: float):
+        logger.info(f"Button {name} handled {latency * 1000:.1f} ms after the press")
 
     def button_b1_action(self):
-        logging.info("B1 pressed: Starting initial pump run")
+        logger.info("B1 pressed: Starting initial pump run")
+        self.start_pump("B1 pressed")
         self.initial_pump_run()
 
     def button_b2_action(self):
-        logging.info("B2 pressed: Stopping pump and scheduling next run")
+        logger.info("B2 pressed: Stopping pump and scheduling next run")
         self.stop_pump("B2 pressed")
+        self.cancel_initial_pump_run()
         # Schedule next run for 10 AM tomorrow
-        next_run_time = time.time() + (24 * 60 * 60)  # 24 hours from now
+        next_run_time = clock.time() + (24 * 60 * 60)  # 24 hours from now
         next_run_time -= next_run_time % (24 * 60 * 60)  # Round down to midnight
         next_run_time += 10 * 60 * 60  # Add 10 hours (10 AM)
-        self.config['next_scheduled_run'] = next_run_time
-        write_config(self.config, self.config_file)
+        self.state.set('next_scheduled_run', next_run_time)
+        self.schedule_next_run(next_run_time)
+
+    def schedule_next_run(self, next_run_time: float):
+        if self.scheduled_run_timer is not None:
+            self.scheduled_run_timer.cancel()
+        self.scheduled_run_timer = self.scheduler.call_at_time('scheduled_run', next_run_time, self.scheduled_run)
 
-    def check_scheduled_run(self):
-        if 'next_scheduled_run' in self.config:
-            if time.time() >= self.config['next_scheduled_run']:
-                logging.info("Executing scheduled pump run")
-                self.initial_pump_run()
-                del self.config['next_scheduled_run']
-                write_config(self.config, self.config_file)
+    def scheduled_run(self):
+        logger.info("Executing scheduled pump run")
+        self.scheduled_run_timer = None
+        self.state.set('next_scheduled_run', None)
+        self.initial_pump_run()
+
+    def read_sensors(self):
+        # All at once through the guards, a failing probe does not hold the others
+        reads = {name: sensor.get_temperature for name, sensor in self.probes.items()}
+        reads[LIGHT_SENSOR] = self.light_sensor.read
+        readings = read_all(self.guards, reads)
+        self.stale = frozenset(name for name, reading in readings.items() if reading.stale)
+        light = readings.pop(LIGHT_SENSOR).value
+        return {name: reading.value for name, reading in readings.items()}, light
+
+    def poll_light(self):
+        # On the scheduler thread, which a hung bus must not hold
+        self.guards['light_poll'].read(self.light_sensor.poll)
 
     def check_pump_conditions(self):
-        temp_E = self.temp_sensor_E.get_temperature()
-        temp_S = self.temp_sensor_S.get_temperature()
-        temp_A = self.temp_sensor_A.get_temperature()
-        
+        snapshot = self.control_sensors.get()
+        if snapshot is None:
+            logger.warning("No recent sensor data, skipping pump conditions check")
+            return
+        if snapshot.light is not None and LIGHT_SENSOR not in snapshot.stale:
+            self.light_sensor.update_light_history(snapshot.light)
+        if self.pump_run_timer is not None:
+            # The pump run decides until it ends
+            return
+        temp_E = snapshot.temperatures[self.sensor_names['E']]
+        temp_S = snapshot.temperatures[self.sensor_names['S']]
+        temp_A = snapshot.temperatures[self.sensor_names['A']]
+
         is_temp_below_threshold, is_ambient_above_temp_E = self.temp_sensor_E.is_temp_above_threshold(temp_E, temp_S, temp_A)
         
         is_light_sufficient = self.light_sensor.is_average_light_sufficient()
 
-        self.log_status(temp_E, temp_S, temp_A, is_light_sufficient, is_temp_below_threshold, is_ambient_above_temp_E)
-
-        current_time = time.time()
-
-        if is_ambient_above_temp_E:
-            if self.analysis_start_time == 0:
-                self.stop_pump("Starting analysis period")
-                self.analysis_start_time = current_time
-            elif current_time - self.analysis_start_time >= self.config['analysis_interval']:
-                if self.water_replace_start_time == 0:
-                    self.start_pump("Analysis period completed, starting water replacement")
-                    self.water_replace_start_time = current_time
-                elif current_time - self.water_replace_start_time >= self.config['water_replace_time']:
-                    self.stop_pump("Water replace time completed")
-                    self.water_replace_start_time = 0
-                    self.analysis_start_time = 0
-        else:
-            if self.pump_running:
-                self.stop_pump("Ambient temperature not above pool temperature")
-            self.water_replace_start_time = 0
-            self.analysis_start_time = 0
-
-        if is_light_sufficient and not self.pump_running and self.analysis_start_time == 0:
-            self.start_pump("Light conditions met")
-
-        if not self.pump_running and current_time - self.config['last_pump_start_time'] >= self.config['analysis_interval']:
+        self.log_status(temp_E, temp_S, temp_A, is_light_sufficient, is_temp_below_threshold, is_ambient_above_temp_E,
+                        snapshot.stale)
+        if is_ambient_above_temp_E is None:
+            # A probe without a known value, the cycle goes on when it answers again
+            logger.warning("Temperature missing, keeping pump state")
+            return
+
+        cycle = PumpCycleState(self.pump_running, self.analysis_start_time, self.water_replace_start_time,
+                               self.state.get('last_pump_start_time'))
+        cycle, decisions, start_pump_run = pump_cycle_decision(
+            cycle, is_ambient_above_temp_E, is_light_sufficient, clock.time(),
+            self.config['analysis_interval'], self.config['water_replace_time'])
+        for decision in decisions:
+            if decision.relay == "ON":
+                self.start_pump(decision.reason)
+            else:
+                self.stop_pump(decision.reason)
+        self.analysis_start_time = cycle.analysis_start_time
+        self.water_replace_start_time = cycle.water_replace_start_time
+        self.state.update(analysis_start_time=self.analysis_start_time,
+                          water_replace_start_time=self.water_replace_start_time)
+
+        if start_pump_run:
             self.initial_pump_run()
 
-    def log_status(self, temp_E, temp_S, temp_A, is_light_sufficient, is_temp_below_threshold, is_ambient_above_temp_E):
-        current_time = time.time()
-        status = f"""
-        Status Update:
-        Time: {time.strftime('%Y-%m-%d %H:%M:%S')}
-        Pump Running: {self.pump_running}
-        Last Action: {self.last_action_reason}
-        Temperatures:
-            E (Pool Water): {temp_E:.2f}°C
-            S (Solar Collector): {temp_S:.2f}°C
-            A (Ambient): {temp_A:.2f}°C
-        Average Light Sufficient: {is_light_sufficient}
-        Temperature Conditions:
-            E Below S - Threshold: {is_temp_below_threshold}
-            A Above E: {is_ambient_above_temp_E}
-        Time since last pump start: {current_time - self.config['last_pump_start_time']:.2f} seconds
-        Analysis period: {"In progress" if self.analysis_start_time > 0 else "Not active"}
-        Water replacement: {"In progress" if self.water_replace_start_time > 0 else "Not active"}
-        """
-        logging.info(status)
-        print(status)  # Also print to console for real-time monitoring
+    def save_light_history(self):
+        self.windows.set('light_history', self.light_sensor.light_history.values())
+
+    def log_status(self, temp_E, temp_S, temp_A, is_light_sufficient, is_temp_below_threshold, is_ambient_above_temp_E,
+                   stale=frozenset()):
+        names = self.sensor_names
+        # Formatted by the log writer, which also prints it to the console for real-time monitoring
+        status_log.info(STATUS_BLOCK, time.strftime('%Y-%m-%d %H:%M:%S', clock.localtime()), self.pump_running,
+                        self.last_action_reason, SensorReading(temp_E, names['E'] in stale),
+                        SensorReading(temp_S, names['S'] in stale), SensorReading(temp_A, names['A'] in stale),
+                        is_light_sufficient, is_temp_below_threshold, is_ambient_above_temp_E,
+                        clock.time() - self.state.get('last_pump_start_time'),
+                        "In progress" if self.analysis_start_time > 0 else "Not active",
+                        "In progress" if self.water_replace_start_time > 0 else "Not active")
+
 
+    def push_sensor_status(self, snapshot: SensorSnapshot):
+        light = round(snapshot.light) if snapshot.light is not None else None
+        self.status_api.update(snapshot.timestamp, temperatures=dict(snapshot.temperatures), light=light,
+                               stale=sorted(snapshot.stale))
 
-    def update_lcd(self):
-        while self.running:
-            temps = {
-                'pool_water': self.temp_sensor_E.get_temperature(),
-                'solar_collector_output': self.temp_sensor_S.get_temperature(),
-                'ambient': self.temp_sensor_A.get_temperature()
-            }
-            self.lcd_manager.update_displays(temps)
-            time.sleep(self.config['sensors']['temperature']['update_interval'])
+    def push_pump_status(self):
+        if self.status_api is not None:
+            self.status_api.update(clock.time(), zones={'pool': {
+                'relay_state': "ON" if self.pump_running else "OFF",
+                'last_action_reason': self.last_action_reason,
+            }})
+
+    def update_lcd(self, snapshot: SensorSnapshot):
+        self.lcd_manager.update_displays(snapshot.temperatures)
+
+    def first_acquisition(self):
+        self.sensor_hub.acquire()
+        self.check_pump_conditions()
 
     def run(self):
-        self.initial_pump_run()
-        
-        threads = [
-            threading.Thread(target=self.button_handler),
-            threading.Thread(target=self.update_lcd)
-        ]
-        
-        for thread in threads:
-            thread.start()
+        if not self.restore_state():
+            self.initial_pump_run()
+        next_scheduled_run = self.state.get('next_scheduled_run')
+        if next_scheduled_run is not None:
+            self.schedule_next_run(next_scheduled_run)
+
+        # The first readings are acquired and acted on by a worker, run() does not wait for the sensors
+        update_interval = self.config['sensors']['temperature']['update_interval']
+        self.scheduler.call_later('first_acquisition', 0, self.first_acquisition, blocking=True)
+        self.scheduler.every('sensors', update_interval, self.sensor_hub.acquire, delay=update_interval, blocking=True)
+        self.scheduler.every('light', self.light_sensor.sensor.measurement_time(), self.poll_light)
+        self.scheduler.every('pump_conditions', self.config['log_interval'], self.check_pump_conditions,
+                             delay=self.config['log_interval'])
+        # The light history changes on every check, the state file gets it now and then
+        save_interval = self.windows.min_fsync_interval
+        self.scheduler.every('save_light_history', save_interval, self.save_light_history, delay=save_interval)
+        REGISTRY.add_collector('scheduler', scheduler_collector(self.scheduler))
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.status_api is not None:
+            self.status_api.start()
+        self.state.start()
+        self.windows.start()
+        self.button_input.start()
 
         try:
-            while self.running:
-                self.check_scheduled_run()
-                self.check_pump_conditions()
-                time.sleep(self.config['log_interval'])
+            self.scheduler.run()
         except KeyboardInterrupt:
             self.running = False
-            logging.info("System shutdown initiated by user")
+            logger.info("System shutdown initiated by user")
         finally:
-            for thread in threads:
-                thread.join()
+            self.scheduler.stop()
+            self.button_input.stop()
+            self.save_light_history()
+            self.state.close()
+            self.windows.close()
+            if self.metrics_server is not None:
+                self.metrics_server.stop()
+            if self.status_api is not None:
+                self.status_api.stop()
             GPIO.cleanup()
-            logging.info("System shutdown complete")
+            logger.info("System shutdown complete")
+
+    def stop(self):
+        self.running = False
+        self.scheduler.stop()
 
 if __name__ == "__main__":
     pool_control = PoolControlSystem('config.json')
@@ -0,0 +1,329 @@
+import bisect
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from hardware import clock
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from a fast I2C read to a slow 1-wire conversion
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    __slots__ = ('value', '_lock')
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram: '_HistogramValue'):
+        self.histogram = histogram
+
+    def __enter__(self) -> '_Timer':
+        self.start = clock.monotonic()
+        return self
+
+    def __exit__(self, *exc_info) -> bool:
+        self.histogram.observe(clock.monotonic() - self.start)
+        return False
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', '_lock')
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # Per bucket, not cumulative, the last one is +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self) -> _Timer:
+        """Context manager observing the time spent in its block."""
+        return _Timer(self)
+
+
+class Metric:
+    """A metric family, one value per combination of label values."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _new_value(self) -> Any:
+        return _Value()
+
+    def labels(self, *values: Any) -> Any:
+        key = tuple(str(value) for value in values)
+        value = self._values.get(key)
+        if value is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            with self._lock:
+                value = self._values.setdefault(key, self._new_value())
+        return value
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value.value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self) -> _HistogramValue:
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in sorted(self._values.items()):
+            with value._lock:
+                counts, total, count = list(value.counts), value.sum, value.count
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(float(bound))}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    """Metrics of the process, rendered in the Prometheus text format.
+
+    Instrumented code updates metrics as it runs, which costs a lock and a
+    few additions. Collectors are called only when the metrics are scraped
+    and turn counters the code keeps anyway (scheduler jobs, display
+    writes...) into metrics.
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._collectors: Dict[str, Callable[[], Iterable[Metric]]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """Add a metric, or return the one already registered under its name."""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def add_collector(self, name: str, collect: Callable[[], Iterable[Metric]]) -> None:
+        """Call `collect` at each scrape, replacing any collector of the same name."""
+        with self._lock:
+            self._collectors[name] = collect
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.items())
+        for name, collect in collectors:
+            try:
+                metrics.extend(collect())
+            except Exception as e:
+                logger.error(f"Error in metrics collector {name}: {e}")
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# Shared by the modules doing I/O
+STAGE_TIME = histogram('pipool_stage_seconds', "Time spent in each stage of the control loops", ('stage',))
+SENSOR_READ_TIME = histogram('pipool_sensor_read_seconds', "Time to read each sensor", ('sensor',))
+SENSOR_READ_ERRORS = counter('pipool_sensor_read_errors_total', "Failed reads of each sensor", ('sensor',))
+
+
+def time_log_handlers(logger: Optional[logging.Logger] = None) -> None:
+    """Observe the time spent in each handler of a logger (the root logger by default)."""
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        if getattr(handler, '_timed', False):
+            continue
+        timer = STAGE_TIME.labels(f"logging_{type(handler).__name__}")
+        handle = handler.handle
+
+        def timed_handle(record: logging.LogRecord, handle=handle, timer=timer) -> bool:
+            with timer.time():
+                return handle(record)
+
+        handler.handle = timed_handle
+        handler._timed = True
+
+
+def scheduler_collector(scheduler) -> Callable[[], List[Metric]]:
+    """Runs and overruns of the jobs of a scheduler.Scheduler."""
+    def collect() -> List[Metric]:
+        runs = Counter('pipool_job_runs_total', "Runs of each scheduled job", ('job',))
+        overruns = Counter('pipool_job_overruns_total', "Runs skipped because the job was late or still running", ('job',))
+        lateness = Gauge('pipool_job_max_lateness_seconds', "Largest delay between the due time and the start of each job", ('job',))
+        for job in list(scheduler.jobs.values()):
+            runs.labels(job.name).inc(job.runs)
+            overruns.labels(job.name).inc(job.skipped)
+            lateness.labels(job.name).set(job.max_lateness)
+        return [runs, overruns, lateness]
+    return collect
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry: Registry = REGISTRY
+    routes: Dict[str, Callable[[Dict[str, List[str]]], str]] = {}
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlsplit(self.path)
+        if url.path in ('/', '/metrics'):
+            content_type, text = CONTENT_TYPE, self.registry.render()
+        elif url.path in self.routes:
+            try:
+                text = self.routes[url.path](urllib.parse.parse_qs(url.query))
+            except Exception as e:
+                logger.error(f"Error serving {url.path}: {e}")
+                self.send_error(500)
+                return
+            content_type = 'text/plain; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+
+class MetricsServer:
+    """HTTP endpoint serving the registry at /metrics, on localhost by default.
+
+    Nothing is computed between scrapes.
+    """
+
+    def __init__(self, registry: Registry = REGISTRY, host: str = '127.0.0.1', port: int = 9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        # Other plain text pages, path -> function of the query parameters
+        self.routes: Dict[str, Callable[[Dict[str, List[str]]], str]] = {}
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['MetricsServer']:
+        """The server configured in config.json, None when disabled."""
+        settings = config.get('metrics', {})
+        if not settings.get('enabled', False):
+            return None
+        return cls(REGISTRY, settings.get('host', '127.0.0.1'), settings.get('port', 9108))
+
+    def add_route(self, path: str, func: Callable[[Dict[str, List[str]]], str]) -> None:
+        self.routes[path] = func
+
+    def start(self) -> None:
+        handler = type('MetricsHandler', (_Handler,), {'registry': self.registry, 'routes': self.routes})
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        except OSError as e:
+            logger.error(f"Cannot serve metrics on {self.host}:{self.port}: {e}")
+            return
+        self._server.daemon_threads = True
+        # Port 0 picks a free port
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True)
+        self._thread.start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
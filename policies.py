@@ -0,0 +1,86 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+
+class Decision(NamedTuple):
+    """Relay state to apply ("ON" or "OFF") and the reason logged with it."""
+    relay: str
+    reason: str
+
+
+class PumpCycleState(NamedTuple):
+    """What main.py remembers between two pump condition checks."""
+    pump_running: bool = False
+    analysis_start_time: float = 0
+    water_replace_start_time: float = 0
+    last_pump_start_time: float = 0
+
+
+def delta_decision(temp_E: float, temp_S: float, temp_delta_threshold: float) -> Decision:
+    """control.py: pump on while the collector output is warmer than the pool by the threshold."""
+    delta_temp = temp_S - temp_E
+    if delta_temp < temp_delta_threshold:
+        return Decision("OFF", f"delta temperature ({delta_temp:.2f}) lower than threshold")
+    return Decision("ON", f"delta temperature ({delta_temp:.2f}) above threshold")
+
+
+def light_and_delta_decision(temp_E: float, temp_S: float, light: float, relay_state: Optional[str],
+                             last_button_pressed: Optional[str], temp_delta_threshold: float,
+                             light_threshold: float) -> Optional[Decision]:
+    """start_system.py: pump on in sunlight when the delta is above the threshold, B2 forces it off.
+
+    None when the relay is already in the decided state.
+    """
+    delta_temp = temp_S - temp_E
+    if last_button_pressed == "B2":
+        decision = Decision("OFF", "Pump stopped by B2 (overrides all other conditions)")
+    elif light >= light_threshold:
+        if delta_temp >= temp_delta_threshold:
+            decision = Decision("ON", f"Pump started: Light level ({light:.2f}) above threshold and delta temperature ({delta_temp:.2f}) above threshold")
+        else:
+            decision = Decision("OFF", f"Pump stopped: Light level ({light:.2f}) above threshold but delta temperature ({delta_temp:.2f}) below threshold")
+    else:
+        decision = Decision("OFF", f"Pump stopped: Light level ({light:.2f}) below threshold")
+    return None if decision.relay == relay_state else decision
+
+
+def pump_cycle_decision(state: PumpCycleState, is_ambient_above_temp_E: bool, is_light_sufficient: bool,
+                        now: float, analysis_interval: float,
+                        water_replace_time: float) -> Tuple[PumpCycleState, List[Decision], bool]:
+    """main.py: analysis period and water replacement while the air is warmer than the pool.
+
+    Returns the new state, the relay changes in the order they are made and
+    whether a pump run of water_replace_time should start, which happens when
+    the pump has not been started for analysis_interval.
+    """
+    pump_running, analysis_start_time, water_replace_start_time, last_pump_start_time = state
+    decisions = []
+    if is_ambient_above_temp_E:
+        if analysis_start_time == 0:
+            decisions.append(Decision("OFF", "Starting analysis period"))
+            pump_running = False
+            analysis_start_time = now
+        elif now - analysis_start_time >= analysis_interval:
+            if water_replace_start_time == 0:
+                decisions.append(Decision("ON", "Analysis period completed, starting water replacement"))
+                pump_running = True
+                last_pump_start_time = now
+                water_replace_start_time = now
+            elif now - water_replace_start_time >= water_replace_time:
+                decisions.append(Decision("OFF", "Water replace time completed"))
+                pump_running = False
+                water_replace_start_time = 0
+                analysis_start_time = 0
+    else:
+        if pump_running:
+            decisions.append(Decision("OFF", "Ambient temperature not above pool temperature"))
+            pump_running = False
+        water_replace_start_time = 0
+        analysis_start_time = 0
+
+    if is_light_sufficient and not pump_running and analysis_start_time == 0:
+        decisions.append(Decision("ON", "Light conditions met"))
+        pump_running = True
+        last_pump_start_time = now
+
+    start_pump_run = not pump_running and now - last_pump_start_time >= analysis_interval
+    return PumpCycleState(pump_running, analysis_start_time, water_replace_start_time, last_pump_start_time), decisions, start_pump_run
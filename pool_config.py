@@ -0,0 +1,420 @@
+import json
+import logging
+import os
+import threading
+from collections.abc import Mapping
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+from hardware import clock
+
+logger = logging.getLogger(__name__)
+
+# Displays showing the time rather than a probe: the 'H' key, or any key named 'time'
+TIME_DISPLAY = 'H'
+TIME_NAME = 'time'
+ACQUISITION_MODES = ('auto', 'bulk', 'parallel', 'sequential')
+# Decision used by each zone, see policies.py
+ZONE_POLICIES = ('light_and_delta', 'delta')
+# Probes of a zone: pool water (E), collector output (S), air (A, optional)
+ZONE_ROLES = ('E', 'S', 'A')
+# Name of the light sensor in the sampling section, the read guards and the stale sensors
+LIGHT_SENSOR = 'light'
+# Sampling policy keys -> (temperature default, light default), in °C and lux
+SAMPLING_DEFAULTS = {
+    'max_interval': (300.0, 300.0),
+    'backoff': (1.5, 1.5),
+    'stable_change': (0.125, 1000.0),
+    'margin': (1.0, 5000.0),
+}
+
+
+class ConfigError(Exception):
+    pass
+
+
+def _freeze(value: Any) -> Any:
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
+def _require(mapping: Dict[str, Any], path: str, kind: Any = (int, float), minimum: Optional[float] = None) -> Any:
+    node = mapping
+    for part in path.split('.'):
+        if not isinstance(node, dict) or part not in node:
+            raise ConfigError(f"Missing configuration key '{path}'")
+        node = node[part]
+    if isinstance(node, bool) and kind is not bool or not isinstance(node, kind):
+        raise ConfigError(f"Invalid type for '{path}': {node!r}")
+    if minimum is not None and node < minimum:
+        raise ConfigError(f"'{path}' must be at least {minimum}, got {node}")
+    return node
+
+
+class Zone(NamedTuple):
+    """A pool or collector loop: its probes, relay, buttons and control parameters."""
+    name: str
+    # Role (E, S, A) -> sensor name, A may be missing
+    probes: Mapping
+    relay_pin: int
+    policy: str
+    temp_delta_threshold: float
+    light_threshold: float
+    water_replace_time: float
+    button_b1_pin: Optional[int] = None
+    button_b2_pin: Optional[int] = None
+
+
+class SamplingPolicy(NamedTuple):
+    """How often a sensor is read, see sampling.AdaptiveRate."""
+    min_interval: float
+    max_interval: float
+    backoff: float
+    # Change between two readings above which the sensor is read at min_interval again
+    stable_change: float
+    # Distance to a decision threshold within which the sensor is read at min_interval
+    margin: float
+
+
+class GuardPolicy(NamedTuple):
+    """Deadline, retries and circuit breaker of the sensor reads, see sensor_guard.SensorGuard."""
+    timeout: float = 2.0
+    retries: int = 2
+    backoff: float = 0.05
+    failures: int = 3
+    cool_down: float = 60.0
+    # Seconds the last known value of a failing sensor is served for
+    max_stale: float = 600.0
+
+
+class LogSettings(NamedTuple):
+    """The "logging" section, see log_pipeline.LogPipeline."""
+    level: str = 'INFO'
+    # Logger name (the module) -> level, for the modules more or less verbose than `level`
+    levels: Mapping = MappingProxyType({})
+    # A log file is rotated past max_bytes or rotate_interval seconds, whichever comes first
+    max_bytes: int = 5 * 1024 * 1024
+    rotate_interval: float = 86400.0
+    # Rotated segments kept, gzipped in the background when compress is set
+    backup_count: int = 30
+    compress: bool = True
+    # Bytes written to the SD card at once, and seconds a record waits at most for the write
+    buffer_bytes: int = 64 * 1024
+    flush_interval: float = 5.0
+    # Records waiting for the writer, beyond which new ones are dropped
+    queue_size: int = 10000
+
+
+def _level(value: Any) -> bool:
+    return isinstance(value, str) and isinstance(logging.getLevelName(value.upper()), int)
+
+
+class PoolConfig(Mapping):
+    """Validated, read-only config.json.
+
+    Behaves like the parsed JSON (nested read-only mappings) for existing
+    code, and exposes the values used on every tick as typed attributes,
+    including the display to sensor mapping, so hot paths do not walk the
+    nested dicts.
+
+    Without a "zones" section the whole file describes one zone, named
+    "pool", using the E, S and A probes, the pump relay and both buttons.
+    Each entry of "zones" instead names its probes by role and has its own
+    relay, optional buttons, policy and thresholds (the global ones by
+    default). The first zone defaults to the pins of the "gpio" section.
+    """
+
+    def __init__(self, raw: Dict[str, Any]):
+        if not isinstance(raw, dict):
+            raise ConfigError("Configuration must be a JSON object")
+        self.light_threshold: float = _require(raw, 'light_threshold', minimum=0)
+        self.temp_delta_threshold: float = _require(raw, 'temp_delta_threshold')
+        self.water_replace_time: float = _require(raw, 'water_replace_time', minimum=0)
+        self.analysis_interval: float = _require(raw, 'analysis_interval', minimum=0)
+        self.average_samples: int = _require(raw, 'average_samples', int, minimum=1)
+        self.log_interval: float = _require(raw, 'log_interval', minimum=0.1)
+        self.update_interval: float = _require(raw, 'sensors.temperature.update_interval', minimum=0.1)
+
+        self.button_b1_pin: int = _require(raw, 'gpio.button_b1_pin', int, minimum=0)
+        self.button_b2_pin: int = _require(raw, 'gpio.button_b2_pin', int, minimum=0)
+        self.pump_relay_pin: int = _require(raw, 'gpio.pump_relay_pin', int, minimum=0)
+        self.debounce_ms: float = raw['gpio'].get('debounce_ms', 50)
+        if 'debounce_ms' in raw['gpio']:
+            _require(raw, 'gpio.debounce_ms', minimum=0)
+        pins = [self.button_b1_pin, self.button_b2_pin, self.pump_relay_pin]
+
+        _require(raw, 'error_logging.enabled', bool)
+        _require(raw, 'error_logging.log_directory', str)
+
+        acquisition = raw['sensors']['temperature'].get('acquisition', 'auto')
+        if acquisition not in ACQUISITION_MODES:
+            raise ConfigError(f"Invalid temperature acquisition mode '{acquisition}', expected one of {ACQUISITION_MODES}")
+
+        displays = _require(raw, 'sensors.temperature.displays', dict)
+        display_sensors: List[Tuple[str, str]] = []
+        time_displays: List[str] = []
+        sensor_ids: Dict[str, str] = {}
+        for key, info in displays.items():
+            prefix = f'sensors.temperature.displays.{key}'
+            pins.append(_require(raw, f'{prefix}.clk_pin', int, minimum=0))
+            pins.append(_require(raw, f'{prefix}.dio_pin', int, minimum=0))
+            name = _require(raw, f'{prefix}.name', str)
+            if key == TIME_DISPLAY or name == TIME_NAME:
+                time_displays.append(key)
+                continue
+            if name in sensor_ids:
+                raise ConfigError(f"Duplicate temperature sensor name '{name}'")
+            sensor_ids[name] = _require(raw, f'{prefix}.id', str)
+            display_sensors.append((key, name))
+        zones = self._parse_zones(raw, displays, sensor_ids, pins)
+        duplicates = sorted({pin for pin in pins if pins.count(pin) > 1})
+        if duplicates:
+            raise ConfigError(f"GPIO pins used more than once: {duplicates}")
+
+        for path in ('sensors.light.device_address', 'sensors.light.mode'):
+            value = _require(raw, path, str)
+            try:
+                int(value, 16)
+            except ValueError:
+                raise ConfigError(f"'{path}' must be a hexadecimal string, got {value!r}")
+        _require(raw, 'sensors.light.bus_number', int, minimum=0)
+        if 'auto_range' in raw['sensors']['light']:
+            _require(raw, 'sensors.light.auto_range', bool)
+
+        if raw.get('thingsboard', {}).get('enabled', False):
+            _require(raw, 'thingsboard.host', str)
+            _require(raw, 'thingsboard.access_token', str)
+            _require(raw, 'thingsboard.port', int, minimum=1)
+
+        if raw.get('metrics', {}).get('enabled', False):
+            _require(raw, 'metrics.port', int, minimum=0)
+            if 'host' in raw['metrics']:
+                _require(raw, 'metrics.host', str)
+
+        if raw.get('status_api', {}).get('enabled', False):
+            _require(raw, 'status_api.port', int, minimum=0)
+            if 'host' in raw['status_api']:
+                _require(raw, 'status_api.host', str)
+            if 'max_clients' in raw['status_api']:
+                _require(raw, 'status_api.max_clients', int, minimum=1)
+
+        if raw.get('diagnostics', {}).get('enabled', False):
+            for key in ('profile_seconds', 'sample_interval'):
+                if key in raw['diagnostics']:
+                    _require(raw, f'diagnostics.{key}', minimum=0.001)
+
+        self.logging: LogSettings = self._parse_logging(raw)
+        self.sampling: Optional[Dict[str, SamplingPolicy]] = self._parse_sampling(raw, sensor_ids)
+        guard = raw['sensors'].get('read_guard', {})
+        for key in guard:
+            if key not in GuardPolicy._fields:
+                raise ConfigError(f"Unknown key 'sensors.read_guard.{key}', expected one of {GuardPolicy._fields}")
+            _require(raw, f'sensors.read_guard.{key}', int if key in ('retries', 'failures') else (int, float),
+                     minimum={'failures': 1, 'timeout': 0.001}.get(key, 0))
+        self.read_guard: GuardPolicy = GuardPolicy(**guard)
+
+        max_age = raw['sensors'].get('max_age', {})
+        for consumer, age in max_age.items():
+            _require(max_age, consumer, minimum=0)
+
+        # Display key -> sensor name, for the temperature displays only
+        self.display_sensors: Tuple[Tuple[str, str], ...] = tuple(display_sensors)
+        # Sensor name -> w1 id
+        self.sensor_ids: Dict[str, str] = MappingProxyType(sensor_ids)
+        # Sensor name -> key used by the control logic (temp_E, temp_S...)
+        self.sensor_keys: Dict[str, str] = MappingProxyType({name: f"temp_{key}" for key, name in display_sensors})
+        self.time_displays: Tuple[str, ...] = tuple(time_displays)
+        self.has_time_display: bool = bool(time_displays)
+        self.zones: Tuple[Zone, ...] = tuple(zones)
+        self.zones_by_name: Dict[str, Zone] = MappingProxyType({zone.name: zone for zone in zones})
+        self.max_age: Dict[str, float] = MappingProxyType(dict(max_age))
+        self._raw = _freeze(raw)
+
+    @staticmethod
+    def _parse_logging(raw: Dict[str, Any]) -> LogSettings:
+        settings = dict(raw.get('logging', {}))
+        for key in settings:
+            if key not in LogSettings._fields:
+                raise ConfigError(f"Unknown key 'logging.{key}', expected one of {LogSettings._fields}")
+        if 'level' in settings and not _level(settings['level']):
+            raise ConfigError(f"Invalid log level for 'logging.level': {settings['level']!r}")
+        levels = settings.get('levels', {})
+        if not isinstance(levels, dict):
+            raise ConfigError(f"Invalid type for 'logging.levels': {levels!r}")
+        for name, level in levels.items():
+            if not _level(level):
+                raise ConfigError(f"Invalid log level for 'logging.levels.{name}': {level!r}")
+        settings['levels'] = MappingProxyType(dict(levels))
+        for key in ('max_bytes', 'backup_count', 'buffer_bytes', 'queue_size'):
+            if key in settings:
+                _require(raw, f'logging.{key}', int, minimum=0 if key == 'backup_count' else 1)
+        for key in ('rotate_interval', 'flush_interval'):
+            if key in settings:
+                _require(raw, f'logging.{key}', minimum=0.001)
+        if 'compress' in settings:
+            _require(raw, 'logging.compress', bool)
+        return LogSettings(**settings)
+
+    def _parse_sampling(self, raw: Dict[str, Any], sensor_ids: Dict[str, str]) -> Optional[Dict[str, SamplingPolicy]]:
+        """Sensor name (and 'light') -> sampling policy, None when every sensor is read on each update."""
+        settings = raw['sensors'].get('sampling', {})
+        if not settings.get('enabled', False):
+            return None
+
+        def policy(prefix: str, base: Dict[str, float]) -> SamplingPolicy:
+            values = dict(base)
+            for key in values:
+                if key in _require(raw, prefix, dict):
+                    values[key] = _require(raw, f'{prefix}.{key}', minimum=1 if key == 'backoff' else 0)
+            if values['min_interval'] < self.update_interval:
+                raise ConfigError(f"'{prefix}.min_interval' must be at least sensors.temperature.update_interval")
+            if values['max_interval'] < values['min_interval']:
+                raise ConfigError(f"'{prefix}.max_interval' must be at least its min_interval")
+            return SamplingPolicy(**values)
+
+        temperature = {'min_interval': self.update_interval, **{key: value[0] for key, value in SAMPLING_DEFAULTS.items()}}
+        light = {'min_interval': self.update_interval, **{key: value[1] for key, value in SAMPLING_DEFAULTS.items()}}
+        if 'temperature' in settings:
+            temperature = policy('sensors.sampling.temperature', temperature)._asdict()
+        if 'light' in settings:
+            light = policy('sensors.sampling.light', light)._asdict()
+        policies = {name: SamplingPolicy(**temperature) for name in sensor_ids}
+        policies[LIGHT_SENSOR] = SamplingPolicy(**light)
+        for name in _require(raw, 'sensors.sampling.sensors', dict) if 'sensors' in settings else ():
+            if name not in policies:
+                raise ConfigError(f"'sensors.sampling.sensors.{name}' is not a sensor name")
+            policies[name] = policy(f'sensors.sampling.sensors.{name}', policies[name]._asdict())
+        return MappingProxyType(policies)
+
+    def _parse_zones(self, raw: Dict[str, Any], displays: Dict[str, Any], sensor_ids: Dict[str, str],
+                     pins: List[int]) -> List[Zone]:
+        defaults = (self.temp_delta_threshold, self.light_threshold, self.water_replace_time)
+        if 'zones' not in raw:
+            probes = {role: displays[role]['name'] for role in ZONE_ROLES if role in displays}
+            for role in ('E', 'S'):
+                if role not in probes:
+                    raise ConfigError(f"Missing configuration key 'sensors.temperature.displays.{role}'")
+            return [Zone('pool', MappingProxyType(probes), self.pump_relay_pin, ZONE_POLICIES[0], *defaults,
+                         self.button_b1_pin, self.button_b2_pin)]
+
+        zones = _require(raw, 'zones', dict)
+        if not zones:
+            raise ConfigError("'zones' must define at least one zone")
+        parsed = []
+        for index, (name, settings) in enumerate(zones.items()):
+            prefix = f'zones.{name}'
+            _require(raw, prefix, dict)
+            probes = dict(_require(raw, f'{prefix}.sensors', dict))
+            for role, sensor_name in probes.items():
+                if role not in ZONE_ROLES:
+                    raise ConfigError(f"Unknown probe role '{role}' in '{prefix}.sensors', expected one of {ZONE_ROLES}")
+                if sensor_name not in sensor_ids:
+                    raise ConfigError(f"'{prefix}.sensors.{role}' is not a temperature sensor: {sensor_name!r}")
+            for role in ('E', 'S'):
+                if role not in probes:
+                    raise ConfigError(f"Missing configuration key '{prefix}.sensors.{role}'")
+            policy = settings.get('policy', ZONE_POLICIES[0])
+            if policy not in ZONE_POLICIES:
+                raise ConfigError(f"Invalid policy '{policy}' for zone '{name}', expected one of {ZONE_POLICIES}")
+            # The first zone may keep the pins of the gpio section, which are already counted
+            pin_defaults = (self.pump_relay_pin, self.button_b1_pin, self.button_b2_pin) if index == 0 else (None, None, None)
+            zone_pins = []
+            for key, default in zip(('relay_pin', 'button_b1_pin', 'button_b2_pin'), pin_defaults):
+                if key in settings:
+                    zone_pins.append(_require(raw, f'{prefix}.{key}', int, minimum=0))
+                    if zone_pins[-1] != default:
+                        pins.append(zone_pins[-1])
+                elif key == 'relay_pin' and default is None:
+                    raise ConfigError(f"Missing configuration key '{prefix}.relay_pin'")
+                else:
+                    zone_pins.append(default)
+            values = []
+            for key, default in zip(('temp_delta_threshold', 'light_threshold', 'water_replace_time'), defaults):
+                values.append(_require(raw, f'{prefix}.{key}', minimum=0 if key != 'temp_delta_threshold' else None)
+                              if key in settings else default)
+            parsed.append(Zone(name, MappingProxyType(probes), zone_pins[0], policy, *values, *zone_pins[1:]))
+        return parsed
+
+    @classmethod
+    def load(cls, file_path: str) -> 'PoolConfig':
+        try:
+            with open(file_path, 'r') as f:
+                return cls(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            raise ConfigError(f"Error loading configuration: {e}")
+
+    def __getitem__(self, key: str) -> Any:
+        return self._raw[key]
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Plain mutable copy of the configuration."""
+        return json.loads(json.dumps(self._raw, default=dict))
+
+
+def load_config(file_path: str) -> PoolConfig:
+    return PoolConfig.load(file_path)
+
+
+class ConfigWatcher:
+    """Reload config.json when the file changes.
+
+    get() stats the file at most once every `check_interval` seconds and
+    swaps in a new PoolConfig when its mtime, size or inode changed. Every
+    thread calling get() then sees the new configuration. An edit that does
+    not parse or validate is rejected and the previous configuration kept.
+    """
+
+    def __init__(self, file_path: str, check_interval: float = 2.0):
+        self.file_path = file_path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._stamp = self._stat()
+        self.current = PoolConfig.load(file_path)
+        self._last_check = clock.monotonic()
+        self.listeners: List[Callable[[PoolConfig], None]] = []
+
+    def _stat(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.file_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def get(self) -> PoolConfig:
+        if clock.monotonic() - self._last_check >= self.check_interval:
+            self.check()
+        return self.current
+
+    def check(self) -> bool:
+        """Reload now if the file changed, returns True when a new config was swapped in."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self._last_check = clock.monotonic()
+            stamp = self._stat()
+            if stamp is None or stamp == self._stamp:
+                return False
+            self._stamp = stamp
+            try:
+                config = PoolConfig.load(self.file_path)
+            except ConfigError as e:
+                logger.error(f"Rejected configuration change in {self.file_path}: {e}")
+                return False
+            self.current = config
+            logger.info(f"Configuration reloaded from {self.file_path}")
+        finally:
+            self._lock.release()
+        for listener in self.listeners:
+            try:
+                listener(config)
+            except Exception as e:
+                logger.error(f"Error applying reloaded configuration: {e}")
+        return True
@@ -0,0 +1,134 @@
+from array import array
+from typing import Iterable, Optional
+
+
+class RollingWindow:
+    """Statistics over the last `size` samples, O(1) per sample.
+
+    Samples live in a preallocated ring buffer of doubles. The mean and
+    variance are updated incrementally (Welford's algorithm, extended to
+    drop the sample leaving the window), min and max use monotonic queues
+    stored in preallocated index rings, and an exponentially weighted
+    moving average is kept alongside. push() allocates nothing, so the
+    window can hold thousands of samples at no extra cost per tick.
+    """
+
+    __slots__ = ('size', 'alpha', '_alpha_from_size', '_values', '_count', '_mean', '_m2', '_ewma',
+                 '_min_q', '_min_head', '_min_len', '_max_q', '_max_head', '_max_len')
+
+    def __init__(self, size: int, alpha: Optional[float] = None):
+        if size < 1:
+            raise ValueError("RollingWindow size must be at least 1")
+        self.size = size
+        # EWMA smoothing factor, defaults to the one matching the window length
+        self._alpha_from_size = alpha is None
+        self.alpha = 2.0 / (size + 1) if alpha is None else alpha
+        self._values = array('d', bytes(8 * size))
+        self._min_q = array('q', bytes(8 * size))
+        self._max_q = array('q', bytes(8 * size))
+        self.clear()
+
+    def clear(self) -> None:
+        self._count = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._ewma = None
+        self._min_head = self._min_len = 0
+        self._max_head = self._max_len = 0
+
+    def push(self, value: float) -> None:
+        size = self.size
+        values = self._values
+        seq = self._count
+        slot = seq % size
+
+        if seq < size:
+            n = seq + 1
+            delta = value - self._mean
+            self._mean += delta / n
+            self._m2 += delta * (value - self._mean)
+        else:
+            old = values[slot]
+            old_mean = self._mean
+            self._mean = old_mean + (value - old) / size
+            self._m2 += (value - old) * (value - self._mean + old - old_mean)
+            if self._m2 < 0.0:
+                self._m2 = 0.0
+        values[slot] = value
+        self._count = seq + 1
+        self._ewma = value if self._ewma is None else self._ewma + self.alpha * (value - self._ewma)
+
+        # Monotonic queues of sequence numbers, oldest at head
+        oldest = seq - size + 1
+        q, head, length = self._min_q, self._min_head, self._min_len
+        if length and q[head] < oldest:
+            head = (head + 1) % size
+            length -= 1
+        while length and values[q[(head + length - 1) % size] % size] >= value:
+            length -= 1
+        q[(head + length) % size] = seq
+        self._min_head, self._min_len = head, length + 1
+
+        q, head, length = self._max_q, self._max_head, self._max_len
+        if length and q[head] < oldest:
+            head = (head + 1) % size
+            length -= 1
+        while length and values[q[(head + length - 1) % size] % size] <= value:
+            length -= 1
+        q[(head + length) % size] = seq
+        self._max_head, self._max_len = head, length + 1
+
+    def extend(self, values: Iterable[float]) -> None:
+        for value in values:
+            self.push(value)
+
+    def resize(self, size: int) -> None:
+        """Change the window length, keeping the most recent samples.
+
+        A smoothing factor derived from the length follows the new one.
+        """
+        if size == self.size:
+            return
+        recent = self.values()[-size:]
+        ewma = self._ewma
+        alpha = None if self._alpha_from_size else self.alpha
+        self.__init__(size, alpha)
+        self.extend(recent)
+        self._ewma = ewma
+
+    def values(self) -> list:
+        """Samples currently in the window, oldest first."""
+        n = len(self)
+        start = self._count - n
+        return [self._values[i % self.size] for i in range(start, self._count)]
+
+    def __len__(self) -> int:
+        return min(self._count, self.size)
+
+    @property
+    def mean(self) -> Optional[float]:
+        return self._mean if self._count else None
+
+    @property
+    def variance(self) -> Optional[float]:
+        n = len(self)
+        if n < 2:
+            return None
+        return self._m2 / (n - 1)
+
+    @property
+    def std(self) -> Optional[float]:
+        variance = self.variance
+        return None if variance is None else variance ** 0.5
+
+    @property
+    def min(self) -> Optional[float]:
+        return self._values[self._min_q[self._min_head] % self.size] if self._count else None
+
+    @property
+    def max(self) -> Optional[float]:
+        return self._values[self._max_q[self._max_head] % self.size] if self._count else None
+
+    @property
+    def ewma(self) -> Optional[float]:
+        return self._ewma
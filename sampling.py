@@ -0,0 +1,58 @@
+from typing import Optional, Sequence
+from pool_config import SamplingPolicy
+
+
+def fastest(a: SamplingPolicy, b: SamplingPolicy) -> SamplingPolicy:
+    """Policy reading at least as often as both, for sensors read together."""
+    return SamplingPolicy(min(a.min_interval, b.min_interval), min(a.max_interval, b.max_interval),
+                          min(a.backoff, b.backoff), min(a.stable_change, b.stable_change), max(a.margin, b.margin))
+
+
+class AdaptiveRate:
+    """Sampling interval of one signal, driven by how it moves.
+
+    After each reading the interval drops back to min_interval when the
+    signal changed by more than stable_change since the previous reading,
+    or lies within `margin` of a decision threshold. Otherwise it grows by
+    `backoff`, up to max_interval, but never beyond half the time the
+    signal would take at its current rate to get within the margin of a
+    threshold, so a decision is not made late.
+    """
+
+    def __init__(self, policy: SamplingPolicy):
+        self.policy = policy
+        self.interval = policy.min_interval
+        self.due = float('-inf')
+        self._last_time: Optional[float] = None
+        self._last_value: Optional[float] = None
+
+    def is_due(self, now: float) -> bool:
+        # Half a tick early rather than a whole tick late
+        return now + self.policy.min_interval / 2 >= self.due
+
+    def update(self, now: float, value: Optional[float], thresholds: Sequence[float] = ()) -> float:
+        """Record a reading taken at `now` (monotonic), returns the interval until the next one."""
+        policy = self.policy
+        if value is None:
+            # Failed read, try again soon
+            interval = policy.min_interval
+        elif self._last_value is None:
+            interval = policy.min_interval
+            rate = 0.0
+        else:
+            change = abs(value - self._last_value)
+            elapsed = now - self._last_time
+            rate = change / elapsed if elapsed > 0 else 0.0
+            interval = policy.min_interval if change > policy.stable_change else min(self.interval * policy.backoff, policy.max_interval)
+        if value is not None:
+            for threshold in thresholds:
+                distance = abs(value - threshold) - policy.margin
+                if distance <= 0:
+                    interval = policy.min_interval
+                elif rate > 0:
+                    interval = min(interval, max(distance / rate / 2, policy.min_interval))
+            self._last_time = now
+            self._last_value = value
+        self.interval = interval
+        self.due = now + interval
+        return interval
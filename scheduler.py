@@ -0,0 +1,185 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+from typing import Callable, Dict, List, Optional
+from hardware import clock
+from metrics import histogram
+
+logger = logging.getLogger(__name__)
+
+JOB_TIME = histogram('pipool_job_seconds', "Run time of each scheduled job", ('job',))
+JOB_LATENESS = histogram('pipool_job_lateness_seconds', "Delay between the due time and the start of each job", ('job',))
+
+
+class Job:
+    """A periodic job or a one-shot timer, returned by Scheduler so it can be cancelled."""
+
+    def __init__(self, scheduler: 'Scheduler', name: str, func: Callable[[], None], deadline: float,
+                 interval: Optional[float], blocking: bool):
+        self.scheduler = scheduler
+        self.name = name
+        self.func = func
+        self.deadline = deadline
+        self.interval = interval
+        self.blocking = blocking
+        self.cancelled = False
+        self.running = False
+        self.runs = 0
+        self.skipped = 0
+        self.max_lateness = 0.0
+        self.last_start: Optional[float] = None
+        self.period_total = 0.0
+        self.period_max = 0.0
+        self.busy_total = 0.0
+        self.busy_max = 0.0
+
+    def cancel(self) -> None:
+        self.cancelled = True
+
+    def __repr__(self) -> str:
+        kind = f"every {self.interval}s" if self.interval is not None else "once"
+        return f"<Job {self.name} {kind}, due {self.deadline:.3f}>"
+
+
+class Scheduler:
+    """Runs every periodic job and timer from one thread, on monotonic deadlines.
+
+    Periodic jobs are due at start + n * interval whatever their run time,
+    so periods do not drift; when a job falls more than a period behind,
+    the missed runs are skipped rather than bunched up. Jobs marked
+    `blocking` (hardware I/O) run on a small pool of worker threads and a
+    blocking job still running when it is due again skips that run. Other
+    jobs run on the scheduler thread and must return quickly.
+
+    Jobs can be added or cancelled from any thread; stop() wakes run()
+    immediately.
+    """
+
+    def __init__(self, workers: int = 1):
+        self._lock = threading.Lock()
+        self._heap: List = []
+        self._counter = itertools.count()
+        self._wakeup = threading.Event()
+        self._running = True
+        self._work: 'queue.Queue' = queue.Queue()
+        self._work_ready = threading.Event()
+        self._workers = [
+            threading.Thread(target=self._worker, name=f'scheduler_io_{i}', daemon=True)
+            for i in range(workers)
+        ]
+        self.jobs: Dict[str, Job] = {}
+
+    def _add(self, job: Job) -> Job:
+        with self._lock:
+            self.jobs[job.name] = job
+            heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+        self._wakeup.set()
+        return job
+
+    def every(self, name: str, interval: float, func: Callable[[], None], delay: float = 0.0,
+              blocking: bool = False) -> Job:
+        """Run `func` every `interval` seconds, the first time after `delay`."""
+        return self._add(Job(self, name, func, clock.monotonic() + delay, interval, blocking))
+
+    def call_later(self, name: str, delay: float, func: Callable[[], None], blocking: bool = False) -> Job:
+        """Run `func` once, `delay` seconds from now."""
+        return self._add(Job(self, name, func, clock.monotonic() + delay, None, blocking))
+
+    def call_at_time(self, name: str, timestamp: float, func: Callable[[], None], blocking: bool = False) -> Job:
+        """Run `func` once at a wall clock time (seconds since the epoch)."""
+        return self.call_later(name, timestamp - clock.time(), func, blocking)
+
+    def _pop_due(self, now: float) -> List[Job]:
+        due = []
+        with self._lock:
+            while self._heap and (self._heap[0][2].cancelled or self._heap[0][0] <= now):
+                _, _, job = heapq.heappop(self._heap)
+                if job.cancelled:
+                    if self.jobs.get(job.name) is job:
+                        del self.jobs[job.name]
+                    continue
+                due.append(job)
+                job.max_lateness = max(job.max_lateness, now - job.deadline)
+                JOB_LATENESS.labels(job.name).observe(now - job.deadline)
+                if job.interval is not None:
+                    # Next run on the original grid, skipping the periods already missed
+                    missed = int((now - job.deadline) // job.interval)
+                    job.skipped += missed
+                    job.deadline += (missed + 1) * job.interval
+                    heapq.heappush(self._heap, (job.deadline, next(self._counter), job))
+                elif self.jobs.get(job.name) is job:
+                    del self.jobs[job.name]
+        return due
+
+    def _next_deadline(self) -> Optional[float]:
+        with self._lock:
+            return self._heap[0][0] if self._heap else None
+
+    def _execute(self, job: Job) -> None:
+        start = clock.monotonic()
+        if job.last_start is not None:
+            job.period_total += start - job.last_start
+            job.period_max = max(job.period_max, start - job.last_start)
+        job.last_start = start
+        try:
+            job.func()
+        except Exception as e:
+            logger.error("Error in scheduled job %s: %s", job.name, e)
+        finally:
+            busy = clock.monotonic() - start
+            job.busy_total += busy
+            job.busy_max = max(job.busy_max, busy)
+            JOB_TIME.labels(job.name).observe(busy)
+            job.running = False
+
+    def _worker(self) -> None:
+        while True:
+            self._work_ready.clear()
+            try:
+                job = self._work.get_nowait()
+            except queue.Empty:
+                # Idle through the clock so a simulation knows this thread is waiting
+                clock.wait(self._work_ready, 3600)
+                continue
+            if job is None:
+                return
+            self._execute(job)
+
+    def _dispatch(self, job: Job) -> None:
+        if job.running:
+            job.skipped += 1
+            return
+        job.runs += 1
+        job.running = True
+        if job.blocking:
+            self._work.put(job)
+            self._work_ready.set()
+        else:
+            self._execute(job)
+
+    def run(self) -> None:
+        """Run jobs until stop() is called."""
+        for worker in self._workers:
+            if not worker.is_alive():
+                worker.start()
+        while self._running:
+            self._wakeup.clear()
+            now = clock.monotonic()
+            for job in self._pop_due(now):
+                self._dispatch(job)
+            deadline = self._next_deadline()
+            if not self._running:
+                break
+            clock.wait(self._wakeup, 3600 if deadline is None else deadline - clock.monotonic())
+        for _ in self._workers:
+            self._work.put(None)
+        self._work_ready.set()
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.join()
+
+    def stop(self) -> None:
+        self._running = False
+        self._wakeup.set()
@@ -1,90 +1,246 @@
-import time
-import json
 import logging
-import os
-from typing import Dict, Any
-from w1thermsensor import W1ThermSensor, NoSensorFoundError
-import smbus
+from typing import Callable, Dict, Any, FrozenSet, List, Optional, Tuple
+from hardware import w1thermsensor, w1bus, smbus, clock
+from pool_config import ACQUISITION_MODES, LIGHT_SENSOR, ConfigError, load_config
+from bh1750 import BH1750
+from metrics import SENSOR_READ_TIME, STAGE_TIME, gauge
+from sampling import AdaptiveRate, fastest
+from sensor_guard import CircuitBreaker, SensorGuard, read_all
+from log_pipeline import setup_logging
 
-class ConfigError(Exception):
-    pass
+logger = logging.getLogger(__name__)
 
-def load_config(file_path: str) -> Dict[str, Any]:
-    try:
-        with open(file_path, 'r') as f:
-            return json.load(f)
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        raise ConfigError(f"Error loading configuration: {e}")
+SAMPLE_INTERVAL = gauge('pipool_sensor_sample_interval_seconds', "Current interval between two reads of each sensor", ('sensor',))
+# Parallel reads after a failed bulk conversion, for this long, doubled after each failure in a row
+BULK_RETRY_DELAY = 60.0
+BULK_RETRY_MAX_DELAY = 3600.0
 
 class SensorManager:
     def __init__(self, config: Dict[str, Any]):
         self.config = config
-        self.setup_logging()
         self.temperature_sensors = self._initialize_temperature_sensors()
+        self.acquisition_mode = self._select_acquisition_mode()
         self.light_sensor = self._initialize_light_sensor()
+        # One guard per device, plus the bulk conversion command shared by the probes and the
+        # light polls, which run on the scheduler thread while the acquisition reads
+        self.guards = {name: SensorGuard(name, config.read_guard)
+                       for name in [*self.temperature_sensors, LIGHT_SENSOR, 'w1_bulk_conversion', 'light_poll']}
+        # Sensors currently served their last known value
+        self._stale = set()
+        # Latest readings, returned for the sensors that are not due
+        self._temperatures: Dict[str, Optional[float]] = {}
+        self._light: Optional[float] = None
+        self._sampling, self._light_rate = self._initialize_sampling()
+        self._light_thresholds = tuple({zone.light_threshold for zone in config.zones if zone.policy == 'light_and_delta'})
+        # Failed bulk conversions in a row, and when to try bulk mode again
+        self._bulk_failures = 0
+        self._bulk_retry_at = float('-inf')
 
-    def setup_logging(self):
-        if self.config['error_logging']['enabled']:
-            log_dir = self.config['error_logging']['log_directory']
-            os.makedirs(log_dir, exist_ok=True)
-            log_file = os.path.join(log_dir, 'sensor_errors.log')
-            logging.basicConfig(
-                filename=log_file,
-                level=logging.ERROR,
-                format='%(asctime)s - %(levelname)s - %(message)s'
-            )
-
-    def _initialize_temperature_sensors(self) -> Dict[str, W1ThermSensor]:
+    def _initialize_temperature_sensors(self) -> Dict[str, Any]:
         sensors = {}
         temp_sensors = self.config['sensors']['temperature']['displays']
         for key, sensor_info in temp_sensors.items():
-            if key != 'H':  # 'H' is reserved for time display
+            if key not in self.config.time_displays:
                 try:
-                    sensors[sensor_info['name']] = W1ThermSensor(sensor_id=sensor_info['id'])
-                except NoSensorFoundError as e:
+                    sensors[sensor_info['name']] = w1thermsensor.W1ThermSensor(sensor_id=sensor_info['id'])
+                except w1thermsensor.NoSensorFoundError as e:
                     error_msg = f"Error initializing temperature sensor {key}: {e}"
                     print(error_msg)
-                    logging.error(error_msg)
+                    logger.error(error_msg)
         return sensors
 
-    def _initialize_light_sensor(self):
-        light_config = self.config['sensors']['light']
-        return {
-            'device': light_config['device_address'],
-            'mode': light_config['mode'],
-            'bus': smbus.SMBus(light_config['bus_number'])
-        }
-
-    def get_temperature_data(self) -> Dict[str, float]:
-        temp_data = {}
-        for name, sensor in self.temperature_sensors.items():
+    def _select_acquisition_mode(self) -> str:
+        mode = self.config['sensors']['temperature'].get('acquisition', 'auto')
+        if mode not in ACQUISITION_MODES:
+            raise ConfigError(f"Invalid temperature acquisition mode '{mode}', expected one of {ACQUISITION_MODES}")
+        if mode == 'auto':
             try:
-                temp_data[name] = sensor.get_temperature()
-            except NoSensorFoundError as e:
-                error_msg = f"Error reading temperature data for {name}: {e}"
-                print(error_msg)
-                logging.error(error_msg)
-                temp_data[name] = None
-        return temp_data
-
-    def convert_to_number(self, data):
-        try:
-            return (data[1] + (256 * data[0])) / 1.2
-        except IndexError as e:
-            error_msg = f"Error converting light data: {e}"
-            print(error_msg)
-            logging.error(error_msg)
-            return None
+                bulk = w1bus.bulk_convert_supported()
+            except OSError:
+                bulk = False
+            if bulk:
+                mode = 'bulk'
+            elif len(self.temperature_sensors) > 1:
+                mode = 'parallel'
+            else:
+                mode = 'sequential'
+        logger.info(f"Temperature acquisition mode: {mode}")
+        return mode
 
-    def get_light_level(self):
+    def _initialize_light_sensor(self) -> BH1750:
+        light_config = self.config['sensors']['light']
+        sensor = BH1750(
+            smbus.SMBus(light_config['bus_number']),
+            int(light_config['device_address'], 16),
+            int(light_config['mode'], 16),
+            auto_range=light_config.get('auto_range', True)
+        )
         try:
-            data = self.light_sensor['bus'].read_i2c_block_data(int(self.light_sensor['device'], 16), int(self.light_sensor['mode'], 16))
-            return self.convert_to_number(data)
+            sensor.start()
         except IOError as e:
-            error_msg = f"Error reading light level: {e}"
+            error_msg = f"Error starting light sensor: {e}"
             print(error_msg)
-            logging.error(error_msg)
-            return None
+            logger.error(error_msg)
+        return sensor
+
+    def _initialize_sampling(self) -> Tuple[Optional[List[Tuple[AdaptiveRate, Tuple[str, ...], Tuple[float, ...]]]], Optional[AdaptiveRate]]:
+        """Adaptive read rates, with the probes they cover and the thresholds they watch.
+
+        The E and S probes of a zone share one rate driven by their delta,
+        the other probes follow their own temperature. None when the
+        sampling section is disabled: every sensor is read on each update.
+        """
+        policies = self.config.sampling
+        if policies is None:
+            return None, None
+        groups = []
+        grouped = set()
+        for zone in self.config.zones:
+            pair = (zone.probes['E'], zone.probes['S'])
+            if grouped.intersection(pair) or not all(name in self.temperature_sensors for name in pair):
+                continue
+            groups.append((AdaptiveRate(fastest(policies[pair[0]], policies[pair[1]])), pair, (zone.temp_delta_threshold,)))
+            grouped.update(pair)
+        for name in self.temperature_sensors:
+            if name not in grouped:
+                groups.append((AdaptiveRate(policies[name]), (name,), ()))
+        return groups, AdaptiveRate(policies[LIGHT_SENSOR])
+
+    def get_temperature_data(self) -> Dict[str, Optional[float]]:
+        """Read the probes that are due within a single conversion time when possible.
+
+        'bulk' starts the conversion on all probes with one w1 command and then
+        collects the results, 'parallel' reads the probes at the same time and
+        'sequential' reads them one after another (one conversion each). With
+        adaptive sampling, the probes that are not due keep their last
+        reading, and nothing touches the bus when none is due.
+
+        Every read goes through the guard of its probe: a probe that fails or
+        hangs gets its last known value (see stale_sensors()), or None once it
+        is too old, and costs the cycle `read_guard.timeout` seconds at most.
+        """
+        with STAGE_TIME.labels('temperatures').time():
+            now = clock.monotonic()
+            if self._sampling is None:
+                sensors = self.temperature_sensors
+            else:
+                sensors = {name: self.temperature_sensors[name]
+                           for rate, names, _ in self._sampling if rate.is_due(now) for name in names}
+            if not sensors:
+                return dict(self._temperatures)
+            if self.acquisition_mode == 'bulk':
+                readings = self._read_temperatures_bulk(sensors)
+            elif self.acquisition_mode == 'parallel':
+                readings = self._read_temperatures_parallel(sensors)
+            else:
+                readings = {name: self._read_guarded({name: self._temperature_reader(name, sensor)})[name]
+                            for name, sensor in sensors.items()}
+            if self._sampling is None:
+                return readings
+            self._temperatures.update(readings)
+            self._update_rates(now, readings)
+            return dict(self._temperatures)
+
+    def _update_rates(self, now: float, readings: Dict[str, Optional[float]]) -> None:
+        temperatures = self._temperatures
+        for rate, names, thresholds in self._sampling:
+            if names[0] not in readings:
+                continue
+            if self._stale.intersection(names):
+                # Not a reading, try again soon
+                value = None
+            elif len(names) == 2:
+                temp_E, temp_S = temperatures[names[0]], temperatures[names[1]]
+                value = temp_S - temp_E if temp_E is not None and temp_S is not None else None
+            else:
+                value = temperatures[names[0]]
+            interval = rate.update(now, value, thresholds)
+            for name in names:
+                SAMPLE_INTERVAL.labels(name).set(interval)
+
+    def stale_sensors(self) -> FrozenSet[str]:
+        """Names of the sensors whose latest value is a last known one, the light sensor included."""
+        return frozenset(self._stale)
+
+    def _read_guarded(self, reads: Dict[str, Callable[[], float]]) -> Dict[str, Optional[float]]:
+        readings = {}
+        for name, reading in read_all(self.guards, reads).items():
+            if reading.stale:
+                self._stale.add(name)
+            else:
+                self._stale.discard(name)
+            readings[name] = reading.value
+        return readings
+
+    @staticmethod
+    def _temperature_reader(name: str, sensor) -> Callable[[], float]:
+        def read():
+            with SENSOR_READ_TIME.labels(name).time():
+                return sensor.get_temperature()
+        return read
+
+    @staticmethod
+    def _converted_reader(name: str, sensor) -> Callable[[], float]:
+        def read():
+            with SENSOR_READ_TIME.labels(name).time():
+                return w1bus.read_converted(sensor.id)
+        return read
+
+    def _read_temperatures_parallel(self, sensors: Dict[str, Any]) -> Dict[str, Optional[float]]:
+        return self._read_guarded({name: self._temperature_reader(name, sensor) for name, sensor in sensors.items()})
+
+    def _trigger_conversion(self) -> None:
+        with STAGE_TIME.labels('w1_bulk_conversion').time():
+            w1bus.trigger_bulk_conversion()
+
+    def _read_temperatures_bulk(self, sensors: Dict[str, Any]) -> Dict[str, Optional[float]]:
+        now = clock.monotonic()
+        if now < self._bulk_retry_at:
+            return self._read_temperatures_parallel(sensors)
+        if self.guards['w1_bulk_conversion'].read(self._trigger_conversion).stale:
+            self._bulk_failures += 1
+            delay = min(BULK_RETRY_DELAY * 2 ** (self._bulk_failures - 1), BULK_RETRY_MAX_DELAY)
+            self._bulk_retry_at = now + delay
+            error_msg = f"Bulk temperature conversion failed, falling back to parallel reads for {delay:g}s"
+            print(error_msg)
+            logger.error(error_msg)
+            return self._read_temperatures_parallel(sensors)
+        if self._bulk_failures:
+            logger.info(f"Bulk temperature conversion works again after {self._bulk_failures} failures")
+            self._bulk_failures = 0
+        return self._read_guarded({name: self._converted_reader(name, sensor) for name, sensor in sensors.items()})
+
+    def poll_light(self):
+        """Collect the latest light measurement, cheap enough to run several times per second."""
+        # While the light is stable, get_light_level polls on its own when it is due
+        if self._light_rate is not None and self._light_rate.interval > self._light_rate.policy.min_interval:
+            return
+        # Nor while the sensor is left alone after failing
+        if self.guards[LIGHT_SENSOR].breaker.state == CircuitBreaker.OPEN:
+            return
+        # Guarded as well, a hung bus would hold every job of the scheduler thread
+        self.guards['light_poll'].read(self._poll_light)
+
+    def _poll_light(self) -> None:
+        with SENSOR_READ_TIME.labels('light_poll').time():
+            self.light_sensor.poll()
+
+    def get_light_level(self):
+        """Light level averaged over the samples polled since the last call."""
+        rate = self._light_rate
+        now = clock.monotonic()
+        if rate is not None and not rate.is_due(now):
+            return self._light
+        light = self._read_guarded({LIGHT_SENSOR: self._read_light})[LIGHT_SENSOR]
+        if rate is not None:
+            self._light = light
+            fresh = None if LIGHT_SENSOR in self._stale else light
+            SAMPLE_INTERVAL.labels(LIGHT_SENSOR).set(rate.update(now, fresh, self._light_thresholds))
+        return light
+
+    def _read_light(self) -> float:
+        with SENSOR_READ_TIME.labels('light').time():
+            return self.light_sensor.read()
 
     def sensor_loop(self):
         while True:
@@ -92,11 +248,12 @@ class SensorManager:
             light_level = self.get_light_level()
             sensor_data = {**temp_data, 'light': light_level}
             print(sensor_data)  # You can replace this with your desired data handling
-            time.sleep(self.config['sensors']['temperature']['update_interval'])
+            clock.sleep(self.config['sensors']['temperature']['update_interval'])
 
 def main():
     try:
         config = load_config('config.json')
+        setup_logging(config, 'sensor.log')
         sensor_manager = SensorManager(config)
         sensor_manager.sensor_loop()
     except ConfigError as e:
@@ -105,7 +262,7 @@ def main():
         print("Program terminated by user")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        logging.exception("An unexpected error occurred")
+        logger.exception("An unexpected error occurred")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
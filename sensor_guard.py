@@ -0,0 +1,186 @@
+import logging
+import threading
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+from hardware import clock
+from metrics import SENSOR_READ_ERRORS, counter
+from pool_config import GuardPolicy
+
+logger = logging.getLogger(__name__)
+
+BREAKER_TRIPS = counter('pipool_sensor_breaker_trips_total', "Times the circuit breaker of each sensor opened", ('sensor',))
+READ_RETRIES = counter('pipool_sensor_read_retries_total', "Reads of each sensor attempted again after a failure", ('sensor',))
+
+
+class SensorReading(NamedTuple):
+    value: Optional[float]
+    # True when `value` is the last known one, served in place of a failed or skipped read
+    stale: bool = False
+
+    def __str__(self) -> str:
+        # Formatted when written, a reading passed as a log argument costs the caller nothing
+        return format_reading(self.value, self.stale)
+
+
+def format_reading(value: Optional[float], stale: bool = False) -> str:
+    """Value for the status logs: 'n/a' when unknown, a trailing '*' when stale."""
+    if value is None:
+        return "n/a"
+    return f"{value:.2f}*" if stale else f"{value:.2f}"
+
+
+class CircuitBreaker:
+    """Stops calling a device for `cool_down` seconds after `failures` failures in a row.
+
+    After the cool-down one trial call is let through (half open): a
+    success closes the breaker, a failure opens it for another cool-down.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failures: int = 3, cool_down: float = 60.0):
+        self.failures = failures
+        self.cool_down = cool_down
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened_at = float('-inf')
+
+    def allow(self, now: float) -> bool:
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.cool_down:
+                return False
+            self.state = self.HALF_OPEN
+        return True
+
+    def success(self) -> None:
+        self.state = self.CLOSED
+        self.consecutive = 0
+
+    def failure(self, now: float) -> bool:
+        """Count a failure, returns True when it opens the breaker."""
+        self.consecutive += 1
+        if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.consecutive >= self.failures):
+            self.state = self.OPEN
+            self.opened_at = now
+            return True
+        return False
+
+
+class SensorGuard:
+    """Deadline, retries and circuit breaker around the reads of one device.
+
+    Reads run on a thread of their own, so a device blocking in the kernel
+    holds its caller for `timeout` seconds at most, and no other read is
+    started while one is still stuck. A failed attempt is retried after
+    `backoff` seconds, doubled each time, while the deadline allows. Once
+    the breaker opens the device is left alone for the cool-down, and the
+    last known value is served, flagged stale, for up to `max_stale` seconds.
+
+    start() and finish() split a read so several devices can be read at once.
+    A guard is used by one thread at a time, the acquisition.
+    """
+
+    def __init__(self, name: str, policy: GuardPolicy = GuardPolicy()):
+        self.name = name
+        self.policy = policy
+        self.breaker = CircuitBreaker(policy.failures, policy.cool_down)
+        self.last = SensorReading(None)
+        self.last_time = float('-inf')
+        self._thread: Optional[threading.Thread] = None
+        self._request: Optional[Tuple[Callable[[], Optional[float]], float]] = None
+        self._outcome: Tuple[Optional[float], Optional[Exception]] = (None, None)
+        self._busy = False
+        self._deadline = float('-inf')
+        self._work_ready = threading.Event()
+        self._done = threading.Event()
+
+    def read(self, func: Callable[[], Optional[float]]) -> SensorReading:
+        return self.finish(self.start(func))
+
+    def start(self, func: Callable[[], Optional[float]]) -> bool:
+        """Start a read in the background, False when the device is skipped."""
+        now = clock.monotonic()
+        if not self.breaker.allow(now):
+            return False
+        if self._busy:
+            self._failed(now, "the previous read is still blocked")
+            return False
+        if self._thread is None:
+            # Daemon, a read stuck in the kernel must not hold the process at exit
+            self._thread = threading.Thread(target=self._worker, name=f'read_{self.name}', daemon=True)
+            self._thread.start()
+        self._deadline = now + self.policy.timeout
+        self._busy = True
+        self._done.clear()
+        self._request = (func, self._deadline)
+        self._work_ready.set()
+        return True
+
+    def _worker(self) -> None:
+        while True:
+            if not self._work_ready.is_set():
+                # Idle through the clock so a simulation knows this thread is waiting
+                clock.wait(self._work_ready, 3600)
+                continue
+            self._work_ready.clear()
+            func, deadline = self._request
+            try:
+                self._outcome = (self._attempts(func, deadline), None)
+            except Exception as e:
+                self._outcome = (None, e)
+            self._busy = False
+            self._done.set()
+
+    def _attempts(self, func: Callable[[], Optional[float]], deadline: float) -> Optional[float]:
+        delay = self.policy.backoff
+        for attempt in range(self.policy.retries + 1):
+            try:
+                return func()
+            except Exception:
+                if attempt == self.policy.retries or clock.monotonic() + delay >= deadline:
+                    raise
+            READ_RETRIES.labels(self.name).inc()
+            clock.sleep(delay)
+            delay *= 2
+
+    def finish(self, started: bool) -> SensorReading:
+        """Result of the read started by start(), waiting until its deadline at most."""
+        if not started:
+            return self.last_known()
+        if not clock.wait(self._done, self._deadline - clock.monotonic()):
+            self._failed(clock.monotonic(), f"no answer within {self.policy.timeout:g}s")
+            return self.last_known()
+        value, error = self._outcome
+        if error is not None:
+            self._failed(clock.monotonic(), error)
+            return self.last_known()
+        if self.breaker.consecutive:
+            logger.info("Sensor %s answers again", self.name)
+        self.breaker.success()
+        self.last = SensorReading(value)
+        self.last_time = clock.monotonic()
+        return self.last
+
+    def last_known(self) -> SensorReading:
+        if clock.monotonic() - self.last_time > self.policy.max_stale:
+            return SensorReading(None, True)
+        return SensorReading(self.last.value, True)
+
+    def _failed(self, now: float, error: object) -> None:
+        SENSOR_READ_ERRORS.labels(self.name).inc()
+        first = self.breaker.consecutive == 0
+        if self.breaker.failure(now):
+            BREAKER_TRIPS.labels(self.name).inc()
+            logger.error("Error reading %s: %s, not read again for %gs", self.name, error, self.policy.cool_down)
+        elif first:
+            logger.error("Error reading %s: %s", self.name, error)
+
+
+def read_all(guards: Dict[str, SensorGuard], reads: Dict[str, Callable[[], Optional[float]]]) -> Dict[str, SensorReading]:
+    """Run the reads at the same time, each through the guard of its sensor.
+
+    The whole takes as long as the slowest read, a hung device its timeout at most.
+    """
+    started = {name: guards[name].start(read) for name, read in reads.items()}
+    return {name: guards[name].finish(ok) for name, ok in started.items()}
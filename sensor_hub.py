@@ -0,0 +1,85 @@
+import logging
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Callable, Dict, FrozenSet, List, Mapping, Optional, Tuple
+from hardware import clock
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SensorSnapshot:
+    """One acquisition of every sensor, shared read-only by all consumers."""
+    sequence: int
+    timestamp: float
+    temperatures: Mapping[str, Optional[float]]
+    light: Optional[float]
+    # Sensors whose value above is a last known one, 'light' for the light sensor
+    stale: FrozenSet[str] = frozenset()
+
+    def age(self) -> float:
+        return clock.time() - self.timestamp
+
+
+class Subscription:
+    def __init__(self, hub: 'SensorHub', name: str, max_age: Optional[float], callback: Optional[Callable[[SensorSnapshot], None]]):
+        self.hub = hub
+        self.name = name
+        self.max_age = max_age
+        self.callback = callback
+        self.last_sequence = 0
+
+    def get(self) -> Optional[SensorSnapshot]:
+        """Latest snapshot, or None if there is none younger than max_age."""
+        snapshot = self.hub.latest
+        if snapshot is None:
+            return None
+        if self.max_age is not None and snapshot.age() > self.max_age:
+            logger.warning("Sensor snapshot %d is too old for %s (%.1fs > %ss)", snapshot.sequence, self.name, snapshot.age(), self.max_age)
+            return None
+        self.last_sequence = snapshot.sequence
+        return snapshot
+
+
+class SensorHub:
+    """Single acquisition thread publishing immutable sensor snapshots.
+
+    `read` returns the temperatures by sensor name and the light level. However
+    many consumers subscribe, the sensors are read once per acquire(), which
+    the scheduler calls every update interval.
+    `stale`, when given, returns the names of the sensors read from their
+    last known value and is called after each read.
+    Consumers either pull the latest snapshot with Subscription.get() or get a
+    callback on the acquisition thread after each publication.
+    """
+
+    def __init__(self, read: Callable[[], Tuple[Dict[str, Optional[float]], Optional[float]]],
+                 stale: Optional[Callable[[], FrozenSet[str]]] = None):
+        self.read = read
+        self.stale = stale
+        self.latest: Optional[SensorSnapshot] = None
+        self.subscriptions: List[Subscription] = []
+        self.reads = 0
+
+    def subscribe(self, name: str, max_age: Optional[float] = None,
+                  callback: Optional[Callable[[SensorSnapshot], None]] = None) -> Subscription:
+        subscription = Subscription(self, name, max_age, callback)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def acquire(self) -> SensorSnapshot:
+        temperatures, light = self.read()
+        self.reads += 1
+        sequence = self.latest.sequence + 1 if self.latest is not None else 1
+        stale = self.stale() if self.stale is not None else frozenset()
+        snapshot = SensorSnapshot(sequence, clock.time(), MappingProxyType(dict(temperatures)), light, stale)
+        self.latest = snapshot
+        for subscription in self.subscriptions:
+            if subscription.callback is None:
+                continue
+            try:
+                subscription.callback(snapshot)
+                subscription.last_sequence = sequence
+            except Exception as e:
+                logger.error("Error in sensor subscriber %s: %s", subscription.name, e)
+        return snapshot
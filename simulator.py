@@ -0,0 +1,874 @@
+import argparse
+import contextlib
+import copy
+import io
+import json
+import math
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import urllib.request
+from typing import Callable, Dict, Any, List, Optional
+
+import hardware
+
+# Typical DS18B20 conversion time at 12-bit resolution
+W1_CONVERSION_TIME = 0.75
+# BH1750 one-time high resolution measurement time
+BH1750_MEASUREMENT_TIME = 0.12
+# Bit-banged TM1637 transfer of a full 4 digit frame
+TM1637_TRANSFER_TIME = 0.004
+
+
+class WallClock(hardware.RealClock):
+    """Real time clock for running the fakes interactively (PIPOOL_BACKEND=sim)."""
+
+    def io_delay(self, seconds: float) -> None:
+        self.sleep(seconds)
+
+
+class VirtualClock:
+    """Discrete-event clock: simulated time jumps to the next sleeper's deadline.
+
+    Non-daemon threads and threads that call sleep() or io_delay() take part
+    in the simulation. The thread calling advance() moves time forward as soon as every participant
+    is asleep, or after `grace` real seconds without clock activity nor CPU
+    use when one of them is blocked on something else (a join, a queue...).
+    Python code
+    therefore runs in zero simulated time and only the modelled hardware
+    delays show up in the timings.
+
+    Every call to sleep() is recorded per thread so the loop periods of the
+    controller can be reported at the end of a run. Fake drivers use
+    io_delay(), which advances time without counting as a loop iteration.
+    """
+
+    def __init__(self, start: Optional[float] = None, grace: float = 0.002):
+        self.start = time.time() if start is None else start
+        self.grace = grace
+        self._now = self.start
+        self._cond = threading.Condition()
+        self._waiting: Dict[threading.Thread, float] = {}
+        self._events: Dict[threading.Thread, threading.Event] = {}
+        self._participants = set()
+        self._activity = 0
+        self.loop_stats: Dict[str, Dict[str, float]] = {}
+
+    def time(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._now - self.start
+
+    def localtime(self) -> 'time.struct_time':
+        return time.localtime(self._now)
+
+    def io_delay(self, seconds: float) -> None:
+        thread = threading.current_thread()
+        with self._cond:
+            deadline = self._now + max(seconds, 0.0)
+            self._participants.add(thread)
+            self._waiting[thread] = deadline
+            self._activity += 1
+            self._cond.notify_all()
+            while self._now < deadline:
+                self._cond.wait()
+            del self._waiting[thread]
+            self._activity += 1
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        thread = threading.current_thread()
+        with self._cond:
+            self._participants.add(thread)
+            # A positive timeout always moves time on, even one below the float resolution
+            self._waiting[thread] = (max(self._now + timeout, math.nextafter(self._now, math.inf))
+                                     if timeout > 0 else self._now)
+            self._events[thread] = event
+            self._activity += 1
+            self._cond.notify_all()
+            while self._now < self._waiting[thread] and not event.is_set():
+                self._cond.wait(self.grace)
+            del self._waiting[thread]
+            del self._events[thread]
+            self._activity += 1
+        return event.is_set()
+
+    def sleep(self, seconds: float) -> None:
+        name = threading.current_thread().name
+        now = self._now
+        with self._cond:
+            stats = self.loop_stats.get(name)
+            if stats is None:
+                stats = self.loop_stats[name] = {
+                    'iterations': 0, 'busy_total': 0.0, 'busy_max': 0.0,
+                    'period_total': 0.0, 'period_max': 0.0, 'last_wake': None,
+                    'last_sleep': None,
+                }
+            if stats['last_wake'] is not None:
+                busy = now - stats['last_wake']
+                stats['busy_total'] += busy
+                stats['busy_max'] = max(stats['busy_max'], busy)
+            if stats['last_sleep'] is not None:
+                period = now - stats['last_sleep']
+                stats['period_total'] += period
+                stats['period_max'] = max(stats['period_max'], period)
+                stats['iterations'] += 1
+            stats['last_sleep'] = now
+        self.io_delay(seconds)
+        stats['last_wake'] = self._now
+
+    def advance(self, end: Optional[float] = None, alive: Optional[Callable[[], bool]] = None) -> None:
+        """Drive simulated time until `end` or until `alive()` turns false."""
+        driver = threading.current_thread()
+        with self._cond:
+            while (end is None or self._now < end) and (alive is None or alive()):
+                self._participants = {t for t in self._participants if t.is_alive()}
+                # Threads that did not reach the clock yet may be about to
+                participants = self._participants | {
+                    t for t in threading.enumerate() if not t.daemon and t is not driver
+                }
+                # A thread whose event was set is about to wake up, it is not asleep anymore
+                pending = [d for t, d in self._waiting.items()
+                           if t in participants and not (t in self._events and self._events[t].is_set())]
+                if pending and min(pending) > self._now and len(pending) == len(participants):
+                    self._jump(min(pending), end)
+                    continue
+                activity = self._activity
+                cpu = time.process_time()
+                self._cond.wait(self.grace)
+                idle = time.process_time() - cpu < self.grace / 2
+                if activity == self._activity and idle and pending and min(pending) > self._now:
+                    # Someone is blocked outside the clock, let time move on
+                    self._jump(min(pending), end)
+
+    def _jump(self, deadline: float, end: Optional[float]) -> None:
+        self._now = deadline if end is None else min(deadline, end)
+        self._cond.notify_all()
+
+
+class InstantClock:
+    """Simulated time that jumps over every sleep and hardware delay at once.
+
+    For a single thread calling into the controller directly (bench.py):
+    the modelled delays still move time, so sensors convert and averages
+    fill, but only the Python code costs real time. A wait() is for a
+    helper thread (a sensor read) and takes the real time it needs to set
+    the event.
+    """
+
+    def __init__(self, start: Optional[float] = None):
+        self.start = time.time() if start is None else start
+        self._now = self.start
+
+    def time(self) -> float:
+        return self._now
+
+    def monotonic(self) -> float:
+        return self._now - self.start
+
+    def localtime(self) -> 'time.struct_time':
+        return time.localtime(self._now)
+
+    def io_delay(self, seconds: float) -> None:
+        self._now += max(seconds, 0.0)
+
+    def sleep(self, seconds: float) -> None:
+        self.io_delay(seconds)
+
+    def wait(self, event: threading.Event, timeout: float) -> bool:
+        return event.wait(max(timeout, 0.0))
+
+
+class PoolModel:
+    """Very rough thermal model of a pool heated by a solar collector."""
+
+    def __init__(self, clock: VirtualClock, seed: int = 0, peak_lux: float = 60000.0):
+        self.clock = clock
+        self.peak_lux = peak_lux
+        self.random = random.Random(seed)
+        self.pump_on = False
+        self._lock = threading.Lock()
+        self._last_update = clock.time()
+        self.water = 25.0
+        self.collector = self.ambient()
+
+    def _hour(self, t: float) -> float:
+        lt = time.localtime(t)
+        return lt.tm_hour + lt.tm_min / 60.0 + lt.tm_sec / 3600.0
+
+    def light(self, t: Optional[float] = None) -> float:
+        t = self.clock.time() if t is None else t
+        sun = math.sin(math.pi * (self._hour(t) - 6.0) / 14.0)
+        if sun <= 0:
+            return 0.0
+        # Passing clouds, deterministic for a given time so repeated reads agree
+        cloud = 0.75 + 0.25 * math.sin(t / 600.0) * math.sin(t / 97.0)
+        return self.peak_lux * sun * cloud
+
+    def ambient(self, t: Optional[float] = None) -> float:
+        t = self.clock.time() if t is None else t
+        return 21.0 + 7.0 * math.sin(math.pi * (self._hour(t) - 9.0) / 12.0)
+
+    def _update(self) -> None:
+        now = self.clock.time()
+        dt = now - self._last_update
+        if dt <= 0:
+            return
+        self._last_update = now
+        ambient = self.ambient(now)
+        light = self.light(now)
+        if self.pump_on:
+            target = self.water + light / 25000.0
+            self.collector += (target - self.collector) * (1 - math.exp(-dt / 60.0))
+            self.water += (self.collector - self.water) * (1 - math.exp(-dt / 40000.0))
+        else:
+            target = ambient + light / 2500.0
+            self.collector += (target - self.collector) * (1 - math.exp(-dt / 900.0))
+        self.water += (ambient - self.water) * (1 - math.exp(-dt / 200000.0))
+
+    def set_pump(self, on: bool) -> None:
+        with self._lock:
+            self._update()
+            self.pump_on = on
+
+    def temperature(self, role: str) -> float:
+        with self._lock:
+            self._update()
+            value = {'E': self.water, 'S': self.collector, 'A': self.ambient()}[role]
+        return value + self.random.gauss(0.0, 0.03)
+
+
+class FakeGPIO:
+    """In-process replacement for the RPi.GPIO module."""
+
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, simulation: 'Simulation'):
+        self.simulation = simulation
+        self._mode = None
+        self._lock = threading.Lock()
+        self.directions: Dict[int, int] = {}
+        self.levels: Dict[int, int] = {}
+        self.callbacks: Dict[int, List[Any]] = {}
+        self.edges: Dict[int, int] = {}
+        self.transitions: List[Any] = []
+        self._events: 'queue.Queue' = queue.Queue()
+        self._dispatcher = None
+
+    def _check_mode(self) -> None:
+        if self._mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+
+    def setmode(self, mode: int) -> None:
+        self._mode = mode
+
+    def getmode(self) -> Optional[int]:
+        return self._mode
+
+    def setwarnings(self, flag: bool) -> None:
+        pass
+
+    def setup(self, channel: int, direction: int, pull_up_down: int = PUD_OFF, initial: int = -1) -> None:
+        self._check_mode()
+        with self._lock:
+            self.directions[channel] = direction
+            if direction == self.IN:
+                self.levels[channel] = self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH
+            else:
+                self.levels[channel] = self.LOW if initial == -1 else initial
+        if direction == self.OUT:
+            self._notify_output(channel, self.levels[channel])
+
+    def output(self, channel: int, value: int) -> None:
+        self._check_mode()
+        if self.directions.get(channel) != self.OUT:
+            raise RuntimeError("The GPIO channel has not been set up as an OUTPUT")
+        value = self.HIGH if value else self.LOW
+        with self._lock:
+            changed = self.levels.get(channel) != value
+            self.levels[channel] = value
+        if changed:
+            self._notify_output(channel, value)
+
+    def input(self, channel: int) -> int:
+        self._check_mode()
+        if channel not in self.directions:
+            raise RuntimeError("You must setup() the GPIO channel first")
+        return self.levels[channel]
+
+    def cleanup(self, channel: Optional[int] = None) -> None:
+        with self._lock:
+            channels = [channel] if channel is not None else list(self.directions)
+            for ch in channels:
+                self.directions.pop(ch, None)
+                self.callbacks.pop(ch, None)
+                self.edges.pop(ch, None)
+            if channel is None:
+                self._mode = None
+
+    def add_event_detect(self, channel: int, edge: int, callback=None, bouncetime: Optional[int] = None) -> None:
+        self._check_mode()
+        with self._lock:
+            if channel in self.edges:
+                raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+            self.edges[channel] = edge
+            self.callbacks[channel] = [callback] if callback is not None else []
+
+    def add_event_callback(self, channel: int, callback) -> None:
+        with self._lock:
+            if channel not in self.edges:
+                raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+            self.callbacks[channel].append(callback)
+
+    def remove_event_detect(self, channel: int) -> None:
+        with self._lock:
+            self.edges.pop(channel, None)
+            self.callbacks.pop(channel, None)
+
+    def _notify_output(self, channel: int, value: int) -> None:
+        self.transitions.append((self.simulation.clock.time(), channel, value))
+        if channel == self.simulation.relay_pin:
+            self.simulation.model.set_pump(value == self.HIGH)
+
+    def _dispatch_events(self) -> None:
+        while True:
+            channel = self._events.get()
+            for callback in list(self.callbacks.get(channel, [])):
+                try:
+                    callback(channel)
+                except Exception as e:
+                    print(f"Error in GPIO event callback: {e}")
+            self._events.task_done()
+
+    def set_input(self, channel: int, value: int) -> None:
+        """Drive an input pin, firing edge callbacks like the RPi.GPIO event thread."""
+        with self._lock:
+            previous = self.levels.get(channel)
+            self.levels[channel] = value
+            edge = self.edges.get(channel)
+            if self._dispatcher is None:
+                self._dispatcher = threading.Thread(target=self._dispatch_events, name='gpio_events', daemon=True)
+                self._dispatcher.start()
+        if edge is None or previous == value:
+            return
+        falling = value == self.LOW
+        if edge == self.BOTH or (edge == self.FALLING and falling) or (edge == self.RISING and not falling):
+            self._events.put(channel)
+            # The level must not change before the callbacks had a chance to read it
+            self._events.join()
+
+    def press(self, channel: int, duration: float = 0.2) -> None:
+        """Press a pull-up button for `duration` simulated seconds."""
+        self.set_input(channel, self.LOW)
+        self.simulation.clock.io_delay(duration)
+        self.set_input(channel, self.HIGH)
+
+
+class FakeNoSensorFoundError(Exception):
+    pass
+
+
+class FakeSensorNotReadyError(Exception):
+    pass
+
+
+class FakeW1ThermSensor:
+    """Replacement for w1thermsensor.W1ThermSensor bound to a Simulation."""
+
+    simulation: 'Simulation' = None
+
+    def __init__(self, sensor_id: Optional[str] = None):
+        if sensor_id not in self.simulation.probes:
+            raise FakeNoSensorFoundError(f"Could not find sensor of type DS18B20 with id {sensor_id}")
+        self.id = sensor_id
+        self.role = self.simulation.probes[sensor_id]
+
+    @classmethod
+    def get_available_sensors(cls) -> List['FakeW1ThermSensor']:
+        return [cls(sensor_id) for sensor_id in cls.simulation.probes]
+
+    def get_temperature(self) -> float:
+        self.simulation.clock.io_delay(W1_CONVERSION_TIME)
+        self.simulation.check_fault(self.id, FakeSensorNotReadyError(f"Sensor {self.id} is not yet ready to read temperature"))
+        # 12-bit resolution
+        return round(self.simulation.model.temperature(self.role) * 16) / 16
+
+
+class FakeW1Bus:
+    """Replacement for w1bus.py, the kernel bulk conversion interface."""
+
+    def __init__(self, simulation: 'Simulation'):
+        self.simulation = simulation
+        self.triggers = 0
+        self._ready_at = None
+        self._values: Dict[str, float] = {}
+
+    def bulk_convert_supported(self) -> bool:
+        return True
+
+    def trigger_bulk_conversion(self) -> None:
+        model = self.simulation.model
+        self.simulation.check_fault('w1_bulk', OSError("Bulk conversion trigger failed"))
+        self.triggers += 1
+        self._ready_at = self.simulation.clock.time() + W1_CONVERSION_TIME
+        self._values = {
+            sensor_id: round(model.temperature(role) * 16) / 16
+            for sensor_id, role in self.simulation.probes.items()
+        }
+
+    def read_converted(self, sensor_id: str) -> float:
+        if sensor_id not in self.simulation.probes:
+            raise OSError(f"No w1 device found with id {sensor_id}")
+        if self._ready_at is None:
+            raise OSError("No bulk conversion triggered")
+        self.simulation.clock.io_delay(self._ready_at - self.simulation.clock.time())
+        self.simulation.check_fault(sensor_id, OSError(f"CRC check failed for w1 device {sensor_id}"))
+        return self._values[sensor_id]
+
+
+class FakeSMBus:
+    """Replacement for smbus.SMBus with a BH1750 at address 0x23."""
+
+    simulation: 'Simulation' = None
+    BH1750_ADDRESS = 0x23
+
+    def __init__(self, bus: int = 1):
+        self.bus = bus
+        self.reads = 0
+        self.mtreg = 69
+        self.mode = None
+
+    def _check_address(self, addr: int) -> None:
+        if addr != self.BH1750_ADDRESS:
+            raise IOError(121, 'Remote I/O error')
+
+    def write_byte(self, addr: int, value: int) -> None:
+        self._check_address(addr)
+        if value & 0xF8 == 0x40:
+            self.mtreg = (self.mtreg & 0x1F) | ((value & 0x07) << 5)
+        elif value & 0xE0 == 0x60:
+            self.mtreg = (self.mtreg & 0xE0) | (value & 0x1F)
+        elif value in (0x10, 0x11, 0x13, 0x20, 0x21, 0x23):
+            self.mode = value
+
+    def read_i2c_block_data(self, addr: int, cmd: int, length: int = 32) -> List[int]:
+        self._check_address(addr)
+        if cmd in (0x20, 0x21, 0x23):
+            # One-time modes measure on request
+            self.simulation.clock.io_delay(BH1750_MEASUREMENT_TIME)
+        self.simulation.check_fault('light', IOError(121, 'Remote I/O error'))
+        self.reads += 1
+        counts = self.simulation.model.light() * 1.2 * self.mtreg / 69
+        if cmd in (0x11, 0x21):
+            counts *= 2
+        raw = min(int(counts), 0xFFFF)
+        return ([raw >> 8, raw & 0xFF] + [0] * 30)[:length]
+
+
+class FakeTM1637:
+    """Replacement for tm1637.TM1637 that records what would be shown."""
+
+    simulation: 'Simulation' = None
+
+    def __init__(self, clk: int, dio: int, brightness: int = 7):
+        self.clk = clk
+        self.dio = dio
+        self._brightness = brightness
+        self.text = None
+        self.segments = bytes(4)
+        self.writes = 0
+        self.simulation.displays.append(self)
+
+    def brightness(self, val: Optional[int] = None) -> int:
+        if val is not None:
+            self._brightness = val
+        return self._brightness
+
+    def write(self, segments, pos: int = 0) -> None:
+        self.simulation.clock.io_delay(TM1637_TRANSFER_TIME)
+        if not isinstance(segments, str):
+            self.segments = self.segments[:pos] + bytes(segments) + self.segments[pos + len(segments):]
+        self.writes += 1
+
+    def show(self, string: str, colon: bool = False) -> None:
+        self.write(string)
+        self.text = string
+
+
+class FakeTBPublishInfo:
+    TB_ERR_SUCCESS = 0
+    TB_ERR_NO_CONN = 4
+
+    def __init__(self, rc: int):
+        self._rc = rc
+
+    def rc(self) -> int:
+        return self._rc
+
+    def get(self) -> int:
+        return self._rc
+
+
+class FakeBroker:
+    """ThingsBoard MQTT stand-in: keeps the telemetry it receives.
+
+    Set `online` to False to simulate an outage and `latency` for the
+    time each publish takes to be acknowledged.
+    """
+
+    def __init__(self, clock: Any, latency: float = 0.05):
+        self.clock = clock
+        self.latency = latency
+        self.online = True
+        self.telemetry: List[Dict[str, Any]] = []
+        self.messages = 0
+
+
+class FakeTBDeviceMqttClient:
+    """Replacement for tb_device_mqtt.TBDeviceMqttClient publishing to a FakeBroker."""
+
+    simulation: 'Simulation' = None
+
+    def __init__(self, host: str, port: int = 1883, username: Optional[str] = None, **kwargs):
+        self.host = host
+        self.port = port
+        self.username = username
+        self._connected = False
+
+    def connect(self, timeout: float = 120, **kwargs) -> None:
+        broker = self.simulation.broker
+        if not broker.online:
+            self.simulation.clock.io_delay(timeout)
+            raise ConnectionRefusedError(111, 'Connection refused')
+        self.simulation.clock.io_delay(broker.latency)
+        self._connected = True
+
+    def is_connected(self) -> bool:
+        if not self.simulation.broker.online:
+            self._connected = False
+        return self._connected
+
+    def disconnect(self) -> None:
+        self._connected = False
+
+    def send_telemetry(self, telemetry: Any, quality_of_service: Optional[int] = None,
+                       wait_for_publish: bool = False) -> FakeTBPublishInfo:
+        broker = self.simulation.broker
+        if not self.is_connected():
+            return FakeTBPublishInfo(FakeTBPublishInfo.TB_ERR_NO_CONN)
+        self.simulation.clock.io_delay(broker.latency)
+        if isinstance(telemetry, str):
+            telemetry = json.loads(telemetry)
+        broker.telemetry.extend(telemetry if isinstance(telemetry, list) else [telemetry])
+        broker.messages += 1
+        return FakeTBPublishInfo(FakeTBPublishInfo.TB_ERR_SUCCESS)
+
+
+class _Namespace:
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+
+class Simulation:
+    """Fake drivers, a virtual clock and a pool model sharing one timeline."""
+
+    def __init__(self, config: Dict[str, Any], clock: Any = None, seed: int = 0):
+        self.config = config
+        self.clock = VirtualClock() if clock is None else clock
+        self.model = PoolModel(self.clock, seed)
+        self.relay_pin = config['gpio']['pump_relay_pin']
+        # Sensor id -> role in the pool model, the probes of every zone follow the same model
+        roles = {name: role for zone in config.get('zones', {}).values() for role, name in zone['sensors'].items()}
+        self.probes = {
+            info['id']: roles.get(info.get('name'), key)
+            for key, info in config['sensors']['temperature']['displays'].items()
+            if 'id' in info
+        }
+        # Sensor id, or 'light' -> 'fail' or 'hang', the sensors currently faulty
+        self.faults: Dict[str, str] = {}
+        self.displays: List[FakeTM1637] = []
+        self.gpio = FakeGPIO(self)
+        bound = {'simulation': self}
+        self.w1thermsensor = _Namespace(
+            W1ThermSensor=type('W1ThermSensor', (FakeW1ThermSensor,), bound),
+            NoSensorFoundError=FakeNoSensorFoundError,
+            SensorNotReadyError=FakeSensorNotReadyError,
+        )
+        self.w1bus = FakeW1Bus(self)
+        self.smbus = _Namespace(SMBus=type('SMBus', (FakeSMBus,), bound))
+        self.tm1637 = _Namespace(TM1637=type('TM1637', (FakeTM1637,), bound))
+        self.broker = FakeBroker(self.clock)
+        self.tb_device_mqtt = _Namespace(
+            TBDeviceMqttClient=type('TBDeviceMqttClient', (FakeTBDeviceMqttClient,), bound),
+            TBPublishInfo=FakeTBPublishInfo,
+        )
+
+    @classmethod
+    def from_config_file(cls, file_path: str, **kwargs) -> 'Simulation':
+        with open(file_path, 'r') as f:
+            return cls(json.load(f), **kwargs)
+
+    def drivers(self) -> Dict[str, Any]:
+        return {
+            'GPIO': self.gpio,
+            'w1thermsensor': self.w1thermsensor,
+            'w1bus': self.w1bus,
+            'smbus': self.smbus,
+            'tm1637': self.tm1637,
+            'tb_device_mqtt': self.tb_device_mqtt,
+            'clock': self.clock,
+        }
+
+    def install(self) -> 'Simulation':
+        hardware.install(self.drivers())
+        return self
+
+    def sensor_key(self, name: str) -> str:
+        """Key in `faults` of a sensor given by its name in the config, 'light' or 'w1_bulk'."""
+        if name in ('light', 'w1_bulk'):
+            return name
+        for info in self.config['sensors']['temperature']['displays'].values():
+            if info.get('name') == name and 'id' in info:
+                return info['id']
+        raise ValueError(f"Unknown sensor '{name}'")
+
+    def check_fault(self, key: str, error: Exception) -> None:
+        """Called by the fake drivers on each read: raises `error` while the sensor fails.
+
+        A hanging sensor blocks the read until the fault ends, and then fails it.
+        """
+        fault = self.faults.get(key)
+        if fault is None:
+            return
+        while self.faults.get(key) == 'hang':
+            self.clock.io_delay(1.0)
+        raise error
+
+    def pump_runtime(self, until: float) -> Dict[str, float]:
+        """Relay ON time and number of ON transitions up to `until`."""
+        runtime = 0.0
+        cycles = 0
+        on_since = None
+        for t, channel, value in self.gpio.transitions:
+            if channel != self.relay_pin:
+                continue
+            if value == FakeGPIO.HIGH and on_since is None:
+                on_since = t
+                cycles += 1
+            elif value == FakeGPIO.LOW and on_since is not None:
+                runtime += t - on_since
+                on_since = None
+        if on_since is not None:
+            runtime += until - on_since
+        return {'runtime': runtime, 'cycles': cycles}
+
+
+def run_start_system(config_file: str, hours: float, start: Optional[float] = None,
+                     seed: int = 0, presses: Optional[List[Any]] = None,
+                     outages: Optional[List[Any]] = None, faults: Optional[List[Any]] = None) -> Dict[str, Any]:
+    """Run start_system.PoolControlSystem against simulated hardware.
+
+    `presses` is a list of (hours after start, 'B1' or 'B2') button presses,
+    `outages` a list of (start hours, end hours) when the broker is down,
+    `faults` a list of (start hours, end hours, sensor name, 'fail' or 'hang').
+    Returns the loop timing of every thread and the pump statistics.
+    """
+    with open(config_file, 'r') as f:
+        config = json.load(f)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config = copy.deepcopy(config)
+        config['error_logging']['log_directory'] = os.path.join(work_dir, 'logs')
+        config.setdefault('thingsboard', {}).update(enabled=True, host='localhost', port=1883, access_token='simulator')
+        # Any free port, the endpoint is scraped once at the end
+        config['metrics'] = {'enabled': True, 'host': '127.0.0.1', 'port': 0}
+        config['status_api'] = {'enabled': True, 'host': '127.0.0.1', 'port': 0}
+        sim_config_file = os.path.join(work_dir, 'config.json')
+        with open(sim_config_file, 'w') as f:
+            json.dump(config, f, indent=2)
+
+        clock = VirtualClock(start)
+        simulation = Simulation(config, clock=clock, seed=seed).install()
+        begin = clock.time()
+        end = begin + hours * 3600
+
+        def press_buttons():
+            for at, button in sorted(presses or []):
+                clock.io_delay(begin + at * 3600 - clock.time())
+                simulation.gpio.press(config['gpio'][f'button_{button.lower()}_pin'])
+
+        def broker_outages():
+            for down, up in sorted(outages or []):
+                clock.io_delay(begin + down * 3600 - clock.time())
+                simulation.broker.online = False
+                clock.io_delay(begin + up * 3600 - clock.time())
+                simulation.broker.online = True
+
+        def sensor_fault(down, up, key, mode):
+            clock.io_delay(begin + down * 3600 - clock.time())
+            simulation.faults[key] = mode
+            clock.io_delay(begin + up * 3600 - clock.time())
+            simulation.faults.pop(key, None)
+
+        import start_system
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            system = start_system.PoolControlSystem(sim_config_file)
+            runner = threading.Thread(target=system.run, name='run')
+            runner.start()
+            threading.Thread(target=press_buttons, name='sim_buttons', daemon=True).start()
+            threading.Thread(target=broker_outages, name='sim_broker', daemon=True).start()
+            for down, up, name, mode in faults or []:
+                threading.Thread(target=sensor_fault, args=(down, up, simulation.sensor_key(name), mode),
+                                 name=f'sim_fault_{name}', daemon=True).start()
+            clock.advance(end)
+            threads = sorted(t.name for t in threading.enumerate() if not t.name.startswith('sim_'))
+            metrics = scrape_metrics(system.metrics_server)
+            system.stop()
+            clock.advance(alive=runner.is_alive)
+            runner.join()
+            # Its files are in work_dir
+            system.log_pipeline.stop()
+
+    loops = {}
+    for name, stats in clock.loop_stats.items():
+        iterations = stats['iterations']
+        if iterations == 0:
+            continue
+        loops[name] = {
+            'iterations': iterations,
+            'period_mean': stats['period_total'] / iterations,
+            'period_max': stats['period_max'],
+            'busy_mean': stats['busy_total'] / iterations,
+            'busy_max': stats['busy_max'],
+        }
+    for name, job in system.scheduler.jobs.items():
+        if job.interval is None or job.runs < 2:
+            continue
+        loops[name] = {
+            'iterations': job.runs,
+            'period_mean': job.period_total / (job.runs - 1),
+            'period_max': job.period_max,
+            'busy_mean': job.busy_total / job.runs,
+            'busy_max': job.busy_max,
+            'skipped': job.skipped,
+        }
+    return {
+        'simulated_seconds': end - begin,
+        'loops': loops,
+        'threads': threads,
+        'pump': simulation.pump_runtime(end),
+        'display_writes': sum(d.writes for d in simulation.displays),
+        'display_stats': system.lcd_manager.stats,
+        'button_latency': system.button_input.latency,
+        'state_flushes': system.state.flushes,
+        'window_flushes': system.windows.flushes,
+        'history_rows': system.timeseries.rows_written,
+        'telemetry': dict(system.telemetry.stats, received=len(simulation.broker.telemetry)),
+        'output_lines': output.getvalue().count('\n'),
+        'metrics': metrics,
+        'status_updates': system.status_api.board.version,
+    }
+
+
+def scrape_metrics(server) -> Dict[str, float]:
+    """Fetch the metrics endpoint, samples keyed by name and labels as written."""
+    with urllib.request.urlopen(f"http://{server.host}:{server.port}/metrics", timeout=10) as response:
+        text = response.read().decode('utf-8')
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            samples[name] = float(value)
+    return samples
+
+
+def mean_times(metrics: Dict[str, float], name: str) -> Dict[str, tuple]:
+    """Label -> (count, mean seconds) of a histogram with a single label."""
+    means = {}
+    for sample, total in metrics.items():
+        if sample.startswith(f"{name}_sum{{"):
+            labels = sample[len(name) + 4:]
+            count = metrics[f"{name}_count{labels}"]
+            means[labels.split('"')[1]] = (int(count), total / count if count else 0.0)
+    return means
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pool controller against simulated hardware")
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--hours', type=float, default=24.0, help="simulated duration")
+    parser.add_argument('--start', default=None, help="simulated start time, YYYY-mm-dd HH:MM (default: now)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--press', action='append', default=[], metavar='HOURS:BUTTON',
+                        help="press a button, e.g. 8.5:B1 (repeatable)")
+    parser.add_argument('--outage', action='append', default=[], metavar='HOURS:HOURS',
+                        help="broker unreachable between two times, e.g. 2:3.5 (repeatable)")
+    parser.add_argument('--fault', action='append', default=[], metavar='HOURS:HOURS:SENSOR[:hang]',
+                        help="sensor failing between two times, or hanging with :hang, "
+                             "e.g. 1:2:pool_water, 0.5:1:light:hang or 1:1.1:w1_bulk (repeatable)")
+    args = parser.parse_args()
+
+    start = time.mktime(time.strptime(args.start, "%Y-%m-%d %H:%M")) if args.start else None
+    presses = []
+    for press in args.press:
+        at, button = press.split(':')
+        presses.append((float(at), button.upper()))
+
+    outages = [tuple(float(at) for at in outage.split(':')) for outage in args.outage]
+    faults = []
+    for fault in args.fault:
+        down, up, name, *mode = fault.split(':')
+        faults.append((float(down), float(up), name, mode[0] if mode else 'fail'))
+
+    result = run_start_system(args.config, args.hours, start, args.seed, presses, outages, faults)
+
+    print(f"Simulated {result['simulated_seconds'] / 3600:.2f} h")
+    for name, loop in sorted(result['loops'].items()):
+        print(f"  {name:<16} iterations: {loop['iterations']:>7} | period mean: {loop['period_mean']:.3f} s "
+              f"max: {loop['period_max']:.3f} s | busy mean: {loop['busy_mean']:.3f} s max: {loop['busy_max']:.3f} s"
+              + (f" | skipped: {loop['skipped']}" if loop.get('skipped') else ""))
+    print(f"Threads: {len(result['threads'])} ({', '.join(result['threads'])})")
+    print(f"Pump runtime: {result['pump']['runtime'] / 3600:.2f} h in {result['pump']['cycles']} cycles")
+    print(f"Display writes: {result['display_writes']}")
+    for key, stats in sorted(result['display_stats'].items()):
+        print(f"  display {key}: {stats['writes']} writes, {stats['skipped']} unchanged skipped, {stats['time']:.2f} s writing")
+    print(f"Runtime state writes: {result['state_flushes']}, rolling window writes: {result['window_flushes']}")
+    print(f"Status updates pushed: {result['status_updates']}")
+    print(f"History rows written: {result['history_rows']}")
+    telemetry = result['telemetry']
+    print(f"Telemetry: {telemetry['published']} samples published, {telemetry['received']} received by the broker, "
+          f"{telemetry['spooled']} batches spooled, {telemetry['replayed']} replayed, {telemetry['dropped']} samples dropped")
+    for title, name in (("Stage", 'pipool_stage_seconds'), ("Sensor read", 'pipool_sensor_read_seconds'),
+                        ("Display write", 'pipool_display_write_seconds')):
+        for label, (count, mean) in sorted(mean_times(result['metrics'], name).items()):
+            print(f"{title} {label}: {count} times, mean {mean * 1000:.2f} ms")
+    errors = {sample: value for sample, value in result['metrics'].items()
+              if sample.startswith('pipool_sensor_read_errors_total') and value}
+    print(f"Sensor read errors: {sum(errors.values()):.0f}")
+    for sample, value in sorted(errors.items()):
+        trips = result['metrics'].get(sample.replace('read_errors', 'breaker_trips'), 0)
+        sensor = sample.split('"')[1]
+        print(f"  {sensor}: {value:.0f} errors, breaker opened {trips:.0f} times")
+    for name, latency in sorted(result['button_latency'].items()):
+        if latency['count']:
+            print(f"Button {name}: {latency['count']} presses, press to relay mean: "
+                  f"{latency['total'] / latency['count'] * 1000:.2f} ms max: {latency['max'] * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
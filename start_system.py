@@ -1,224 +1,290 @@
-import json
-import os
-import time
 import threading
+import time
 import logging
-import RPi.GPIO as GPIO
-from typing import Dict, Any
-from sensor import SensorManager, load_config
+from typing import Callable, Any, Optional
+from hardware import GPIO, clock
+from sensor import SensorManager
+from pool_config import LIGHT_SENSOR, ConfigError, ConfigWatcher, PoolConfig
+from state_store import RuntimeStateStore
+from sensor_hub import SensorHub, SensorSnapshot
 from lcd_display import LCDManager
+from button_input import ButtonInput
+from timeseries import TimeSeriesStore
+from thingsboard import TelemetryPublisher, telemetry_values
+from scheduler import Scheduler
+from metrics import REGISTRY, Counter, MetricsServer, scheduler_collector, time_log_handlers
+from diagnostics import Diagnostics
+from log_pipeline import CONSOLE_LOGGER, setup_logging
+from status_api import StatusServer
+from zones import ControllerStatus, ZoneController
 
-class ConfigError(Exception):
-    pass
+# Named after the module, __name__ is __main__ when it runs as a script
+logger = logging.getLogger('start_system')
+console = logging.getLogger(CONSOLE_LOGGER)
 
-def write_config(config: Dict[str, Any], file_path: str) -> None:
-    with open(file_path, 'w') as file:
-        json.dump(config, file, indent=2)
 
 class PoolControlSystem:
     def __init__(self, config_file: str):
         self.config_file = config_file
-        self.config = load_config(config_file)
-        self.temperatures = {'temp_E': 0.0, 'temp_A': 0.0, 'temp_S': 0.0, 'light': 0.0}
-        self.history = []
-        self.countdown_active = True
-        self.countdown_start_time = time.time()
-        self.last_button_pressed = None
-        self.last_action_reason = "System initialized"
+        self.config_watcher = ConfigWatcher(config_file)
+        self.config_watcher.listeners.append(self.apply_config)
+        # First, so the other components log through it from their construction on
+        self.setup_logging()
+        time_log_handlers()
+        self.state = RuntimeStateStore.from_config(self.config, config_file)
+        self.windows = RuntimeStateStore.windows_from_config(self.config, config_file)
+        self.timeseries = TimeSeriesStore.from_config(self.config, config_file)
+        self.scheduler = Scheduler()
+        self.status_api = StatusServer.from_config(self.config)
+        self._status_api_lock = threading.Lock()
+        # The first zone is the one of a single zone installation, the methods below act on it
+        self.zones = [ZoneController(self, zone, primary=index == 0) for index, zone in enumerate(self.config.zones)]
+        self.primary = self.zones[0]
         self.lcd_manager = LCDManager(self.config)
         self.sensor_manager = SensorManager(self.config)
+        self.sensor_hub = SensorHub(self.read_sensors, stale=self.sensor_manager.stale_sensors)
+        max_age = self.config.max_age
+        self.display_sensors = self.sensor_hub.subscribe('display', max_age.get('display'), callback=self.show_sensor_data)
+        self.control_sensors = self.sensor_hub.subscribe('control', max_age.get('control'))
+        self.log_sensors = self.sensor_hub.subscribe('log', max_age.get('log'))
+        self.sensor_hub.subscribe('history', callback=self.record_sample)
+        self.telemetry = TelemetryPublisher.from_config(self.config, config_file)
+        if self.telemetry is not None:
+            self.sensor_hub.subscribe('telemetry', callback=self.publish_telemetry)
+        if self.status_api is not None:
+            self.sensor_hub.subscribe('status_api', callback=self.push_sensor_status)
+        self.metrics_server = MetricsServer.from_config(self.config)
+        self.diagnostics = Diagnostics.from_config(self.config)
         self.running = True
 
-        self.setup_logging()
+        if self.diagnostics is not None:
+            self.diagnostics.install_signals()
+            if self.metrics_server is not None:
+                self.diagnostics.add_routes(self.metrics_server)
         self.setup_gpio()
+        self.button_input = ButtonInput(self.config.debounce_ms, self.report_button_latency)
+        for zone in self.zones:
+            zone.add_buttons(self.button_input)
+            zone.publish(countdown=zone.initial_countdown())
+
+    @property
+    def config(self) -> PoolConfig:
+        """Current configuration, reloaded when config.json changes."""
+        return self.config_watcher.get()
+
+    @property
+    def status(self) -> ControllerStatus:
+        return self.primary.status
+
+    @property
+    def countdown_timer(self):
+        return self.primary.countdown_timer
+
+    @property
+    def last_action_reason(self) -> str:
+        return self.status.last_action_reason
+
+    @property
+    def last_button_pressed(self) -> Optional[str]:
+        return self.status.last_button_pressed
+
+    @property
+    def countdown_active(self) -> bool:
+        return self.status.countdown_active
+
+    def publish(self, when: Optional[Callable[[ControllerStatus], bool]] = None, **changes: Any) -> Optional[ControllerStatus]:
+        """Change the status of the first zone, see ZoneController.publish."""
+        return self.primary.publish(when, **changes)
+
+    def apply_config(self, config: PoolConfig):
+        # Pins and sensor ids are only read at startup
+        self.log_pipeline.apply_levels(config.logging)
+        for name, interval in (('sensors', config.update_interval), ('log_status', config.log_interval)):
+            job = self.scheduler.jobs.get(name)
+            if job is not None:
+                job.interval = interval
+        for subscription in (self.display_sensors, self.control_sensors, self.log_sensors):
+            subscription.max_age = config.max_age.get(subscription.name)
 
     def setup_logging(self):
         log_output = self.config.get('log_output', 'file')
-        
-        if log_output == 'file' and self.config['error_logging']['enabled']:
-            log_dir = self.config['error_logging']['log_directory']
-            os.makedirs(log_dir, exist_ok=True)
-            log_file = os.path.join(log_dir, 'pool_control.log')
-            logging.basicConfig(
-                filename=log_file,
-                level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s'
-            )
-        elif log_output == 'terminal':
-            logging.basicConfig(
-                level=logging.INFO,
-                format='%(asctime)s - %(levelname)s - %(message)s'
-            )
-        else:
+        if log_output not in ('file', 'terminal'):
             raise ConfigError("Invalid log_output value. It should be either 'file' or 'terminal'.")
+        self.log_pipeline = setup_logging(self.config, 'pool_control.log', log_output)
 
     def setup_gpio(self):
         GPIO.setmode(GPIO.BCM)
         GPIO.setwarnings(False)
-        GPIO.setup(self.config['gpio']['button_b1_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.config['gpio']['button_b2_pin'], GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.setup(self.config['gpio']['pump_relay_pin'], GPIO.OUT)
-
-        if self.config['relay_state'] == "ON":
-            GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.HIGH)
-        else:
-            GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
+        for zone in self.zones:
+            zone.setup_gpio()
 
     def log_status(self):
-        while self.running:
+        config = self.config
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime())
+        snapshot = self.log_sensors.get()
+        if snapshot is None:
+            logger.warning("No recent sensor data to log")
+        temperatures = snapshot.temperatures if snapshot is not None else None
+        light = snapshot.light if snapshot is not None else None
+        stale = snapshot.stale if snapshot is not None else frozenset()
+        # A zone that fails to log does not keep the others from logging
+        for zone in self.zones:
             try:
-                logging.info("Logging status thread is running")
-                timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-                self.history.append(self.temperatures.copy())
-
-                if len(self.history) > self.config['average_samples']:
-                    self.history.pop(0)
-
-                avg_temps = {key: sum(h[key] for h in self.history) / len(self.history) for key in self.temperatures if key != 'temp_A'}
-                delta_temp = self.temperatures['temp_S'] - self.temperatures['temp_E']
-
-                log_message = (
-                    f"{timestamp} | RELAY: {self.config['relay_state']} - [Reason: {self.last_action_reason}] "
-                    f"| Temp. Entrée: {self.temperatures['temp_E']:.2f} - Moyenne: {avg_temps['temp_E']:.2f} "
-                    f"| Temp. Sortie: {self.temperatures['temp_S']:.2f} - Moyenne: {avg_temps['temp_S']:.2f} "
-                    f"| Delta Temp: {delta_temp:.2f} "
-                    f"| Temp. Air: {self.temperatures['temp_A']:.2f} "
-                    f"| Luminosité: {self.temperatures['light']:.2f} - Moyenne: {avg_temps['light']:.2f} "
-                    f"| Last Button Pressed: {self.last_button_pressed}"
-                )
-                logging.info(log_message)
-                print(log_message)
-
-                if self.countdown_active:
-                    time_left = self.config['water_replace_time'] - (time.time() - self.countdown_start_time)
-                    if time_left > 0:
-                        logging.info(f"Water Replace Time Left: {time_left:.2f} seconds")
-                    else:
-                        self.countdown_active = False
-                        self.last_action_reason = "Water replacement time ended. Switching to normal control logic."
-                        logging.info(self.last_action_reason)
-
-                if self.config['relay_state'] == "ON":
-                    if self.last_button_pressed == "B1":
-                        self.last_action_reason = "Pump started by Button B1"
-                    elif self.last_button_pressed == "B2":
-                        self.last_action_reason = "Pump stopped by Button B2"
-                elif self.config['relay_state'] == "OFF":
-                    self.last_action_reason = "Pump stopped (automatic control)"
-                
-                time.sleep(self.config['log_interval'])
-
+                zone.log_status(timestamp, temperatures, light, config.average_samples, stale)
             except KeyError as e:
-                logging.error(f"Missing key in temperatures or config: {e}")
+                logger.error(f"Missing key in temperatures or config: {e}")
             except Exception as e:
-                logging.error(f"Error in log_status: {e}")
+                logger.error(f"Error in log_status: {e}")
+
+    def save_averages(self):
+        for zone in self.zones:
+            zone.save_averages()
 
     def button_b1_action(self):
-        self.last_button_pressed = "B1"
-        self.config['relay_state'] = "ON"
-        self.config['last_pump_start_time'] = time.time()
-        self.config['button_b1_last_pressed'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        write_config(self.config, self.config_file)
-        GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.HIGH)
-        self.countdown_active = True
-        self.countdown_start_time = time.time()
-        self.last_action_reason = "Button B1 pressed"
-        logging.info("Pump started/restarted by B1")
+        self.primary.button_b1_action()
 
     def button_b2_action(self):
-        self.last_button_pressed = "B2"
-        self.config['relay_state'] = "OFF"
-        self.config['button_b2_last_pressed'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-        write_config(self.config, self.config_file)
-        GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
-        self.countdown_active = False
-        self.last_action_reason = "Button B2 pressed"
-        logging.info("Pump stopped by B2")
-
-    def button_handler(self, button_pin, action):
-        while self.running:
-            if GPIO.input(button_pin) == GPIO.LOW:
-                action()
-                time.sleep(0.3)  # Debounce delay
-
-    def sensor_loop(self):
-        while self.running:
-            try:
-                temp_data = self.sensor_manager.get_temperature_data()
-                light_level = self.sensor_manager.get_light_level()
-                self.temperatures.update(temp_data)
-                self.temperatures['light'] = light_level
-                self.lcd_manager.update_displays(self.temperatures)
+        self.primary.button_b2_action()
 
-                # Ajouter un print pour vérifier les données des capteurs
-                print(f"Températures: {self.temperatures}, Niveau de lumière: {light_level}")
+    def start_countdown(self, duration: Optional[float] = None) -> int:
+        return self.primary.start_countdown(duration)
 
-            except Exception as e:
-                logging.error(f"Error reading sensor data: {e}")
-            time.sleep(self.config['sensors']['temperature']['update_interval'])
+    def stop_countdown(self):
+        self.primary.stop_countdown()
+
+    def end_countdown(self, countdown: int):
+        self.primary.end_countdown(countdown)
+
+    def report_button_latency(self, name: str, latency: float):
+        logger.info(f"Button {name} handled {latency * 1000:.1f} ms after the press")
+
+    def read_sensors(self):
+        return self.sensor_manager.get_temperature_data(), self.sensor_manager.get_light_level()
+
+    def record_sample(self, snapshot: SensorSnapshot):
+        sensor_keys = self.config.sensor_keys
+        # A last known value is not a measurement, the history keeps a gap
+        stale = snapshot.stale
+        values = {sensor_keys[name]: None if name in stale else value for name, value in snapshot.temperatures.items()}
+        values['light'] = None if LIGHT_SENSOR in stale else snapshot.light
+        self.timeseries.add_sample(snapshot.timestamp, values)
 
-    def control_loop(self):
-        while self.running:
+    def publish_telemetry(self, snapshot: SensorSnapshot):
+        values = telemetry_values(self.config, snapshot.temperatures, snapshot.light)
+        values['relay'] = self.status.relay_state
+        for zone in self.zones[1:]:
+            values[f'relay_{zone.name}'] = zone.status.relay_state
+        self.telemetry.publish(values, snapshot.timestamp)
+
+    def push_sensor_status(self, snapshot: SensorSnapshot):
+        # Whole lux, the BH1750 resolution, so a steady light does not push a new status every read
+        light = round(snapshot.light) if snapshot.light is not None else None
+        self.status_api.update(snapshot.timestamp, temperatures=dict(snapshot.temperatures), light=light,
+                               stale=sorted(snapshot.stale))
+
+    def push_zone_status(self):
+        """Called by the zones after each status change."""
+        if self.status_api is None:
+            return
+        # Read and sent under one lock, so the last push carries the latest status of every zone
+        with self._status_api_lock:
+            self.status_api.update(clock.time(), zones={
+                zone.name: {
+                    'relay_state': status.relay_state,
+                    'last_button_pressed': status.last_button_pressed,
+                    'countdown_active': status.countdown_active,
+                    'last_action_reason': status.last_action_reason,
+                }
+                for zone, status in ((zone, zone.status) for zone in self.zones)
+            })
+
+    def show_sensor_data(self, snapshot: SensorSnapshot):
+        self.lcd_manager.update_displays(snapshot.temperatures)
+
+        # Afficher les données des capteurs, écrites par le thread des logs
+        console.info("Températures: %s, Niveau de lumière: %s", dict(snapshot.temperatures), snapshot.light)
+
+    def collect_metrics(self):
+        """Counters kept by the components, turned into metrics when scraped."""
+        acquisitions = Counter('pipool_sensor_acquisitions_total', "Sensor acquisitions made by the hub")
+        acquisitions.inc(self.sensor_hub.reads)
+        display_writes = Counter('pipool_display_updates_total', "Display updates, written or skipped when unchanged", ('display', 'result'))
+        for key, stats in self.lcd_manager.stats.items():
+            display_writes.labels(key, 'written').inc(stats['writes'])
+            display_writes.labels(key, 'skipped').inc(stats['skipped'])
+        metrics = [acquisitions, display_writes]
+        if self.telemetry is not None:
+            telemetry = Counter('pipool_telemetry_total', "Telemetry samples and batches by outcome", ('event',))
+            for event, count in self.telemetry.stats.items():
+                telemetry.labels(event).inc(count)
+            metrics.append(telemetry)
+        return metrics
+
+    def control_step(self):
+        # One snapshot for every zone, the zones share the probes' acquisition
+        snapshot = self.control_sensors.get()
+        if snapshot is None:
+            logger.warning("No recent sensor data, keeping relay state")
+            return
+        # A zone that fails does not keep the others from deciding
+        for zone in self.zones:
             try:
-                if not self.countdown_active:
-                    delta_temp = self.temperatures['temp_S'] - self.temperatures['temp_E']
-                    
-                    if self.last_button_pressed == "B2":
-                        if self.config['relay_state'] != "OFF":
-                            self.config['relay_state'] = "OFF"
-                            GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
-                            self.last_action_reason = "Pump stopped by B2 (overrides all other conditions)"
-                            logging.info(self.last_action_reason)
-                    elif self.temperatures['light'] >= self.config['light_threshold']:
-                        if delta_temp >= self.config['temp_delta_threshold']:
-                            if self.config['relay_state'] != "ON":
-                                self.config['relay_state'] = "ON"
-                                GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.HIGH)
-                                self.last_action_reason = f"Pump started: Light level ({self.temperatures['light']:.2f}) above threshold and delta temperature ({delta_temp:.2f}) above threshold"
-                                logging.info(self.last_action_reason)
-                        else:
-                            if self.config['relay_state'] != "OFF":
-                                self.config['relay_state'] = "OFF"
-                                GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
-                                self.last_action_reason = f"Pump stopped: Light level ({self.temperatures['light']:.2f}) above threshold but delta temperature ({delta_temp:.2f}) below threshold"
-                                logging.info(self.last_action_reason)
-                    else:
-                        if self.config['relay_state'] != "OFF":
-                            self.config['relay_state'] = "OFF"
-                            GPIO.output(self.config['gpio']['pump_relay_pin'], GPIO.LOW)
-                            self.last_action_reason = f"Pump stopped: Light level ({self.temperatures['light']:.2f}) below threshold"
-                            logging.info(self.last_action_reason)
-                    
-                    write_config(self.config, self.config_file)
-                else:
-                    self.last_action_reason = "Water replacement in progress"
+                zone.control_step(snapshot.temperatures, snapshot.light)
             except Exception as e:
-                logging.error(f"Error in control_loop: {e}")
-            
-            time.sleep(10)
+                logger.error("Error in control_step of zone %s: %s", zone.name, e)
+
+    def first_acquisition(self):
+        self.sensor_hub.acquire()
+        self.control_step()
 
     def run(self):
         """Run the pool control system."""
-        threads = [
-            threading.Thread(target=self.sensor_loop),
-            threading.Thread(target=self.control_loop),
-            threading.Thread(target=self.button_handler, args=(self.config['gpio']['button_b1_pin'], self.button_b1_action)),
-            threading.Thread(target=self.button_handler, args=(self.config['gpio']['button_b2_pin'], self.button_b2_action)),
-            threading.Thread(target=self.log_status)
-        ]
+        config = self.config
+        # The first readings are acquired and acted on at once, the periodic jobs follow
+        self.scheduler.call_later('first_acquisition', 0, self.first_acquisition, blocking=True)
+        self.scheduler.every('sensors', config.update_interval, self.sensor_hub.acquire, delay=config.update_interval,
+                             blocking=True)
+        # A register read, the light level of each acquisition is the mean of these polls
+        self.scheduler.every('light', self.sensor_manager.light_sensor.measurement_time(), self.sensor_manager.poll_light)
+        self.scheduler.every('control', 10, self.control_step, delay=config.update_interval)
+        self.scheduler.every('log_status', config.log_interval, self.log_status, delay=config.update_interval)
+        # The averages change on every tick, the state file gets them now and then
+        save_interval = self.windows.min_fsync_interval
+        self.scheduler.every('save_averages', save_interval, self.save_averages, delay=save_interval)
 
-        for thread in threads:
-            thread.start()
+        REGISTRY.add_collector('scheduler', scheduler_collector(self.scheduler))
+        REGISTRY.add_collector('pool_control', self.collect_metrics)
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.status_api is not None:
+            self.status_api.start()
+        self.state.start()
+        self.windows.start()
+        self.timeseries.start()
+        if self.telemetry is not None:
+            self.telemetry.start()
+        self.button_input.start()
 
         try:
-            while True:
-                time.sleep(1)
+            self.scheduler.run()
         except KeyboardInterrupt:
             print("Shutting down...")
-            self.running = False
+            self.stop()
+        self.button_input.stop()
+        self.save_averages()
+        self.state.close()
+        self.windows.close()
+        self.timeseries.close()
+        if self.telemetry is not None:
+            self.telemetry.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.status_api is not None:
+            self.status_api.stop()
 
-        for thread in threads:
-            thread.join()
+    def stop(self):
+        self.running = False
+        self.scheduler.stop()
 
 def main():
     try:
@@ -230,7 +296,7 @@ def main():
         print("Program terminated by user")
     except Exception as e:
         print(f"An unexpected error occurred: {e}")
-        logging.exception("An unexpected error occurred")
+        logger.exception("An unexpected error occurred")
     finally:
         if GPIO.getmode() is not None:
             GPIO.cleanup()
@@ -0,0 +1,193 @@
+import json
+import logging
+import os
+import threading
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional
+from hardware import clock
+from metrics import STAGE_TIME
+
+logger = logging.getLogger(__name__)
+
+# Values that change while the system runs, kept out of config.json
+RUNTIME_DEFAULTS = {
+    'relay_state': "OFF",
+    'last_button_pressed': None,
+    'last_pump_start_time': 0,
+    'button_b1_last_pressed': None,
+    'button_b2_last_pressed': None,
+    'next_scheduled_run': None,
+    'stopped_by_b2': False,
+    # Wall clock end of the water replacement countdown of start_system.py
+    'water_replacement_until': None,
+    # Pump cycle of main.py
+    'analysis_start_time': 0,
+    'water_replace_start_time': 0,
+    'pump_run_until': None,
+}
+
+# Samples of the rolling windows, restored after a restart: the averages of
+# each zone of start_system.py and the light history of main.py
+WINDOW_DEFAULTS = {
+    'averages': None,
+    'light_history': None,
+}
+
+
+class RuntimeStateStore:
+    """Runtime state persisted with coalesced, atomic writes.
+
+    Changes are kept in memory and marked dirty. A background thread writes
+    them `coalesce_window` seconds after the first change, and never more
+    often than once every `min_fsync_interval` seconds, so a burst of updates
+    costs a single write. Each write goes to a temporary file which is
+    fsynced and renamed over the state file, so a power cut leaves either the
+    old or the new state on the SD card, never a truncated file.
+
+    The values are an immutable mapping replaced as a whole by each update,
+    so readers need no lock and snapshot() is always consistent. Values
+    must be JSON scalars, or treated as immutable by the callers.
+    """
+
+    def __init__(self, file_path: str, defaults: Optional[Dict[str, Any]] = None,
+                 coalesce_window: float = 5.0, min_fsync_interval: float = 30.0,
+                 keys: Mapping[str, Any] = RUNTIME_DEFAULTS):
+        self.file_path = file_path
+        self.coalesce_window = coalesce_window
+        self.min_fsync_interval = min_fsync_interval
+        self._lock = threading.Lock()
+        values = dict(keys)
+        values.update(defaults or {})
+        loaded = self._load()
+        values.update(loaded)
+        # False on a cold start, when there was no state to restore
+        self.restored = bool(loaded)
+        self._values: Mapping[str, Any] = MappingProxyType(values)
+        self._dirty = set()
+        self._dirty_since = None
+        self._last_flush = float('-inf')
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+        self.flushes = 0
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], config_file: str) -> 'RuntimeStateStore':
+        """Open the store configured in config.json, seeded from legacy keys found there."""
+        settings = config.get('runtime_state', {})
+        file_path = os.path.join(os.path.dirname(os.path.abspath(config_file)), settings.get('file', 'runtime_state.json'))
+        defaults = {key: config[key] for key in RUNTIME_DEFAULTS if key in config}
+        return cls(file_path, defaults, settings.get('coalesce_window', 5.0), settings.get('min_fsync_interval', 30.0))
+
+    @classmethod
+    def windows_from_config(cls, config: Dict[str, Any], config_file: str) -> 'RuntimeStateStore':
+        """Store of the rolling window samples, in a file of its own.
+
+        The windows change on every tick and hold up to average_samples
+        values each. Their owners save them every window_save_interval and
+        at shutdown, so the runtime state file stays small and the windows
+        cost one write per interval.
+        """
+        settings = config.get('runtime_state', {})
+        file_path = os.path.join(os.path.dirname(os.path.abspath(config_file)),
+                                 settings.get('windows_file', 'runtime_windows.json'))
+        return cls(file_path, coalesce_window=0, min_fsync_interval=settings.get('window_save_interval', 300.0),
+                   keys=WINDOW_DEFAULTS)
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.file_path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"Error loading runtime state from {self.file_path}, using defaults: {e}")
+            return {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._values.get(key)
+        return default if value is None else value
+
+    def snapshot(self) -> Mapping[str, Any]:
+        """Every value at one point in time, read-only."""
+        return self._values
+
+    def update(self, **fields: Any) -> None:
+        with self._lock:
+            changed = {key: value for key, value in fields.items() if self._values.get(key) != value}
+            if changed:
+                # Copy on write, readers keep the mapping they already hold
+                self._values = MappingProxyType({**self._values, **changed})
+                self._dirty.update(changed)
+            if self._dirty and self._dirty_since is None:
+                self._dirty_since = clock.monotonic()
+                self._wakeup.set()
+
+    def set(self, key: str, value: Any) -> None:
+        self.update(**{key: value})
+
+    def flush(self) -> bool:
+        """Write the state now if anything changed, returns True when written."""
+        with self._lock:
+            if not self._dirty:
+                return False
+            values = self._values
+            dirty = self._dirty
+            self._dirty = set()
+            self._dirty_since = None
+        try:
+            with STAGE_TIME.labels('state_write').time():
+                self._write(values)
+        except OSError as e:
+            logger.error(f"Error writing runtime state to {self.file_path}: {e}")
+            with self._lock:
+                self._dirty |= dirty
+                if self._dirty_since is None:
+                    self._dirty_since = clock.monotonic()
+            return False
+        self._last_flush = clock.monotonic()
+        self.flushes += 1
+        return True
+
+    def _write(self, values: Mapping[str, Any]) -> None:
+        tmp_path = f"{self.file_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(values), f, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.file_path)
+        dir_fd = os.open(os.path.dirname(self.file_path) or '.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+    def _next_flush(self) -> Optional[float]:
+        with self._lock:
+            if self._dirty_since is None:
+                return None
+            return max(self._dirty_since + self.coalesce_window, self._last_flush + self.min_fsync_interval)
+
+    def _flush_loop(self) -> None:
+        while self._running:
+            due = self._next_flush()
+            if due is None:
+                clock.wait(self._wakeup, 3600)
+            elif clock.monotonic() >= due:
+                self.flush()
+                continue
+            else:
+                clock.wait(self._wakeup, due - clock.monotonic())
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self._flush_loop, name='state_store', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
@@ -0,0 +1,169 @@
+import json
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds between comments sent to idle event streams, so proxies and browsers keep them open
+KEEPALIVE = 15.0
+
+
+class StatusBoard:
+    """Latest controller status, with a version bumped on each change.
+
+    The controller threads call update(); it only compares and swaps a dict
+    and wakes the waiting clients, whatever their number. The JSON is built
+    by the first client that needs it, on the server threads.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._sections: Dict[str, Any] = {}
+        self._time: Optional[float] = None
+        self._encoded: Optional[str] = None
+        self.version = 0
+        self.closed = False
+
+    def update(self, timestamp: Optional[float] = None, **sections: Any) -> bool:
+        """Replace the given sections, returns whether anything changed.
+
+        The timestamp alone is not a change: clients are only woken when a
+        value or a relay state differs from the last status.
+        """
+        with self._condition:
+            if all(self._sections.get(name) == value for name, value in sections.items()):
+                return False
+            self._sections = dict(self._sections, **sections)
+            if timestamp is not None:
+                self._time = timestamp
+            self._encoded = None
+            self.version += 1
+            self._condition.notify_all()
+        return True
+
+    def current(self) -> Tuple[int, str]:
+        """(version, JSON document) of the latest status."""
+        with self._condition:
+            if self._encoded is None:
+                self._encoded = json.dumps(dict(self._sections, time=self._time, version=self.version))
+            return self.version, self._encoded
+
+    def wait(self, version: int, timeout: float) -> bool:
+        """Wait for a status newer than `version`, False on timeout or close."""
+        with self._condition:
+            self._condition.wait_for(lambda: self.version > version or self.closed, timeout)
+            return self.version > version and not self.closed
+
+    def close(self) -> None:
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    board: StatusBoard
+    server_limit: threading.BoundedSemaphore
+
+    def do_GET(self) -> None:
+        path = urllib.parse.urlsplit(self.path).path
+        if path in ('/', '/status'):
+            self.send_status()
+        elif path == '/events':
+            if not self.server_limit.acquire(blocking=False):
+                self.send_error(503, "Too many event streams")
+                return
+            try:
+                self.send_events()
+            finally:
+                self.server_limit.release()
+        else:
+            self.send_error(404)
+
+    def send_status(self) -> None:
+        body = self.board.current()[1].encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_events(self) -> None:
+        """Server-Sent Events: the current status, then each new one."""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        version = -1
+        try:
+            while True:
+                if self.board.wait(version, KEEPALIVE):
+                    # A client that fell behind gets the latest status only
+                    version, text = self.board.current()
+                    self.wfile.write(f"id: {version}\nevent: status\ndata: {text}\n\n".encode('utf-8'))
+                elif self.board.closed:
+                    break
+                else:
+                    self.wfile.write(b': keepalive\n\n')
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(f"Status request from {self.address_string()}: {format % args}")
+
+
+class StatusServer:
+    """Live status over HTTP, on localhost by default.
+
+    GET /status returns the latest status as JSON, GET /events streams it
+    as Server-Sent Events, sent when a value or a relay changes and not on
+    a timer. Each client is served by its own thread of the server.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9109, max_clients: int = 20):
+        self.board = StatusBoard()
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> Optional['StatusServer']:
+        """The server configured in config.json, None when disabled."""
+        settings = config.get('status_api', {})
+        if not settings.get('enabled', False):
+            return None
+        return cls(settings.get('host', '127.0.0.1'), settings.get('port', 9109), settings.get('max_clients', 20))
+
+    def update(self, timestamp: Optional[float] = None, **sections: Any) -> bool:
+        return self.board.update(timestamp, **sections)
+
+    def start(self) -> None:
+        handler = type('StatusHandler', (_Handler,), {
+            'board': self.board,
+            'server_limit': threading.BoundedSemaphore(self.max_clients),
+        })
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        except OSError as e:
+            logger.error(f"Cannot serve the status on {self.host}:{self.port}: {e}")
+            return
+        self._server.daemon_threads = True
+        # Port 0 picks a free port
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='status_api', daemon=True)
+        self._thread.start()
+        logger.info(f"Serving the status on http://{self.host}:{self.port}/status")
+
+    def stop(self) -> None:
+        # Ends the event streams before the server waits for its threads
+        self.board.close()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
@@ -1,8 +1,8 @@
-from w1thermsensor import W1ThermSensor
+from hardware import w1thermsensor
 
 class TempSensor:
     def __init__(self, sensor_id, temp_delta_threshold):
-        self.sensor = W1ThermSensor(sensor_id=sensor_id)
+        self.sensor = w1thermsensor.W1ThermSensor(sensor_id=sensor_id)
         self.temp_delta_threshold = temp_delta_threshold
 
     def get_temperature(self):
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pytest
+
+from backtest import POLICIES, Trace, backtest, parameters
+from pool_config import load_config
+
+CONFIG = load_config(os.path.join(os.path.dirname(__file__), '..', 'config.json'))
+
+
+def day_trace() -> Trace:
+    """A sunny day sampled every minute, the collector up to 3 °C above the pool."""
+    ts = np.arange(0, 86400, 60.0)
+    sun = np.sin(ts / 86400 * np.pi)
+    return Trace(ts, np.full(len(ts), 25.0), 25.0 + 3 * sun, np.full(len(ts), 26.0), 40000 * sun)
+
+
+@pytest.mark.parametrize('policy', ['start_system', 'control'])
+def test_relay_never_switching(policy):
+    trace = day_trace()
+    result = backtest(trace, policy, dict(parameters(CONFIG), temp_delta_threshold=50))
+    assert result.cycles == 0
+    assert result.runtime == 0.0
+    assert len(result.relay) == len(result.ticks)
+    assert not result.relay.any()
+    # The delta never reaches the threshold, nothing was missed either
+    assert result.missed == 0.0
+
+
+@pytest.mark.parametrize('policy', POLICIES)
+def test_reachable_threshold_runs_the_pump(policy):
+    result = backtest(day_trace(), policy, dict(parameters(CONFIG), temp_delta_threshold=1))
+    assert result.cycles > 0
+    assert 0 < result.runtime <= result.duration
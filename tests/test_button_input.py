@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import hardware
+import simulator
+from button_input import PRESSED, RELEASED, Button, ButtonInput
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), '..', 'config.json')
+LOW, HIGH = simulator.FakeGPIO.LOW, simulator.FakeGPIO.HIGH
+PIN = 5
+
+
+@pytest.fixture
+def gpio():
+    with open(CONFIG_FILE) as f:
+        config = json.load(f)
+    simulation = simulator.Simulation(config, clock=simulator.WallClock()).install()
+    simulation.gpio.setmode(simulation.gpio.BCM)
+    simulation.gpio.setup(PIN, simulation.gpio.IN, pull_up_down=simulation.gpio.PUD_UP)
+    yield simulation.gpio
+    hardware.install({})
+
+
+def test_tap_shorter_than_the_debounce_then_press(gpio):
+    button = Button('B1', PIN, lambda: None, 0.05)
+    assert button.on_edge(LOW, 0.0)
+    # The release of the tap comes within the debounce window
+    assert not button.on_edge(HIGH, 0.03)
+    assert button.state == PRESSED and button.settle_at == 0.05
+    # Read again once the window has ended, the button is up
+    assert not button.settle(HIGH, 0.05)
+    assert button.state == RELEASED and button.settle_at is None
+    assert button.on_edge(LOW, 1.0)
+    assert not button.on_edge(HIGH, 1.2)
+
+
+def test_bounce_settling_on_the_same_level(gpio):
+    button = Button('B1', PIN, lambda: None, 0.05)
+    assert button.on_edge(LOW, 0.0)
+    assert not button.on_edge(HIGH, 0.005)
+    assert not button.on_edge(LOW, 0.01)
+    assert not button.settle(LOW, 0.05)
+    assert button.state == PRESSED and button.bounces == 1
+
+
+def test_press_after_a_quick_tap_is_dispatched(gpio):
+    pressed = []
+    done = threading.Event()
+
+    def action():
+        pressed.append(time.monotonic())
+        if len(pressed) == 2:
+            done.set()
+
+    buttons = ButtonInput(debounce_ms=50)
+    buttons.add_button('B1', PIN, action)
+    buttons.start()
+    try:
+        gpio.set_input(PIN, LOW)
+        time.sleep(0.01)
+        gpio.set_input(PIN, HIGH)
+        time.sleep(0.2)
+        gpio.set_input(PIN, LOW)
+        time.sleep(0.1)
+        gpio.set_input(PIN, HIGH)
+        assert done.wait(2)
+    finally:
+        buttons.stop()
+    assert len(pressed) == 2
+    assert buttons.latency['B1']['count'] == 2
@@ -0,0 +1,93 @@
+import math
+import os
+
+from log_ingest import SOURCE_BLOCK, SOURCE_LINE, LogColumns, import_history
+from timeseries import TimeSeriesStore
+
+CHECKED_IN_LOG = os.path.join(os.path.dirname(__file__), '..', 'logs', 'pool_control.log')
+
+
+def parse(text: str) -> LogColumns:
+    columns = LogColumns()
+    columns.parse(text.encode('utf-8'))
+    return columns
+
+
+def test_checked_in_log():
+    # Air temperature before the delta, as older versions of start_system wrote it
+    columns = LogColumns()
+    columns.parse_file(CHECKED_IN_LOG, workers=1)
+    assert len(columns) == 12
+    assert set(columns.temp_E) == {25.0} and set(columns.temp_S) == {27.0}
+    assert set(columns.temp_A) == {26.0} and set(columns.delta) == {2.0}
+    assert set(columns.light) == {0.0}
+    assert columns.reasons == ["Water replacement in progress"]
+    assert list(columns.relay) == [1] * 12
+
+
+def test_air_after_the_delta():
+    columns = parse(
+        "2024-07-20 10:00:10,000 - INFO - 2024-07-20 10:00:10 | RELAY: OFF - [Reason: Pump stopped (automatic control)] "
+        "| Temp. Entrée: 25.00 - Moyenne: 25.10 | Temp. Sortie: 28.00* - Moyenne: 27.90 | Delta Temp: 3.00* "
+        "| Temp. Air: n/a | Luminosité: 41000.00 - Moyenne: 40000.00 | Last Button Pressed: B2\n")
+    assert len(columns) == 1
+    assert (columns.temp_E[0], columns.avg_E[0], columns.temp_S[0], columns.delta[0]) == (25.0, 25.1, 28.0, 3.0)
+    assert math.isnan(columns.temp_A[0])
+    assert (columns.light[0], columns.avg_light[0]) == (41000.0, 40000.0)
+    assert columns.buttons == ["B2"] and list(columns.relay) == [0]
+    assert list(columns.source) == [SOURCE_LINE]
+
+
+def test_without_air_and_status_block():
+    columns = parse(
+        "2024-07-20 10:00:10,000 - INFO - 2024-07-20 10:00:10 | RELAY: ON - [Reason: delta temperature (3.00) above threshold] "
+        "| Temp. Entrée: 25.00 | Temp. Sortie: 28.00 | Delta Temp: 3.00 | Luminosité: 0.00 | Last Button Pressed: None\n"
+        "2024-07-20 10:00:20,000 - INFO - \n"
+        "        Status Update:\n"
+        "        Time: 2024-07-20 10:00:20\n"
+        "        Pump Running: True\n"
+        "        Last Action: Light conditions met\n"
+        "        Temperatures:\n"
+        "            E (Pool Water): 25.00°C\n"
+        "            S (Solar Collector): 28.00°C\n"
+        "            A (Ambient): 26.00°C\n")
+    assert len(columns) == 2
+    assert math.isnan(columns.temp_A[0]) and columns.temp_A[1] == 26.0
+    assert list(columns.delta) == [3.0, 3.0]
+    assert list(columns.source) == [SOURCE_LINE, SOURCE_BLOCK]
+    assert columns.ts[1] - columns.ts[0] == 10
+
+
+ZONE_LINES = (
+        "2024-07-20 10:00:10,000 - INFO - 2024-07-20 10:00:10 | RELAY: ON - [Reason: Light conditions met] "
+        "| Temp. Entrée: 25.00 - Moyenne: 25.00 | Temp. Sortie: 28.00 - Moyenne: 28.00 | Delta Temp: 3.00 "
+        "| Temp. Air: 26.00 | Luminosité: 41000.00 - Moyenne: 41000.00 | Last Button Pressed: None\n"
+        "2024-07-20 10:00:10,000 - INFO - 2024-07-20 10:00:10 | Zone spa RELAY: OFF - [Reason: Pump stopped (automatic control)] "
+        "| Temp. Entrée: 35.00 - Moyenne: 35.00 | Temp. Sortie: 36.00 - Moyenne: 36.00 | Delta Temp: 1.00 "
+        "| Luminosité: 41000.00 - Moyenne: 41000.00 | Last Button Pressed: None\n")
+
+
+def test_zone_lines():
+    columns = parse(ZONE_LINES)
+    assert len(columns) == 2
+    assert columns.zones == ["spa"] and list(columns.zone) == [-1, 0]
+    assert list(columns.temp_E) == [25.0, 35.0] and list(columns.relay) == [1, 0]
+    assert columns.ts[0] == columns.ts[1]
+
+    other = LogColumns()
+    other.merge(parse(
+        "2024-07-20 10:00:20,000 - INFO - 2024-07-20 10:00:20 | Zone hot tub RELAY: OFF - [Reason: Pump stopped (automatic control)] "
+        "| Temp. Entrée: 35.00 | Temp. Sortie: 36.00 | Delta Temp: 1.00 | Luminosité: 0.00 | Last Button Pressed: None\n"))
+    other.merge(columns)
+    assert other.zones == ["hot tub", "spa"] and list(other.zone) == [0, -1, 1]
+    assert other.zone_code("spa") == 1 and other.zone_code(None) == -1 and other.zone_code("pool") is None
+
+
+def test_import_zone_lines(tmp_path):
+    store = TimeSeriesStore(str(tmp_path / 'history.db'))
+    import_history(parse(ZONE_LINES), store)
+    raw = store.query(0, 2e9, 'raw')
+    assert raw['temp_E'] == [25.0]
+    assert [reason for _, _, reason in store.events(0, 2e9)] == [
+        "Light conditions met", "[spa] Pump stopped (automatic control)"]
+    store.close()
@@ -0,0 +1,23 @@
+from rolling import RollingWindow
+
+
+def test_resize_keeps_the_recent_samples():
+    window = RollingWindow(10)
+    window.extend(range(20))
+    window.resize(4)
+    assert window.values() == [16.0, 17.0, 18.0, 19.0]
+    assert window.mean == 17.5
+    assert (window.min, window.max) == (16.0, 19.0)
+
+
+def test_resize_follows_the_alpha_derived_from_the_size():
+    window = RollingWindow(10)
+    assert window.alpha == 2.0 / 11
+    window.resize(4)
+    assert window.alpha == 2.0 / 5
+
+
+def test_resize_keeps_an_explicit_alpha():
+    window = RollingWindow(10, alpha=0.5)
+    window.resize(4)
+    assert window.alpha == 0.5
@@ -0,0 +1,83 @@
+import copy
+import json
+import os
+
+from pool_config import PoolConfig
+from timeseries import SAMPLE_KEYS, TimeSeriesStore
+
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), '..', 'config.json')
+
+
+def two_zone_config() -> PoolConfig:
+    """The pool of config.json plus a spa on the probes F and G."""
+    with open(CONFIG_FILE) as f:
+        raw = copy.deepcopy(json.load(f))
+    displays = raw['sensors']['temperature']['displays']
+    displays['F'] = {'id': '0000000000f1', 'name': 'spa_water', 'clk_pin': 7, 'dio_pin': 8}
+    displays['G'] = {'id': '0000000000f2', 'name': 'spa_collector', 'clk_pin': 12, 'dio_pin': 13}
+    raw['zones'] = {
+        'pool': {'sensors': {'E': 'pool_water', 'S': 'solar_collector_output', 'A': 'ambient'}},
+        'spa': {'sensors': {'E': 'spa_water', 'S': 'spa_collector'}, 'relay_pin': 17, 'policy': 'delta'},
+    }
+    return PoolConfig(raw)
+
+
+def test_two_zones(tmp_path):
+    config = two_zone_config()
+    store = TimeSeriesStore.from_config(config, str(tmp_path / 'config.json'))
+    assert store.keys == SAMPLE_KEYS + ('temp_F', 'temp_G')
+    # As start_system.record_sample builds them
+    temperatures = {'pool_water': 25.0, 'solar_collector_output': 28.0, 'ambient': 26.0,
+                    'spa_water': 36.0, 'spa_collector': 40.0}
+    for i in range(3):
+        values = {config.sensor_keys[name]: value + i for name, value in temperatures.items()}
+        values['light'] = 1000.0
+        store.add_sample(7200.0 + i * 60, values)
+    assert store.flush() == 3
+
+    raw = store.query(0, 86400, 'raw')
+    assert raw['temp_E'] == [25.0, 26.0, 27.0]
+    assert raw['temp_F'] == [36.0, 37.0, 38.0]
+    assert raw['temp_G'] == [40.0, 41.0, 42.0]
+    hourly = store.query(0, 86400, 'hour')
+    assert hourly['temp_F'] == [37.0] and hourly['temp_G_max'] == [42.0] and hourly['temp_F_n'] == [3]
+    daily = store.query(0, 86400 * 2, 'day')
+    assert daily['temp_G_min'] == [40.0] and daily['temp_E_n'] == [3]
+    store.close()
+
+
+def test_zone_added_to_an_existing_database(tmp_path):
+    file_path = str(tmp_path / 'history.db')
+    store = TimeSeriesStore(file_path)
+    store.add_sample(7200.0, {'temp_E': 25.0, 'temp_S': 28.0, 'temp_A': 26.0, 'light': 1000.0})
+    store.flush()
+    store.close()
+
+    store = TimeSeriesStore(file_path, keys=SAMPLE_KEYS + ('temp_F',))
+    store.add_sample(7260.0, {'temp_E': 25.5, 'temp_F': 36.0})
+    store.flush()
+    raw = store.query(0, 86400, 'raw')
+    assert raw['temp_E'] == [25.0, 25.5]
+    assert raw['temp_F'] == [None, 36.0]
+    assert store.query(0, 86400, 'hour')['temp_F_n'] == [1]
+    store.close()
+
+    # Opened without the new key, the store still reads every column
+    store = TimeSeriesStore(file_path)
+    assert store.keys == SAMPLE_KEYS + ('temp_F',)
+    store.close()
+
+
+def test_batch_out_of_time_order(tmp_path):
+    # As log_ingest --history imports pool_control.log before pool_control.log.1.gz
+    store = TimeSeriesStore(str(tmp_path / 'history.db'))
+    day = 86400.0
+    for first in (day, 0.0):
+        for i in range(120):
+            store.add_sample(first + 7200.0 + i * 60, {'temp_E': 25.0, 'temp_S': 28.0, 'light': 1000.0})
+    assert store.flush() == 240
+    hourly = store.query(0, 2 * day, 'hour')
+    assert sum(hourly['temp_E_n']) == 240
+    daily = store.query(-day, 3 * day, 'day')
+    assert daily['temp_E_n'] == [120, 120]
+    store.close()
@@ -0,0 +1,17 @@
+from test_backtest import CONFIG, day_trace
+
+from backtest import parameters
+from tune import grid, pareto_front, sweep
+
+
+def test_grid_with_a_point_where_the_pump_never_runs():
+    base = parameters(CONFIG)
+    base['missed_delta'] = 1.0
+    # The delta of the trace peaks at 3 °C, 50 is never reached
+    points = grid({'temp_delta_threshold': [1.0, 2.0, 50.0]})
+    rows = sweep(day_trace(), 'start_system', base, points, workers=2)
+    assert [row['temp_delta_threshold'] for row in rows] == [1.0, 2.0, 50.0]
+    never = rows[-1]
+    assert never['cycles'] == 0 and never['runtime'] == 0.0 and never['missed'] > 0
+    assert all(row['cycles'] > 0 for row in rows[:-1])
+    assert len(pareto_front(rows)) == len(rows)
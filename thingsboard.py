@@ -1,38 +1,293 @@
 # thingsboard.py
 
-import time
+import collections
 import json
-from tb_device_mqtt import TBDeviceMqttClient, TBPublishInfo
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+from hardware import clock, tb_device_mqtt
+from pool_config import load_config
 
-# Configuration des identifiants et du serveur de ThingsBoard
-THINGSBOARD_HOST = '192.168.2.99:8765'  # Remplacez par l'adresse de votre serveur ThingsBoard
-ACCESS_TOKEN = 'your-access-token'  # Remplacez par le jeton d'accès de votre appareil
+logger = logging.getLogger(__name__)
 
-client = TBDeviceMqttClient(THINGSBOARD_HOST, ACCESS_TOKEN)
-client.connect()
 
-def send_telemetry(data):
-    result = client.send_telemetry(json.dumps(data))
-    success = result.get() == TBPublishInfo.TB_ERR_SUCCESS
-    if success:
-        print(f"Télémetrie envoyée: {data}")
-    else:
-        print(f"Erreur lors de l'envoi de la télémetrie: {data}")
+class TelemetrySpool:
+    """Bounded on-disk queue of telemetry batches, one JSON array per line.
 
-def thingsboard_loop():
+    Batches are appended to `<path>` and the file is rotated to `<path>.1`
+    when it reaches half of `max_bytes`, dropping the previous `.1`. The
+    spool therefore never exceeds `max_bytes` and, when it is full, the
+    oldest telemetry is the one lost.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dropped_batches = 0
+        # Bytes already replayed in each segment
+        self._offsets: Dict[str, int] = {}
+
+    def _segments(self) -> List[str]:
+        return [path for path in (f"{self.path}.1", self.path) if os.path.exists(path)]
+
+    def __len__(self) -> int:
+        count = 0
+        for path in self._segments():
+            with open(path, 'rb') as f:
+                f.seek(self._offsets.get(path, 0))
+                count += sum(1 for _ in f)
+        return count
+
+    def append(self, batches: List[List[Dict[str, Any]]]) -> None:
+        lines = ''.join(json.dumps(batch, separators=(',', ':')) + '\n' for batch in batches)
+        try:
+            if os.path.getsize(self.path) + len(lines) > self.max_bytes // 2:
+                self._rotate()
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'a') as f:
+            f.write(lines)
+
+    def _rotate(self) -> None:
+        old = f"{self.path}.1"
+        if os.path.exists(old):
+            with open(old, 'rb') as f:
+                self.dropped_batches += sum(1 for _ in f)
+            logger.warning(f"Telemetry spool full, dropping the oldest batches in {old}")
+        self._offsets.pop(old, None)
+        os.replace(self.path, old)
+        if self.path in self._offsets:
+            self._offsets[old] = self._offsets.pop(self.path)
+
+    def replay(self, send, limit: int) -> int:
+        """Send up to `limit` spooled batches, oldest first, with `send(batch) -> bool`.
+
+        Returns the number of batches sent and stops at the first failure.
+        Progress within a segment is kept in memory and the segment deleted
+        once fully sent; after a crash the rest of a segment is sent again,
+        which ThingsBoard absorbs since telemetry is keyed by timestamp.
+        """
+        sent = 0
+        for path in self._segments():
+            with open(path, 'rb') as f:
+                f.seek(self._offsets.get(path, 0))
+                while sent < limit:
+                    line = f.readline()
+                    if not line:
+                        break
+                    try:
+                        batch = json.loads(line)
+                    except ValueError:
+                        # Torn line from a power cut
+                        batch = None
+                    if batch is not None and not send(batch):
+                        return sent
+                    self._offsets[path] = f.tell()
+                    sent += batch is not None
+                finished = not f.readline()
+            if not finished:
+                break
+            os.remove(path)
+            self._offsets.pop(path, None)
+        return sent
+
+    def compact(self) -> None:
+        """Drop the batches already replayed from the spool files."""
+        for path, offset in list(self._offsets.items()):
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    rest = f.read()
+                tmp_path = f"{path}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(rest)
+                os.replace(tmp_path, path)
+            del self._offsets[path]
+
+
+class TelemetryPublisher:
+    """Background ThingsBoard publisher.
+
+    publish() only appends the sample to a bounded in-memory queue, so the
+    sensor and control loops never wait on the network; when the queue is
+    full the oldest samples are dropped. A publisher thread sends the queue
+    every `batch_interval` seconds (sooner once `max_batch` samples are
+    waiting) as `[{"ts": ms, "values": {...}}, ...]` batches. While the broker
+    is unreachable, batches go to the disk spool and reconnection is retried
+    with exponential backoff; once connected, spooled batches are replayed,
+    a few per cycle so live telemetry keeps flowing.
+    """
+
+    def __init__(self, host: str, access_token: str, port: int = 1883, batch_interval: float = 5.0,
+                 max_batch: int = 100, max_pending: int = 5000, spool: Optional[TelemetrySpool] = None,
+                 replay_batches: int = 20, max_backoff: float = 300.0):
+        self.host = host
+        self.port = port
+        self.access_token = access_token
+        self.batch_interval = batch_interval
+        self.max_batch = max_batch
+        self.spool = spool
+        self.replay_batches = replay_batches
+        self.max_backoff = max_backoff
+        self.client = None
+        self._lock = threading.Lock()
+        self._pending = collections.deque(maxlen=max_pending)
+        self._wakeup = threading.Event()
+        self._running = False
+        self._thread = None
+        self._backoff = batch_interval
+        self._retry_at = float('-inf')
+        self.stats = {'published': 0, 'sent': 0, 'spooled': 0, 'replayed': 0, 'dropped': 0, 'failures': 0}
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any], config_file: str) -> Optional['TelemetryPublisher']:
+        """Publisher configured in config.json, None when ThingsBoard is disabled."""
+        settings = config.get('thingsboard', {})
+        if not settings.get('enabled', False):
+            return None
+        spool_file = os.path.join(os.path.dirname(os.path.abspath(config_file)), settings.get('spool_file', 'telemetry_spool.jsonl'))
+        return cls(settings['host'], settings['access_token'], settings.get('port', 1883),
+                   settings.get('batch_interval', 5.0), settings.get('max_batch', 100),
+                   settings.get('max_pending', 5000),
+                   TelemetrySpool(spool_file, settings.get('spool_max_bytes', 10 * 1024 * 1024)))
+
+    def publish(self, values: Dict[str, Any], timestamp: Optional[float] = None) -> None:
+        """Queue one sample, never blocks."""
+        ts = int((clock.time() if timestamp is None else timestamp) * 1000)
+        with self._lock:
+            if len(self._pending) == self._pending.maxlen:
+                self.stats['dropped'] += 1
+            self._pending.append({'ts': ts, 'values': values})
+            self.stats['published'] += 1
+            full = len(self._pending) >= self.max_batch
+        if full:
+            self._wakeup.set()
+
+    def _take_batches(self) -> List[List[Dict[str, Any]]]:
+        with self._lock:
+            samples = list(self._pending)
+            self._pending.clear()
+        return [samples[i:i + self.max_batch] for i in range(0, len(samples), self.max_batch)]
+
+    def _connected(self) -> bool:
+        if self.client is not None and self.client.is_connected():
+            return True
+        if clock.monotonic() < self._retry_at:
+            return False
+        try:
+            if self.client is None:
+                self.client = tb_device_mqtt.TBDeviceMqttClient(self.host, port=self.port, username=self.access_token)
+            self.client.connect(timeout=10)
+            if not self.client.is_connected():
+                raise ConnectionError("connection timed out")
+        except Exception as e:
+            logger.warning(f"ThingsBoard unreachable at {self.host}:{self.port}, retrying in {self._backoff:.0f}s: {e}")
+            self._retry_at = clock.monotonic() + self._backoff
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            return False
+        self._backoff = self.batch_interval
+        logger.info(f"Connected to ThingsBoard at {self.host}:{self.port}")
+        return True
+
+    def _send(self, batch: List[Dict[str, Any]]) -> bool:
+        try:
+            result = self.client.send_telemetry(batch)
+            if result.get() == tb_device_mqtt.TBPublishInfo.TB_ERR_SUCCESS:
+                return True
+        except Exception as e:
+            logger.warning(f"Error sending telemetry: {e}")
+        self.stats['failures'] += 1
+        return False
+
+    def _spool(self, batches: List[List[Dict[str, Any]]]) -> None:
+        if not batches:
+            return
+        if self.spool is None:
+            self.stats['dropped'] += sum(len(batch) for batch in batches)
+            return
+        try:
+            self.spool.append(batches)
+            self.stats['spooled'] += len(batches)
+        except OSError as e:
+            logger.error(f"Error spooling telemetry to {self.spool.path}: {e}")
+            self.stats['dropped'] += sum(len(batch) for batch in batches)
+
+    def flush(self) -> None:
+        """Send (or spool) everything queued."""
+        batches = self._take_batches()
+        if not self._connected():
+            self._spool(batches)
+            return
+        if self.spool is not None:
+            try:
+                self.stats['replayed'] += self.spool.replay(self._send, self.replay_batches)
+            except OSError as e:
+                logger.error(f"Error replaying telemetry spool {self.spool.path}: {e}")
+        for i, batch in enumerate(batches):
+            if not self._send(batch):
+                self._spool(batches[i:])
+                return
+            self.stats['sent'] += 1
+
+    def _publish_loop(self) -> None:
+        while self._running:
+            clock.wait(self._wakeup, self.batch_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error in telemetry publisher: {e}")
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self._publish_loop, name='telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        # Whatever could not be sent is kept in the spool for the next start
+        self._spool(self._take_batches())
+        if self.spool is not None:
+            try:
+                self.spool.compact()
+            except OSError as e:
+                logger.error(f"Error compacting telemetry spool {self.spool.path}: {e}")
+        if self.client is not None:
+            try:
+                self.client.disconnect()
+            except Exception as e:
+                logger.error(f"Error disconnecting from ThingsBoard: {e}")
+
+
+def telemetry_values(config, temperatures: Dict[str, Optional[float]], light: Optional[float]) -> Dict[str, Any]:
+    """ThingsBoard keys (temperature_E, ..., light) for readings keyed by sensor name."""
+    values = {f"temperature_{config.sensor_keys[name][len('temp_'):]}": value for name, value in temperatures.items()}
+    values['light'] = light
+    return values
+
+
+def thingsboard_loop(config_file: str = 'config.json'):
+    """Publish the sensor readings on their own, without the pool controller."""
+    from sensor import SensorManager
+
+    config = load_config(config_file)
+    publisher = TelemetryPublisher.from_config(config, config_file)
+    if publisher is None:
+        print("ThingsBoard is disabled in the configuration")
+        return
+    sensor_manager = SensorManager(config)
+    publisher.start()
     try:
         while True:
-            # Exemple de données à envoyer à ThingsBoard
-            data = {
-                "temperature_E": 23.5,
-                "temperature_A": 24.0,
-                "temperature_S": 22.8,
-                "light": 350
-            }
-            send_telemetry(data)
-            time.sleep(5)  # Attendre 5 secondes avant d'envoyer les prochaines données
+            temperatures = sensor_manager.get_temperature_data()
+            publisher.publish(telemetry_values(config, temperatures, sensor_manager.get_light_level()))
+            clock.sleep(config.update_interval)
     except KeyboardInterrupt:
-        client.disconnect()
+        publisher.stop()
 
 if __name__ == "__main__":
     thingsboard_loop()
@@ -0,0 +1,245 @@
+import collections
+import logging
+import os
+import re
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from hardware import clock
+from metrics import STAGE_TIME
+
+logger = logging.getLogger(__name__)
+
+# Columns of the sample table of a single zone installation, the keys of the
+# probes of other zones are added after them
+SAMPLE_KEYS = ('temp_E', 'temp_S', 'temp_A', 'light')
+RESOLUTIONS = {'hour': 3600, 'day': 86400}
+KEY_PATTERN = re.compile(r'^[A-Za-z_]\w*$')
+
+
+def _rollup_columns(key: str) -> List[str]:
+    return [f'{key}_n', f'{key}_sum', f'{key}_min', f'{key}_max']
+
+
+def _schema(keys: Sequence[str]) -> List[str]:
+    rollup_columns = [column for key in keys for column in _rollup_columns(key)]
+    return [
+        f"CREATE TABLE IF NOT EXISTS samples (ts REAL PRIMARY KEY, {', '.join(f'{key} REAL' for key in keys)}) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS events (ts REAL NOT NULL, relay TEXT, reason TEXT)",
+        "CREATE INDEX IF NOT EXISTS events_ts ON events (ts)",
+    ] + [
+        f"CREATE TABLE IF NOT EXISTS rollup_{name} (bucket INTEGER PRIMARY KEY, {', '.join(f'{column} REAL' for column in rollup_columns)})"
+        for name in RESOLUTIONS
+    ]
+
+
+class TimeSeriesStore:
+    """SQLite history of the sensor samples, relay transitions and action reasons.
+
+    Samples are queued in memory and written by a background thread in one
+    transaction per batch. After each batch the hourly and daily rollups of
+    the buckets it touched are refreshed (count, sum, min and max per key,
+    so rollups combine exactly), and once an hour rows older than their
+    retention are deleted; SQLite reuses the freed pages, so the file stops
+    growing once the retention periods are reached.
+
+    There is one column per sample key (temp_E, temp_F... and light). The
+    columns of `keys` missing from an existing database are added, and the
+    ones it already has are kept, so `keys` lists every key of the store.
+
+    Queries run on their own connection, so they never wait for the writer.
+    """
+
+    def __init__(self, file_path: str, raw_retention_days: float = 35, hourly_retention_days: float = 400,
+                 daily_retention_days: float = 3650, flush_interval: float = 30.0, max_pending: int = 10000,
+                 keys: Sequence[str] = SAMPLE_KEYS):
+        for key in keys:
+            if not KEY_PATTERN.match(key):
+                raise ValueError(f"Invalid sample key '{key}'")
+        self.file_path = file_path
+        self.retention = {
+            'samples': raw_retention_days * 86400,
+            'events': hourly_retention_days * 86400,
+            'rollup_hour': hourly_retention_days * 86400,
+            'rollup_day': daily_retention_days * 86400,
+        }
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=max_pending)
+        self._events = collections.deque(maxlen=max_pending)
+        self._wakeup = threading.Event()
+        self._readers = threading.local()
+        self._running = False
+        self._thread = None
+        self._last_retention = float('-inf')
+        # Day buckets follow local midnight
+        self.utc_offset = clock.localtime().tm_gmtoff
+        self.rows_written = 0
+        self.dropped = 0
+
+        self._db = self._connect()
+        with self._db:
+            for statement in _schema(keys):
+                self._db.execute(statement)
+            existing = [row[1] for row in self._db.execute("PRAGMA table_info(samples)")][1:]
+            for key in keys:
+                if key not in existing:
+                    self._db.execute(f"ALTER TABLE samples ADD COLUMN {key} REAL")
+                    for name in RESOLUTIONS:
+                        for column in _rollup_columns(key):
+                            self._db.execute(f"ALTER TABLE rollup_{name} ADD COLUMN {column} REAL")
+                    existing.append(key)
+        self.keys: Tuple[str, ...] = tuple(existing)
+        self.rollup_columns = [column for key in self.keys for column in _rollup_columns(key)]
+        self._insert_sample = (f"INSERT OR REPLACE INTO samples (ts, {', '.join(self.keys)}) "
+                               f"VALUES ({', '.join('?' * (len(self.keys) + 1))})")
+
+    @classmethod
+    def from_config(cls, config: Any, config_file: str) -> 'TimeSeriesStore':
+        """Open the store configured in config.json, next to the config file, with a column per probe."""
+        settings = config.get('history', {})
+        file_path = os.path.join(os.path.dirname(os.path.abspath(config_file)), settings.get('file', 'history.db'))
+        keys = SAMPLE_KEYS + tuple(sorted(set(config.sensor_keys.values()) - set(SAMPLE_KEYS)))
+        return cls(file_path,
+                   settings.get('raw_retention_days', 35),
+                   settings.get('hourly_retention_days', 400),
+                   settings.get('daily_retention_days', 3650),
+                   settings.get('flush_interval', 30.0),
+                   keys=keys)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.file_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def add_sample(self, timestamp: float, values: Dict[str, Optional[float]]) -> None:
+        row = (timestamp,) + tuple(values.get(key) for key in self.keys)
+        with self._lock:
+            if len(self._samples) == self._samples.maxlen:
+                self.dropped += 1
+            self._samples.append(row)
+
+    def add_event(self, timestamp: float, relay: Optional[str], reason: Optional[str]) -> None:
+        with self._lock:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append((timestamp, relay, reason))
+
+    def flush(self) -> int:
+        """Write the queued rows now, returns the number of rows written."""
+        with self._lock:
+            samples = list(self._samples)
+            events = list(self._events)
+            self._samples.clear()
+            self._events.clear()
+        if not samples and not events:
+            return 0
+        try:
+            with STAGE_TIME.labels('history_write').time(), self._db:
+                self._db.executemany(self._insert_sample, samples)
+                self._db.executemany("INSERT INTO events VALUES (?, ?, ?)", events)
+                if samples:
+                    # Not in time order when log files are imported newest first
+                    timestamps = [row[0] for row in samples]
+                    self._rollup(min(timestamps), max(timestamps))
+        except sqlite3.Error as e:
+            logger.error(f"Error writing history to {self.file_path}: {e}")
+            return 0
+        self.rows_written += len(samples) + len(events)
+        return len(samples) + len(events)
+
+    def _bucket(self, timestamp: float, width: int) -> int:
+        return int((timestamp + self.utc_offset) // width * width - self.utc_offset)
+
+    def _rollup(self, first: float, last: float) -> None:
+        offset = self.utc_offset
+        columns = ', '.join(self.rollup_columns)
+        width = RESOLUTIONS['hour']
+        aggregates = ', '.join(f"COUNT({key}), SUM({key}), MIN({key}), MAX({key})" for key in self.keys)
+        self._db.execute(
+            f"INSERT OR REPLACE INTO rollup_hour (bucket, {columns}) SELECT CAST((ts + {offset}) / {width} AS INTEGER) * {width} - {offset}, {aggregates} "
+            f"FROM samples WHERE ts >= ? AND ts < ? GROUP BY 1",
+            (self._bucket(first, width), self._bucket(last, width) + width))
+
+        width = RESOLUTIONS['day']
+        aggregates = ', '.join(f"SUM({key}_n), SUM({key}_sum), MIN({key}_min), MAX({key}_max)" for key in self.keys)
+        self._db.execute(
+            f"INSERT OR REPLACE INTO rollup_day (bucket, {columns}) SELECT CAST((bucket + {offset}) / {width} AS INTEGER) * {width} - {offset}, {aggregates} "
+            f"FROM rollup_hour WHERE bucket >= ? AND bucket < ? GROUP BY 1",
+            (self._bucket(first, width), self._bucket(last, width) + width))
+
+    def apply_retention(self, now: Optional[float] = None) -> None:
+        now = clock.time() if now is None else now
+        column = {'samples': 'ts', 'events': 'ts', 'rollup_hour': 'bucket', 'rollup_day': 'bucket'}
+        try:
+            with self._db:
+                for table, seconds in self.retention.items():
+                    self._db.execute(f"DELETE FROM {table} WHERE {column[table]} < ?", (now - seconds,))
+        except sqlite3.Error as e:
+            logger.error(f"Error applying history retention: {e}")
+
+    def _writer_loop(self) -> None:
+        while self._running:
+            clock.wait(self._wakeup, self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+            if clock.monotonic() - self._last_retention >= 3600:
+                self.apply_retention()
+                self._last_retention = clock.monotonic()
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self._writer_loop, name='timeseries', daemon=True)
+        self._thread.start()
+
+    def close(self) -> None:
+        self._running = False
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self._db.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        db = getattr(self._readers, 'db', None)
+        if db is None:
+            db = self._readers.db = sqlite3.connect(self.file_path)
+        return db
+
+    def query(self, start: float, end: float, resolution: str = 'auto') -> Dict[str, List[Any]]:
+        """Samples with start <= ts < end, as columns.
+
+        `resolution` is 'raw', 'hour', 'day' or 'auto' (raw up to two days,
+        hourly up to 90 days, daily beyond). Raw results have a 'ts' column
+        and one column per key. Rollups have a 'ts' column with the bucket
+        start, and per key its mean plus `<key>_min`, `<key>_max` and the
+        sample count `<key>_n`.
+        """
+        if resolution == 'auto':
+            span = end - start
+            resolution = 'raw' if span <= 2 * 86400 else 'hour' if span <= 90 * 86400 else 'day'
+        if resolution == 'raw':
+            rows = self._reader().execute(
+                f"SELECT ts, {', '.join(self.keys)} FROM samples WHERE ts >= ? AND ts < ? ORDER BY ts", (start, end)).fetchall()
+            names = ('ts',) + self.keys
+            return {name: [row[i] for row in rows] for i, name in enumerate(names)}
+        if resolution not in RESOLUTIONS:
+            raise ValueError(f"Unknown resolution '{resolution}', expected 'auto', 'raw' or one of {tuple(RESOLUTIONS)}")
+
+        rows = self._reader().execute(
+            f"SELECT bucket, {', '.join(self.rollup_columns)} FROM rollup_{resolution} WHERE bucket >= ? AND bucket < ? ORDER BY bucket",
+            (self._bucket(start, RESOLUTIONS[resolution]), end)).fetchall()
+        columns: Dict[str, List[Any]] = {'ts': [row[0] for row in rows]}
+        for i, key in enumerate(self.keys):
+            n, total, low, high = (1 + 4 * i + j for j in range(4))
+            columns[key] = [row[total] / row[n] if row[n] else None for row in rows]
+            columns[f'{key}_min'] = [row[low] for row in rows]
+            columns[f'{key}_max'] = [row[high] for row in rows]
+            columns[f'{key}_n'] = [int(row[n] or 0) for row in rows]
+        return columns
+
+    def events(self, start: float, end: float) -> List[Tuple[float, Optional[str], Optional[str]]]:
+        """Relay transitions and action reasons with start <= ts < end, as (ts, relay, reason)."""
+        return self._reader().execute(
+            "SELECT ts, relay, reason FROM events WHERE ts >= ? AND ts < ? ORDER BY ts", (start, end)).fetchall()
@@ -0,0 +1,176 @@
+import argparse
+import concurrent.futures
+import csv
+import itertools
+import math
+import multiprocessing
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from backtest import POLICIES, POLICY_PARAMETERS, Trace, backtest, parameters, parse_timestamp
+
+METRICS = ('missed', 'cycles', 'runtime')
+# Parameters that only take whole values
+INTEGER_PARAMETERS = ('average_samples',)
+
+# The trace of a worker process, inherited when forked or loaded once by _init_worker
+_trace: Optional[Trace] = None
+
+
+def parse_range(spec: str) -> Tuple[str, List[float]]:
+    """'name=1,2,5' lists the values, 'name=1:6:0.5' is a range with its end included."""
+    name, _, values = spec.partition('=')
+    if not values:
+        raise ValueError(f"Expected name=values, got '{spec}'")
+    integer = name in INTEGER_PARAMETERS
+    if ':' in values:
+        start, stop, step = (float(value) for value in values.split(':'))
+        if step <= 0:
+            raise ValueError(f"Step of '{name}' must be positive")
+        count = int(math.floor((stop - start) / step + 1e-9)) + 1
+        points = [start + i * step for i in range(count)]
+    else:
+        points = [float(value) for value in values.split(',')]
+    return name, [int(round(point)) if integer else point for point in points]
+
+
+def grid(ranges: Dict[str, List[float]]) -> List[Dict[str, float]]:
+    names = list(ranges)
+    return [dict(zip(names, point)) for point in itertools.product(*(ranges[name] for name in names))]
+
+
+def random_sample(ranges: Dict[str, List[float]], count: int, seed: int = 0) -> List[Dict[str, float]]:
+    """`count` points drawn uniformly between the smallest and largest value of each range."""
+    generator = random.Random(seed)
+    points = []
+    for _ in range(count):
+        point = {}
+        for name, values in ranges.items():
+            low, high = min(values), max(values)
+            point[name] = generator.randint(low, high) if name in INTEGER_PARAMETERS else generator.uniform(low, high)
+        points.append(point)
+    return points
+
+
+def _init_worker(trace: Optional[Trace]) -> None:
+    global _trace
+    if trace is not None:
+        _trace = trace
+
+
+def _evaluate(task: Tuple[str, Dict[str, Any]]) -> Tuple[int, float, float]:
+    policy, params = task
+    result = backtest(_trace, policy, params)
+    return result.cycles, result.runtime, result.missed
+
+
+def pareto_front(rows: Sequence[Dict[str, Any]]) -> List[bool]:
+    """True for the rows no other row beats on every metric."""
+    values = np.array([[row[metric] for metric in METRICS] for row in rows], dtype=float).reshape(-1, len(METRICS))
+    return [not np.any(np.all(values <= point, axis=1) & np.any(values < point, axis=1)) for point in values]
+
+
+def sweep(trace: Trace, policy: str, base: Dict[str, Any], points: List[Dict[str, float]],
+          workers: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Backtest the policy at each point (parameter overrides of `base`) on a process pool.
+
+    The trace is inherited by forked workers rather than sent to each of
+    them. Each row holds the parameters and the three metrics.
+    """
+    global _trace
+    tasks = [(policy, dict(base, **point)) for point in points]
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _trace = trace
+        results = [_evaluate(task) for task in tasks]
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        if 'fork' in methods:
+            _trace = trace
+            context, initargs = multiprocessing.get_context('fork'), (None,)
+        else:
+            context, initargs = multiprocessing.get_context(), (trace,)
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker,
+                                                    initargs=initargs) as executor:
+            results = list(executor.map(_evaluate, tasks, chunksize=max(1, len(tasks) // (workers * 8))))
+    return [dict(point, cycles=cycles, runtime=runtime, missed=missed)
+            for point, (cycles, runtime, missed) in zip(points, results)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search the control parameters on recorded sensor data")
+    parser.add_argument('source', nargs='+', help="history database, or pool_control.log files")
+    parser.add_argument('--policy', choices=POLICIES, default='start_system')
+    parser.add_argument('--config', default='config.json', help="values of the parameters not searched")
+    parser.add_argument('--start', type=parse_timestamp, default=0, help='"YYYY-MM-DD HH:MM" (history database only)')
+    parser.add_argument('--end', type=parse_timestamp, default=math.inf, help='"YYYY-MM-DD HH:MM" (history database only)')
+    parser.add_argument('--range', dest='ranges', action='append', default=[], metavar='NAME=VALUES',
+                        help="values to try, 'a,b,c' or 'start:stop:step' (repeatable)")
+    parser.add_argument('--random', type=int, metavar='N', help="evaluate N random points within the ranges instead of the grid")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, help="processes (default: one per CPU)")
+    parser.add_argument('--missed-delta', type=float,
+                        help="delta counted as missed when the pump is off (default: temp_delta_threshold of the config)")
+    parser.add_argument('--sort', default=','.join(METRICS), help="metrics to rank by, in order of importance")
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--csv', help="write every result to this file")
+    args = parser.parse_args()
+
+    from pool_config import load_config
+    base = parameters(load_config(args.config))
+    # The same missed time for every parameter set, whatever its own threshold
+    base['missed_delta'] = base['temp_delta_threshold'] if args.missed_delta is None else args.missed_delta
+    ranges = dict(parse_range(spec) for spec in args.ranges)
+    for name in list(ranges):
+        if name not in base:
+            parser.error(f"Unknown parameter '{name}', expected one of {tuple(base)}")
+        if name not in POLICY_PARAMETERS[args.policy]:
+            print(f"{args.policy} does not use {name}, ignoring its range")
+            del ranges[name]
+    if not ranges:
+        parser.error("Nothing to search, give at least one --range the policy uses")
+    sort = args.sort.split(',')
+    for metric in sort:
+        if metric not in METRICS:
+            parser.error(f"Unknown metric '{metric}', expected one of {METRICS}")
+
+    begin = time.perf_counter()
+    if args.source[0].endswith('.log'):
+        trace = Trace.from_logs(args.source)
+    else:
+        trace = Trace.from_history(args.source[0], args.start, args.end)
+    print(f"Loaded {len(trace)} samples in {time.perf_counter() - begin:.2f} s")
+    if not len(trace):
+        return
+
+    points = random_sample(ranges, args.random, args.seed) if args.random else grid(ranges)
+    begin = time.perf_counter()
+    rows = sweep(trace, args.policy, base, points, args.workers)
+    elapsed = time.perf_counter() - begin
+    print(f"Evaluated {len(rows)} parameter sets in {elapsed:.1f} s ({len(rows) / max(elapsed, 1e-9):.1f}/s)")
+
+    for row, optimal in zip(rows, pareto_front(rows)):
+        row['pareto'] = optimal
+    rows.sort(key=lambda row: tuple(row[metric] for metric in sort))
+    names = list(ranges)
+    print("  ".join(f"{name:>20}" for name in names) + f"{'cycles':>8}{'runtime':>10}{'missed':>10}")
+    for row in rows[:args.top]:
+        print("  ".join(f"{row[name]:>20.6g}" for name in names)
+              + f"{row['cycles']:>8}{row['runtime'] / 3600:>9.1f}h{row['missed'] / 3600:>9.1f}h"
+              + (" *" if row['pareto'] else ""))
+    print("* no other parameter set does better on every metric")
+
+    if args.csv:
+        with open(args.csv, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=names + list(METRICS) + ['pareto'])
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"Results written to {args.csv}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+import glob
+import os
+
+# sysfs interface of the kernel w1_therm driver (Linux >= 5.10)
+W1_DEVICES_DIR = '/sys/bus/w1/devices'
+
+_temperature_paths = {}
+
+
+def _bulk_read_files():
+    return glob.glob(os.path.join(W1_DEVICES_DIR, 'w1_bus_master*', 'therm_bulk_read'))
+
+
+def bulk_convert_supported() -> bool:
+    """True when the w1 masters expose the therm_bulk_read trigger."""
+    return bool(_bulk_read_files())
+
+
+def trigger_bulk_conversion() -> None:
+    """Start a temperature conversion on every probe of every w1 master at once."""
+    for path in _bulk_read_files():
+        with open(path, 'w') as f:
+            f.write('trigger\n')
+
+
+def read_converted(sensor_id: str) -> float:
+    """Return the result of the last bulk conversion for a probe, in °C.
+
+    The driver waits for the end of the pending conversion on the first read,
+    later reads return immediately without starting a new conversion.
+    """
+    path = _temperature_paths.get(sensor_id)
+    if path is None:
+        matches = glob.glob(os.path.join(W1_DEVICES_DIR, f'*-{sensor_id}', 'temperature'))
+        if not matches:
+            raise OSError(f"No w1 device found with id {sensor_id}")
+        path = _temperature_paths[sensor_id] = matches[0]
+    with open(path, 'r') as f:
+        return int(f.read().strip()) / 1000.0
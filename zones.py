@@ -0,0 +1,260 @@
+import itertools
+import logging
+import threading
+import time
+from typing import AbstractSet, Any, Callable, Mapping, NamedTuple, Optional
+from hardware import GPIO, clock
+from pool_config import LIGHT_SENSOR, Zone
+from policies import Decision, delta_decision, light_and_delta_decision
+from rolling import RollingWindow
+from log_pipeline import STATUS_LOGGER
+from sensor_guard import SensorReading
+
+logger = logging.getLogger(__name__)
+status_log = logging.getLogger(STATUS_LOGGER)
+
+STATUS_LINE = ("%s | %sRELAY: %s - [Reason: %s] | Temp. Entrée: %s - Moyenne: %s | Temp. Sortie: %s - Moyenne: %s "
+               "| Delta Temp: %s | Luminosité: %s - Moyenne: %s | Last Button Pressed: %s")
+# With the air probe of the zone
+STATUS_LINE_AIR = STATUS_LINE.replace("| Luminosité:", "| Temp. Air: %s | Luminosité:")
+
+
+class ControllerStatus(NamedTuple):
+    """State shared by the control job, log_status and the buttons, replaced as a whole."""
+    relay_state: str = "OFF"
+    last_button_pressed: Optional[str] = None
+    # Number of the running water replacement countdown, None when control is automatic
+    countdown: Optional[int] = None
+    last_action_reason: str = "System initialized"
+
+    @property
+    def countdown_active(self) -> bool:
+        return self.countdown is not None
+
+
+def zone_decision(zone: Zone, status: ControllerStatus, temp_E: float, temp_S: float,
+                  light: Optional[float]) -> Optional[Decision]:
+    """Relay change wanted by the policy of the zone, None to keep the relay as it is."""
+    if zone.policy == 'delta':
+        decision = delta_decision(temp_E, temp_S, zone.temp_delta_threshold)
+        return None if decision.relay == status.relay_state else decision
+    return light_and_delta_decision(temp_E, temp_S, light, status.relay_state, status.last_button_pressed,
+                                    zone.temp_delta_threshold, zone.light_threshold)
+
+
+class ZoneController:
+    """Relay, buttons, countdown and decisions of one zone of start_system.PoolControlSystem.
+
+    The zones share the system's sensors, scheduler, runtime state and
+    history. The first zone keeps the runtime state keys, job names and
+    log format of a single zone controller; the others prefix them with
+    their name, so an existing installation reads and writes the same files.
+    """
+
+    def __init__(self, system: Any, zone: Zone, primary: bool):
+        self.system = system
+        self.zone = zone
+        self.name = zone.name
+        self.relay_pin = zone.relay_pin
+        self.primary = primary
+        self._prefix = '' if primary else f"{zone.name}."
+        self._lock = threading.Lock()
+        self._countdowns = itertools.count(1)
+        self.countdown_timer = None
+        # Warned once per outage of the light sensor, not on every step
+        self._light_missing = False
+        self.averages = {role: RollingWindow(system.config.average_samples) for role in ('E', 'S', 'A', 'light')}
+        # Warm restart: the relay, the last button and the averages persisted before it
+        saved = system.windows.get(self._prefix + 'averages') or {}
+        for key, window in self.averages.items():
+            window.extend(saved.get(key, ()))
+        self.status = ControllerStatus(relay_state=self.get_state('relay_state', "OFF"),
+                                       last_button_pressed=self.get_state('last_button_pressed'))
+        self.system.timeseries.add_event(clock.time(), self.status.relay_state, self._event(self.status.last_action_reason))
+
+    @property
+    def settings(self) -> Zone:
+        """Parameters of the zone in the current configuration."""
+        return self.system.config.zones_by_name.get(self.name, self.zone)
+
+    def get_state(self, key: str, default: Any = None) -> Any:
+        return self.system.state.get(self._prefix + key, default)
+
+    def update_state(self, **fields: Any) -> None:
+        self.system.state.update(**{self._prefix + key: value for key, value in fields.items()})
+
+    def _event(self, reason: str) -> str:
+        return reason if self.primary else f"[{self.name}] {reason}"
+
+    def publish(self, when: Optional[Callable[[ControllerStatus], bool]] = None, **changes: Any) -> Optional[ControllerStatus]:
+        """Replace the status with a copy carrying `changes`, in one swap.
+
+        Readers take `self.status` once and get a consistent view without a
+        lock. Writers are serialized: `when` is checked against the current
+        status and the change is dropped (None returned) when it fails, so a
+        decision made on a status that a button press has replaced since is
+        not applied. The relay, the persisted state and the history event
+        follow the status within the same swap.
+        """
+        with self._lock:
+            current = self.status
+            if when is not None and not when(current):
+                return None
+            status = current._replace(**changes)
+            if 'relay_state' in changes:
+                GPIO.output(self.relay_pin, GPIO.HIGH if status.relay_state == "ON" else GPIO.LOW)
+            self.status = status
+            # Every new reason goes to the history along with the relay state it led to
+            if status.last_action_reason != current.last_action_reason:
+                self.system.timeseries.add_event(clock.time(), status.relay_state, self._event(status.last_action_reason))
+            self.update_state(relay_state=status.relay_state, last_button_pressed=status.last_button_pressed)
+        self.system.push_zone_status()
+        return status
+
+    def setup_gpio(self) -> None:
+        GPIO.setup(self.relay_pin, GPIO.OUT)
+        GPIO.output(self.relay_pin, GPIO.HIGH if self.status.relay_state == "ON" else GPIO.LOW)
+        for pin in (self.zone.button_b1_pin, self.zone.button_b2_pin):
+            if pin is not None:
+                GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def add_buttons(self, button_input: Any) -> None:
+        for button, pin, action in (('B1', self.zone.button_b1_pin, self.button_b1_action),
+                                    ('B2', self.zone.button_b2_pin, self.button_b2_action)):
+            if pin is not None:
+                button_input.add_button(self._prefix + button, pin, action)
+
+    def button_b1_action(self):
+        countdown = self.start_countdown()
+        self.publish(relay_state="ON", last_button_pressed="B1", countdown=countdown,
+                     last_action_reason="Button B1 pressed")
+        self.update_state(
+            last_pump_start_time=clock.time(),
+            button_b1_last_pressed=time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime()),
+        )
+        logger.info(self._event("Pump started/restarted by B1"))
+
+    def button_b2_action(self):
+        self.stop_countdown()
+        self.publish(relay_state="OFF", last_button_pressed="B2", countdown=None,
+                     last_action_reason="Button B2 pressed")
+        self.update_state(button_b2_last_pressed=time.strftime("%Y-%m-%d %H:%M:%S", clock.localtime()))
+        logger.info(self._event("Pump stopped by B2"))
+
+    def start_countdown(self, duration: Optional[float] = None) -> int:
+        """(Re)start the water replacement timer, returns the countdown number to publish.
+
+        Automatic control resumes when it ends, after water_replace_time by default.
+        """
+        self.stop_countdown()
+        countdown = next(self._countdowns)
+        if duration is None:
+            duration = self.settings.water_replace_time
+        self.countdown_timer = self.system.scheduler.call_later(
+            self._prefix + 'water_replacement', duration, lambda: self.end_countdown(countdown))
+        self.update_state(water_replacement_until=clock.time() + duration)
+        return countdown
+
+    def initial_countdown(self) -> Optional[int]:
+        """Countdown to publish at startup.
+
+        A full water replacement on a cold start; after a restart, only what
+        was left of the persisted one, so automatic control resumes at once.
+        """
+        if not self.system.state.restored:
+            return self.start_countdown()
+        until = self.get_state('water_replacement_until')
+        remaining = until - clock.time() if until is not None else 0
+        if remaining > 0:
+            return self.start_countdown(remaining)
+        self.update_state(water_replacement_until=None)
+        return None
+
+    def stop_countdown(self):
+        if self.countdown_timer is not None:
+            self.countdown_timer.cancel()
+            self.countdown_timer = None
+            self.update_state(water_replacement_until=None)
+
+    def end_countdown(self, countdown: int):
+        # Ignored when B1 restarted the countdown or B2 stopped it in the meantime
+        reason = "Water replacement time ended. Switching to normal control logic."
+        if self.publish(when=lambda current: current.countdown == countdown, countdown=None,
+                        last_action_reason=reason) is not None:
+            self.countdown_timer = None
+            self.update_state(water_replacement_until=None)
+            logger.info(self._event(reason))
+
+    def readings(self, temperatures: Mapping[str, Optional[float]]) -> Mapping[str, Optional[float]]:
+        """Role (E, S, A) -> temperature of the zone's probes, from readings keyed by sensor name."""
+        return {role: temperatures.get(name) for role, name in self.zone.probes.items()}
+
+    def control_step(self, temperatures: Mapping[str, Optional[float]], light: Optional[float]) -> None:
+        status = self.status
+        if not status.countdown_active:
+            readings = self.readings(temperatures)
+            if readings['E'] is None or readings['S'] is None:
+                logger.warning(self._event("Temperature missing, keeping relay state"))
+                return
+            if light is None and self.settings.policy != 'delta':
+                if not self._light_missing:
+                    logger.warning(self._event("Light level missing, keeping relay state"))
+                    self._light_missing = True
+                return
+            self._light_missing = False
+            decision = zone_decision(self.settings, status, readings['E'], readings['S'], light)
+            # A button pressed since the status was read wins, the next step decides again
+            if decision is not None and self.publish(when=lambda current: current is status,
+                                                     relay_state=decision.relay,
+                                                     last_action_reason=decision.reason) is not None:
+                logger.info(self._event(decision.reason))
+        else:
+            self.publish(when=lambda current: current.countdown == status.countdown,
+                         last_action_reason="Water replacement in progress")
+
+    def save_averages(self) -> None:
+        """Store the samples of the averages, every window_save_interval and at shutdown."""
+        self.system.windows.set(self._prefix + 'averages', {key: window.values() for key, window in self.averages.items()})
+
+    def log_status(self, timestamp: str, temperatures: Optional[Mapping[str, Optional[float]]],
+                   light: Optional[float], average_samples: int, stale: AbstractSet[str] = frozenset()) -> None:
+        status = self.status
+        if temperatures is not None:
+            readings = dict(self.readings(temperatures), light=light)
+            # Role -> whether its value is a last known one, kept out of the averages
+            stale = {role: name in stale for role, name in [*self.zone.probes.items(), ('light', LIGHT_SENSOR)]}
+            for key, window in self.averages.items():
+                window.resize(average_samples)
+                if readings.get(key) is not None and not stale[key]:
+                    window.push(readings[key])
+            avg = {key: window.mean for key, window in self.averages.items()}
+            if readings['E'] is not None and readings['S'] is not None:
+                delta_temp = SensorReading(readings['S'] - readings['E'], stale['E'] or stale['S'])
+            else:
+                delta_temp = SensorReading(None)
+            air = (SensorReading(readings['A'], stale['A']),) if 'A' in self.zone.probes else ()
+
+            # Formatted by the log writer, which also prints it to the console
+            status_log.info(STATUS_LINE_AIR if air else STATUS_LINE,
+                            timestamp, '' if self.primary else f'Zone {self.name} ', status.relay_state,
+                            status.last_action_reason,
+                            SensorReading(readings['E'], stale['E']), SensorReading(avg['E']),
+                            SensorReading(readings['S'], stale['S']), SensorReading(avg['S']),
+                            delta_temp, *air, SensorReading(light, stale['light']), SensorReading(avg['light']),
+                            status.last_button_pressed)
+
+        countdown_timer = self.countdown_timer
+        if countdown_timer is not None:
+            time_left = countdown_timer.deadline - clock.monotonic()
+            logger.info(self._event(f"Water Replace Time Left: {time_left:.2f} seconds"))
+
+        reason = status.last_action_reason
+        if status.relay_state == "ON":
+            if status.last_button_pressed == "B1":
+                reason = "Pump started by Button B1"
+            elif status.last_button_pressed == "B2":
+                reason = "Pump stopped by Button B2"
+        elif status.relay_state == "OFF":
+            reason = "Pump stopped (automatic control)"
+        if reason != status.last_action_reason:
+            self.publish(when=lambda current: current is status, last_action_reason=reason)